@@ -14,4 +14,38 @@ module kb_DRAM {
     funcdef run_kb_dram_annotate(mapping<string,UnspecifiedObject> params) returns (ReportResults output) authentication required;
     funcdef run_kb_dram_annotate_genome(mapping<string,UnspecifiedObject> params) returns (ReportResults output) authentication required;
     funcdef run_kb_dramv_annotate(mapping<string,UnspecifiedObject> params) returns (ReportResults output) authentication required;
+
+    /*
+        Distills the annotations of an earlier DRAM or DRAM-v run without annotating again. Takes
+        annotations_shock_id or annotations_handle_id, or the report_ref of the earlier run, with optional trnas and
+        rrnas ids in the same form, and viral to distill DRAM-v annotations.
+    */
+    funcdef run_kb_dram_distill(mapping<string,UnspecifiedObject> params) returns (ReportResults output) authentication required;
+
+    typedef structure {
+        string stage;
+        int wall_seconds;
+        int peak_memory_bytes;
+        int scratch_bytes;
+        int calibrated;
+    } StageEstimate;
+
+    typedef structure {
+        int input_count;
+        int input_bases;
+        int predicted_genes;
+        int wall_seconds;
+        int peak_memory_bytes;
+        int scratch_bytes;
+        list<string> uncalibrated_stages;
+        list<StageEstimate> stages;
+    } ResourceEstimate;
+
+    /*
+        Predicts the genes, peak memory, scratch and wall time of an annotation run from the input metadata,
+        without running DRAM. Takes assembly_input_ref or genome_input_ref as the run would, and is_metagenome or
+        gff_genome_import for assemblies. Stages with no recorded timings have calibrated 0, are left out of the
+        totals and are listed in uncalibrated_stages.
+    */
+    funcdef estimate_kb_dram_resources(mapping<string,UnspecifiedObject> params) returns (ResourceEstimate output) authentication required;
 };
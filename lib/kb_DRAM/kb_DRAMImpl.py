@@ -1,31 +1,30 @@
 # -*- coding: utf-8 -*-
 #BEGIN_HEADER
+import functools
 import logging
 import os
-import pandas as pd
-import yaml
 import warnings
 
-from mag_annotator import __version__ as dram_version
-from mag_annotator.database_handler import import_config, set_database_paths, print_database_locations
-from mag_annotator.annotate_bins import annotate_bins, annotate_called_genes
-from mag_annotator.summarize_genomes import summarize_genomes
-from mag_annotator.annotate_vgfs import annotate_vgfs, remove_bad_chars
-from mag_annotator.summarize_vgfs import summarize_vgfs
-from mag_annotator.utils import remove_suffix
-
-from installed_clients.WorkspaceClient import Workspace as workspaceService
-from installed_clients.AssemblyUtilClient import AssemblyUtil
-from installed_clients.GenomeFileUtilClient import GenomeFileUtil
-from installed_clients.cb_annotation_ontology_apiClient import cb_annotation_ontology_api
-from installed_clients.KBaseDataObjectToFileUtilsClient import KBaseDataObjectToFileUtils
-from installed_clients.DataFileUtilClient import DataFileUtil
-
-from .utils.dram_util import get_annotation_files, get_distill_files, generate_genomes, add_ontology_terms,\
-    get_viral_distill_files
-from .utils.kbase_util import generate_product_report
+# pandas, yaml, DRAM and the clients are imported by the methods that use them, so the server starts and answers
+# status without loading them
+from .utils.cache_util import DistillCache
+from .utils.scratch_util import JobScratch, StageManifest
+from .utils.trace_util import RPCTracer
+from .utils.profile_util import RunProfiler
 
 THREADS = 30
+# bins are split into this many size balanced shards that DRAM annotates at once, sharing THREADS, each shard is a
+# DRAM process with its own databases loaded so peak memory grows with the shard count
+ANNOTATION_SHARDS = 1
+# recorded stage timings the resource estimate is fit to
+STAGE_TIMINGS_LOC = '/kb/module/data/stage_timings.tsv'
+# annotation tables larger than this are processed a genome at a time instead of held in memory
+CHUNKED_ANNOTATIONS_SIZE = 2 * 1024 ** 3
+# metabolism_summary.xlsx sheets are also attached in these formats
+METABOLISM_SHEET_FORMATS = ('tsv', 'parquet')
+# methods whose RPC summary and profile go on the job timeline whether they succeed or fail
+LOGGED_METHODS = ('run_kb_dram_annotate', 'run_kb_dram_annotate_genome', 'run_kb_dramv_annotate',
+                  'run_kb_dram_distill', 'estimate_kb_dram_resources')
 
 # TODO: Fix no pfam annotations bug
 #END_HEADER
@@ -51,6 +50,52 @@ class kb_DRAM:
     GIT_COMMIT_HASH = ""
 
     #BEGIN_CLASS_HEADER
+    def _log_rpc_summary(self):
+        # the calls this run made go on the job timeline, the next run starts counting again
+        if self.rpc_tracer is not None:
+            self.rpc_tracer.log_summary()
+            self.rpc_tracer.reset()
+
+    def _annotation_shards(self, params):
+        # the annotation_shards parameter, or annotation-shards from deploy.cfg
+        shards = params.get('annotation_shards', self.annotation_shards)
+        if not isinstance(shards, int) or shards < 1:
+            raise ValueError('annotation_shards must be a positive integer')
+        return shards
+
+    def _check_projected_scratch(self, scratch, stage, input_sizes):
+        # checkpoint checks the budget after each stage, this fails a run before a stage expected to go over it
+        if scratch.budget is None:
+            return
+        from .utils.estimate_util import load_stage_model, predict_stage_scratch
+        scratch.check_projected(stage, predict_stage_scratch(input_sizes, stage, load_stage_model(STAGE_TIMINGS_LOC)))
+
+    def _logged(self, method):
+        # wraps a method so a failed run is profiled and logged like one that succeeds
+        @functools.wraps(method)
+        def logged_method(ctx, params):
+            try:
+                return method(ctx, params)
+            finally:
+                self._stop_profiler(ctx, ctx.get('profiler'))
+                self._log_rpc_summary()
+        return logged_method
+
+    def _start_profiler(self, ctx, params, scratch, method):
+        # the profiler is kept in the call's context so _logged can stop it if the run fails
+        if not (self.profile or params.get('profile')):
+            return None
+        ctx['profiler'] = RunProfiler(scratch.path('profile'), method).start()
+        return ctx['profiler']
+
+    def _stop_profiler(self, ctx, profiler, output_files=None):
+        # every profiled run is summarized on the job timeline, the profile files go in the report for admins only,
+        # a failed run's stay in its scratch directory
+        if profiler is None or not profiler.running:
+            return
+        profile_file = profiler.stop()
+        if output_files is not None and ctx.get('user_id') in self.profile_admins:
+            output_files['profile'] = profile_file
     #END_CLASS_HEADER
 
     # config contains contents of config file in a hash or None if it couldn't
@@ -60,8 +105,33 @@ class kb_DRAM:
         self.callback_url = os.environ['SDK_CALLBACK_URL']
         self.workspaceURL = config['workspace-url']
         self.shared_folder = config['scratch']
+        # bytes a run may hold in its scratch directory, no limit when not set
+        if config.get('scratch-budget-gb'):
+            self.scratch_budget = int(float(config['scratch-budget-gb']) * 1024 ** 3)
+        else:
+            self.scratch_budget = None
+        self.annotation_shards = int(config.get('annotation-shards') or ANNOTATION_SHARDS)
+        # distill outputs are reused between runs with the same inputs when a cache directory is set
+        if config.get('distill-cache-dir'):
+            distill_cache_bytes = None
+            if config.get('distill-cache-gb'):
+                distill_cache_bytes = int(float(config['distill-cache-gb']) * 1024 ** 3)
+            self.distill_cache = DistillCache(config['distill-cache-dir'], distill_cache_bytes)
+        else:
+            self.distill_cache = None
+        # calls made through the clients are traced by method when rpc-tracing is set
+        if config.get('rpc-tracing', '').lower() in ('true', 'yes', '1'):
+            self.rpc_tracer = RPCTracer().start()
+        else:
+            self.rpc_tracer = None
+        # runs are profiled when profile is set here or as a parameter
+        self.profile = config.get('profile', '').lower() in ('true', 'yes', '1')
+        self.profile_admins = {i.strip() for i in config.get('profile-admins', '').split(',') if i.strip()}
         logging.basicConfig(format='%(created)s %(levelname)s: %(message)s',
                             level=logging.INFO)
+        # wrapped here rather than with decorators, which kb-sdk would drop when it regenerates this file
+        for method in LOGGED_METHODS:
+            setattr(self, method, self._logged(getattr(self, method)))
         #END_CONSTRUCTOR
         pass
 
@@ -76,6 +146,27 @@ class kb_DRAM:
         # ctx is the context object
         # return variables are: output
         #BEGIN run_kb_dram_annotate
+        import yaml
+
+        from mag_annotator import __version__ as dram_version
+        from mag_annotator.database_handler import import_config, set_database_paths, print_database_locations
+        from mag_annotator.summarize_genomes import summarize_genomes
+        from mag_annotator.utils import remove_suffix
+
+        from installed_clients.WorkspaceClient import Workspace as workspaceService
+        from installed_clients.AssemblyUtilClient import AssemblyUtil
+        from installed_clients.GenomeFileUtilClient import GenomeFileUtil
+        from installed_clients.cb_annotation_ontology_apiClient import cb_annotation_ontology_api
+
+        from .utils.dram_util import get_annotation_files, get_distill_files, generate_genomes, add_ontology_terms, \
+            write_metagenome_gff, write_genome_gffs, GENOME_COLUMNS, ONTOLOGY_COLUMNS, ONTOLOGY_PATTERNS, \
+            streamed_metabolism_summary, dram_method_version
+        from .utils.cache_util import RunArtifacts, run_distill
+        from .utils.shard_util import annotate_bins_sharded
+        from .utils.heatmap_util import write_product_heatmap, get_genome_groups, PRODUCT_HEATMAP_GENOMES
+        from .utils.kbase_util import generate_product_report, save_genomes, save_genomes_from_gff, get_assembly_refs, \
+            AssemblyDownloads, submit_ontology_events, get_saved_refs, write_genome_statuses, get_input_sizes
+
         # validate inputs
         if not isinstance(params['assembly_input_ref'], str) or not len(params['assembly_input_ref']):
             raise ValueError('Pass in a valid assembly reference string')
@@ -87,6 +178,7 @@ class kb_DRAM:
             raise ValueError('Pass in a valid genomeSet description')
         if not isinstance(params['min_contig_size'], int) or (params['min_contig_size'] < 0):
             raise ValueError('Min contig size must be a non-negative integer')
+        annotation_shards = self._annotation_shards(params)
 
         # setup params
         with open("/kb/module/kbase.yml", 'r') as stream:
@@ -98,28 +190,34 @@ class kb_DRAM:
         trans_table = str(params['trans_table'])
         bitscore = params['bitscore']
         rbh_bitscore = params['rbh_bitscore']
-        output_dir = os.path.join(self.shared_folder, 'DRAM_annos')
-        count = 0
-        while os.path.exists(output_dir):
-           count += 1
-           output_dir = os.path.join(self.shared_folder, 'DRAM_annos' + f'_{count}')
+        # a failed run given a job_key is resumed from its first incomplete stage by rerunning with the same key
+        scratch = JobScratch(self.shared_folder, 'DRAM_annotate', self.scratch_budget, params.get('job_key'))
+        manifest = StageManifest(scratch.path('stage_manifest.json'), params)
+        profiler = self._start_profiler(ctx, params, scratch, 'run_kb_dram_annotate')
+        output_dir = scratch.path('DRAM_annos')
 
         output_objects = []
+        report_message = None
 
         # create Util objects
         wsClient = workspaceService(self.workspaceURL, token=ctx['token'])
         assembly_util = AssemblyUtil(self.callback_url)
         genome_util = GenomeFileUtil(self.callback_url)
 
+        # get files, downloads run in the background while the databases are set up
+        downloads = AssemblyDownloads(assembly_util, get_assembly_refs(wsClient, params['assembly_input_ref']))
+        # the sizes stages are checked against the scratch budget with before they run
+        input_sizes = get_input_sizes(wsClient, params['assembly_input_ref']) if scratch.budget is not None else None
+
         # set DRAM database locations
         print('DRAM version: %s' % dram_version)
         import_config('/data/DRAM_databases/CONFIG')
         # This is a hack to get around a bug in my database setup
         set_database_paths(description_db_loc='/data/DRAM_databases/description_db.sqlite')
         print_database_locations()
+        method_version = dram_method_version(version)
 
-        # get files
-        assemblies = assembly_util.get_fastas({'ref_lst': [params['assembly_input_ref']]})
+        assemblies = downloads.result()
         # would paths ever have more than one thing?
         fasta_locs = [assembly_data['paths'][0] for assembly_ref, assembly_data in assemblies.items()]
         # get assembly refs from dram assigned genome names
@@ -127,41 +225,120 @@ class kb_DRAM:
                              assembly_ref for assembly_ref, assembly_data in assemblies.items()}
 
         # annotate and distill with DRAM
-        annotate_bins(fasta_locs, output_dir, min_contig_size, trans_table=trans_table, bit_score_threshold=bitscore,
-                      rbh_bit_score_threshold=rbh_bitscore, low_mem_mode=True, rename_bins=False, keep_tmp_dir=False,
-                      threads=THREADS, verbose=False)
-        output_files = get_annotation_files(output_dir)
+        if not manifest.done('annotation'):
+            # anything an interrupted attempt left behind
+            scratch.release(output_dir, '%s_shards' % output_dir)
+            self._check_projected_scratch(scratch, 'annotation', input_sizes)
+            annotate_bins_sharded(fasta_locs, output_dir, shards=annotation_shards, threads=THREADS,
+                                  min_contig_size=min_contig_size, trans_table=trans_table,
+                                  bit_score_threshold=bitscore, rbh_bit_score_threshold=rbh_bitscore,
+                                  low_mem_mode=True, rename_bins=False, keep_tmp_dir=False, verbose=False)
+            scratch.checkpoint('annotation')
+            manifest.complete('annotation', output_dir=output_dir)
+        artifacts = RunArtifacts(scratch.root)
+        annotations_loc = os.path.join(output_dir, 'annotations.tsv')
+        chunked = os.path.getsize(annotations_loc) > CHUNKED_ANNOTATIONS_SIZE
+        if is_metagenome or chunked:
+            # metagenomes can have millions of genes so their annotations are only streamed from disk
+            output_files = get_annotation_files(output_dir, annotations=artifacts.get_genome_annotations(
+                annotations_loc, chunked=True, split_genomes=True))
+        else:
+            output_files = get_annotation_files(output_dir, annotations=artifacts.get_annotations(annotations_loc))
         distill_output_dir = os.path.join(output_dir, 'distilled')
-        summarize_genomes(output_files['annotations']['path'], output_files['trnas']['path'],
-                          output_files['rrnas']['path'], output_dir=distill_output_dir, groupby_column='fasta')
+        if not manifest.done('distillation'):
+            scratch.release(distill_output_dir)
+            self._check_projected_scratch(scratch, 'distillation', input_sizes)
+            with streamed_metabolism_summary(summarize_genomes, METABOLISM_SHEET_FORMATS):
+                run_distill(self.distill_cache, summarize_genomes,
+                            [output_files['annotations']['path'], output_files['trnas']['path'],
+                             output_files['rrnas']['path']], distill_output_dir, groupby_column='fasta',
+                            genomes_per_product=PRODUCT_HEATMAP_GENOMES)
+            write_product_heatmap(distill_output_dir, get_genome_groups(output_files['annotations']['path']),
+                                  output_dir)
+            scratch.checkpoint('distillation')
+            manifest.complete('distillation', distill_output_dir=distill_output_dir)
         output_files = get_distill_files(distill_output_dir, output_files)
 
+        if len(params['output_name']):
+            output_name = params['output_name']
+        else:
+            output_name = params['assembly_input_ref'] + "_DRAM"
+
         if is_metagenome:
-            pass
+            # stream annotations into a gff and let GenomeFileUtil build the metagenome from files
+            if not manifest.done('metagenome_save'):
+                metagenome_gff = os.path.join(output_dir, 'metagenome.gff')
+                self._check_projected_scratch(scratch, 'metagenome_save', input_sizes)
+                write_metagenome_gff(output_files['genes_gff']['path'], output_files['annotations']['path'],
+                                     metagenome_gff)
+                metagenome_ref = genome_util.fasta_gff_to_metagenome({
+                    'fasta_file': {'path': os.path.join(output_dir, 'scaffolds.fna')},
+                    'gff_file': {'path': metagenome_gff},
+                    'genome_name': output_name,
+                    'workspace_name': params['workspace_name'],
+                    'source': 'DRAM annotation pipeline',
+                    'generate_missing_genes': 1
+                })['metagenome_ref']
+                scratch.checkpoint('metagenome_save')
+                scratch.release(metagenome_gff)
+                manifest.complete('metagenome_save', metagenome_ref=metagenome_ref)
+            metagenome_ref = manifest.outputs('metagenome_save')['metagenome_ref']
+            output_objects.append({"ref": metagenome_ref,
+                                   "description": params['desc']})
         else: # TODO add put this in a function
             # generate genome files
-            annotations = pd.read_csv(output_files['annotations']['path'], sep='\t', index_col=0)
-            genome_objects = generate_genomes(annotations, output_files['genes_fna']['path'],
-                                              output_files['genes_faa']['path'], assembly_ref_dict, assemblies,
-                                              params["workspace_name"], ctx.provenance())
-            if len(genome_objects) == 1:
-                pass #TODO, just return a kbase genome
-            genome_ref_dict = dict()
+            if params.get('gff_genome_import'):
+                # write a gff per genome and let GenomeFileUtil build the genomes from files
+                # anything an interrupted attempt left behind
+                scratch.release(scratch.path('genome_gffs'))
+                genome_gff_dir = scratch.mkdir('genome_gffs')
+                self._check_projected_scratch(scratch, 'genome_gff_import', input_sizes)
+                gff_locs = write_genome_gffs(output_files['genes_gff']['path'], output_files['annotations']['path'],
+                                             genome_gff_dir)
+                save_statuses = save_genomes_from_gff(genome_util, gff_locs, assembly_ref_dict, assemblies,
+                                                      params["workspace_name"], saved=manifest.saved,
+                                                      on_saved=manifest.record_saved)
+                scratch.checkpoint('genome_gff_import')
+                scratch.release(genome_gff_dir)
+            else:
+                self._check_projected_scratch(scratch, 'genome_building', input_sizes)
+                genome_annotations = artifacts.get_genome_annotations(annotations_loc, GENOME_COLUMNS,
+                                                                      chunked=chunked)
+                genome_objects = generate_genomes(genome_annotations, output_files['genes_fna']['path'],
+                                                  output_files['genes_faa']['path'], assembly_ref_dict, assemblies,
+                                                  params["workspace_name"], ctx.provenance(), processes=THREADS,
+                                                  index_dir=scratch.root if chunked else None,
+                                                  skip_genomes=manifest.saved)
+                save_statuses = save_genomes(genome_util, genome_objects, saved=manifest.saved,
+                                             on_saved=manifest.record_saved)
+                scratch.checkpoint('genome_building')
+            # genomes that could not be saved are reported and left out of the later stages
+            genome_ref_dict = get_saved_refs(save_statuses)
+            failed_genomes = set(save_statuses) - set(genome_ref_dict)
             genome_set_elements = dict()
-            for genome_object in genome_objects:
-                info = genome_util.save_one_genome(genome_object)["info"]
-                genome_ref = '%s/%s/%s' % (info[6], info[0], info[4])
-                genome_set_elements[genome_object["name"]] = {'ref': genome_ref}
+            for genome_name, genome_ref in genome_ref_dict.items():
+                genome_set_elements[genome_name] = {'ref': genome_ref}
                 output_objects.append({"ref": genome_ref,
                                        "description": 'Annotated Genome'})
-                genome_ref_dict[genome_object["name"]] = genome_ref
 
             # add ontology terms
             anno_api = cb_annotation_ontology_api(self.callback_url)
             
-            ontology_events = add_ontology_terms(annotations, params['desc'], version, params['workspace_name'],
-                                                 self.workspaceURL, genome_ref_dict)
-            [anno_api.add_annotation_ontology_events(i) for i in ontology_events]
+            genome_annotations = artifacts.get_genome_annotations(annotations_loc, ONTOLOGY_COLUMNS, ONTOLOGY_PATTERNS,
+                                                                  chunked=chunked)
+            ontology_events = add_ontology_terms(genome_annotations, params['desc'], method_version,
+                                                 params['workspace_name'], self.workspaceURL, genome_ref_dict,
+                                                 skip_genomes=failed_genomes)
+            _, chunk_counts = submit_ontology_events(anno_api, ontology_events, submitted=manifest.ontology_events,
+                                                     on_submitted=manifest.record_ontology_event)
+            scratch.checkpoint('ontology')
+            genome_status_loc = os.path.join(output_dir, 'genome_status.tsv')
+            report_message = write_genome_statuses(save_statuses, chunk_counts, genome_status_loc)
+            output_files['genome_status'] = {'path': genome_status_loc,
+                                             'name': 'genome_status.tsv',
+                                             'label': 'genome_status.tsv',
+                                             'description': 'Save status, attempts and ontology event chunks of '
+                                                            'each genome'}
 
             # make genome set
             # TODO: only make genome set if there is more than one genome
@@ -175,26 +352,27 @@ class kb_DRAM:
             provenance[0]['method'] = 'KButil_Batch_Create_GenomeSet'
             output_genomeSet_obj = {'description': params['desc'],
                                     'elements': genome_set_elements}
-            if len(params['output_name']):
-                output_genomeSet_name = params['output_name']
-            else:
-                output_genomeSet_name = params['assembly_input_ref'] + "_DRAM"
-            new_obj_info = wsClient.save_objects({'workspace': params['workspace_name'],
-                                                  'objects': [{'type': 'KBaseSearch.GenomeSet',
-                                                               'data': output_genomeSet_obj,
-                                                               'name': output_genomeSet_name,
-                                                               'meta': {},
-                                                               'provenance': provenance
-                                                               }]
-                                                  })[0]
-            genome_set_ref = '%s/%s/%s' % (new_obj_info[6], new_obj_info[0], new_obj_info[4])
+            if not manifest.done('genome_set'):
+                new_obj_info = wsClient.save_objects({'workspace': params['workspace_name'],
+                                                      'objects': [{'type': 'KBaseSearch.GenomeSet',
+                                                                   'data': output_genomeSet_obj,
+                                                                   'name': output_name,
+                                                                   'meta': {},
+                                                                   'provenance': provenance
+                                                                   }]
+                                                      })[0]
+                manifest.complete('genome_set', genome_set_ref='%s/%s/%s' % (new_obj_info[6], new_obj_info[0],
+                                                                             new_obj_info[4]))
+            genome_set_ref = manifest.outputs('genome_set')['genome_set_ref']
             output_objects.append({"ref": genome_set_ref,
                                    "description": params['desc']})
 
         # generate report
+        self._stop_profiler(ctx, profiler, output_files)
         product_html_loc = os.path.join(distill_output_dir, 'product.html')
         report = generate_product_report(self.callback_url, params['workspace_name'], output_dir, product_html_loc,
-                                         output_files, output_objects)
+                                         output_files, output_objects, report_message)
+        scratch.cleanup()
         output = {
             'report_name': report['name'],
             'report_ref': report['ref'],
@@ -217,6 +395,24 @@ class kb_DRAM:
         # ctx is the context object
         # return variables are: output
         #BEGIN run_kb_dram_annotate_genome
+        import yaml
+
+        from mag_annotator import __version__ as dram_version
+        from mag_annotator.database_handler import import_config, set_database_paths, print_database_locations
+        from mag_annotator.annotate_bins import annotate_called_genes
+        from mag_annotator.summarize_genomes import summarize_genomes
+
+        from installed_clients.WorkspaceClient import Workspace as workspaceService
+        from installed_clients.cb_annotation_ontology_apiClient import cb_annotation_ontology_api
+        from installed_clients.KBaseDataObjectToFileUtilsClient import KBaseDataObjectToFileUtils
+
+        from .utils.dram_util import get_annotation_files, get_distill_files, add_ontology_terms, ONTOLOGY_COLUMNS, \
+            ONTOLOGY_PATTERNS, get_dram_events, annotations_from_ontology_events, write_set_annotations, \
+            streamed_metabolism_summary, dram_method_version
+        from .utils.cache_util import RunArtifacts, run_distill
+        from .utils.heatmap_util import write_product_heatmap, get_genome_groups, PRODUCT_HEATMAP_GENOMES
+        from .utils.kbase_util import generate_product_report, submit_ontology_events
+
         if not isinstance(params['genome_input_ref'], str) or not len(params['genome_input_ref']):
             raise ValueError('Pass in a valid genome reference string')
 
@@ -238,10 +434,12 @@ class kb_DRAM:
         # This is a hack to get around a bug in my database setup
         set_database_paths(description_db_loc='/data/DRAM_databases/description_db.sqlite')
         print_database_locations()
+        method_version = dram_method_version(version)
 
         # get genomes
-        genome_dir = os.path.join(self.shared_folder, 'genomes')
-        os.mkdir(genome_dir)
+        scratch = JobScratch(self.shared_folder, 'DRAM_annotate_genome', self.scratch_budget)
+        profiler = self._start_profiler(ctx, params, scratch, 'run_kb_dram_annotate_genome')
+        genome_dir = scratch.mkdir('genomes')
         genome_info = wsClient.get_object_info_new({'objects': [{'ref': genome_input_ref}]})[0]
         genome_input_type = genome_info[2]
         faa_locs = list()
@@ -254,7 +452,20 @@ class kb_DRAM:
                 genome_ref_dict[name] = genome_ref
         else:
             genome_ref_dict[genome_info[1]] = genome_input_ref
+        # genomes that already carry KO and EC events from this module version, DRAM version and databases are not
+        # annotated again, their earlier terms still go into the distillate
+        anno_api = cb_annotation_ontology_api(self.callback_url)
+        prior_annotations = dict()
+        for genome_name, genome_ref in genome_ref_dict.items():
+            dram_events = get_dram_events(anno_api.get_annotation_ontology_events({'input_ref': genome_ref})['events'],
+                                          method_version)
+            if dram_events is not None:
+                prior_annotations[genome_name] = annotations_from_ontology_events(genome_name, dram_events)
+        print('Skipping %s of %s genome(s) already annotated as %s'
+              % (len(prior_annotations), len(genome_ref_dict), method_version))
         for genome_name, genome_ref in genome_ref_dict.items():
+            if genome_name in prior_annotations:
+                continue
             # this makes the names match if you are doing a genome or genomeSet
             faa_file = '%s.faa' % genome_name
             faa_object = object_to_file_utils.GenomeToFASTA({
@@ -273,26 +484,64 @@ class kb_DRAM:
             faa_locs.append(faa_object['fasta_file_path'])
 
         # annotate and distill with DRAM
-        output_dir = os.path.join(self.shared_folder, 'DRAM_annos')
-        annotate_called_genes(faa_locs, output_dir, bit_score_threshold=bitscore, rbh_bit_score_threshold=rbh_bitscore,
-                              low_mem_mode=True, rename_genes=False, keep_tmp_dir=False, threads=THREADS, verbose=False)
-        output_files = get_annotation_files(output_dir)
+        output_dir = scratch.path('DRAM_annos')
+        artifacts = RunArtifacts(scratch.root)
+        # the scratch budget is checked before each stage against the size of the proteins DRAM annotates
+        input_sizes = [{'name': os.path.basename(i), 'bases': os.path.getsize(i)} for i in faa_locs]
+        if len(faa_locs) > 0:
+            self._check_projected_scratch(scratch, 'annotation', input_sizes)
+            annotate_called_genes(faa_locs, output_dir, bit_score_threshold=bitscore,
+                                  rbh_bit_score_threshold=rbh_bitscore, low_mem_mode=True, rename_genes=False,
+                                  keep_tmp_dir=False, threads=THREADS, verbose=False)
+            scratch.checkpoint('annotation')
+            scratch.release(genome_dir)
+            annotations_loc = os.path.join(output_dir, 'annotations.tsv')
+            chunked = os.path.getsize(annotations_loc) > CHUNKED_ANNOTATIONS_SIZE
+            if chunked:
+                output_files = get_annotation_files(output_dir, annotations=artifacts.get_genome_annotations(
+                    annotations_loc, chunked=True, split_genomes=True))
+            else:
+                output_files = get_annotation_files(output_dir, annotations=artifacts.get_annotations(annotations_loc))
+            distill_annotations_loc = output_files['annotations']['path']
+            trnas_loc = output_files['trnas']['path']
+            rrnas_loc = output_files['rrnas']['path']
+        else:
+            os.mkdir(output_dir)
+            annotations_loc = None
+            output_files = dict()
+            distill_annotations_loc = trnas_loc = rrnas_loc = None
+        if len(prior_annotations) > 0:
+            distill_annotations_loc = write_set_annotations(
+                annotations_loc, prior_annotations.values(), os.path.join(output_dir, 'genome_set_annotations.tsv'))
+            output_files['set_annotations'] = {'path': distill_annotations_loc,
+                                               'name': 'genome_set_annotations.tsv',
+                                               'label': 'genome_set_annotations.tsv',
+                                               'description': 'DRAM annotations of this run with the terms of '
+                                                              'genomes annotated by earlier runs'}
         distill_output_dir = os.path.join(output_dir, 'distilled')
-        summarize_genomes(output_files['annotations']['path'], output_files['trnas']['path'],
-                          output_files['rrnas']['path'], output_dir=distill_output_dir, groupby_column='fasta')
+        self._check_projected_scratch(scratch, 'distillation', input_sizes)
+        with streamed_metabolism_summary(summarize_genomes, METABOLISM_SHEET_FORMATS):
+            run_distill(self.distill_cache, summarize_genomes, [distill_annotations_loc, trnas_loc, rrnas_loc],
+                        distill_output_dir, groupby_column='fasta', genomes_per_product=PRODUCT_HEATMAP_GENOMES)
+        write_product_heatmap(distill_output_dir, get_genome_groups(distill_annotations_loc), output_dir)
         output_files = get_distill_files(distill_output_dir, output_files)
+        scratch.checkpoint('distillation')
 
         # add ontology terms
-        annotations = pd.read_csv(output_files['annotations']['path'], sep='\t', index_col=0, dtype={'fasta': str})
-        anno_api = cb_annotation_ontology_api(self.callback_url)
-        ontology_events = add_ontology_terms(annotations, "DRAM genome annotated", version, params['workspace_name'],
-                                             self.workspaceURL, genome_ref_dict)
-        annotation_events = [anno_api.add_annotation_ontology_events(i) for i in ontology_events]
+        if annotations_loc is not None:
+            genome_annotations = artifacts.get_genome_annotations(annotations_loc, ONTOLOGY_COLUMNS,
+                                                                  ONTOLOGY_PATTERNS, chunked=chunked)
+            ontology_events = add_ontology_terms(genome_annotations, "DRAM genome annotated", method_version,
+                                                 params['workspace_name'], self.workspaceURL, genome_ref_dict)
+            submit_ontology_events(anno_api, ontology_events)
+            scratch.checkpoint('ontology')
 
         # generate report
+        self._stop_profiler(ctx, profiler, output_files)
         product_html_loc = os.path.join(distill_output_dir, 'product.html')
         report = generate_product_report(self.callback_url, params['workspace_name'], output_dir, product_html_loc,
                                          output_files)
+        scratch.cleanup()
         output = {
             'report_name': report['name'],
             'report_ref': report['ref'],
@@ -315,6 +564,18 @@ class kb_DRAM:
         # ctx is the context object
         # return variables are: output
         #BEGIN run_kb_dramv_annotate
+        from mag_annotator import __version__ as dram_version
+        from mag_annotator.database_handler import import_config, set_database_paths, print_database_locations
+        from mag_annotator.annotate_vgfs import annotate_vgfs, remove_bad_chars
+        from mag_annotator.summarize_vgfs import summarize_vgfs
+
+        from installed_clients.AssemblyUtilClient import AssemblyUtil
+        from installed_clients.DataFileUtilClient import DataFileUtil
+
+        from .utils.dram_util import get_annotation_files, get_viral_distill_files
+        from .utils.cache_util import run_distill
+        from .utils.kbase_util import generate_product_report
+
         # validate inputs
         if not isinstance(params['assembly_input_ref'], str) or not len(params['assembly_input_ref']):
             raise ValueError('Pass in a valid assembly reference string')
@@ -335,10 +596,12 @@ class kb_DRAM:
 
         assembly_util = AssemblyUtil(self.callback_url)
         datafile_util = DataFileUtil(self.callback_url)
+        scratch = JobScratch(self.shared_folder, 'DRAMv_annotate', self.scratch_budget)
+        profiler = self._start_profiler(ctx, params, scratch, 'run_kb_dramv_annotate')
 
         # get contigs and merge
         assemblies = assembly_util.get_fastas({'ref_lst': [params['assembly_input_ref']]})
-        fasta = os.path.join(self.shared_folder, 'merged_contigs.fasta')
+        fasta = scratch.path('merged_contigs.fasta')
         with open(fasta, 'w') as f:
             for assembly_ref, assembly_data in assemblies.items():
                 fasta_path = assembly_data['paths'][0]
@@ -346,10 +609,10 @@ class kb_DRAM:
                     f.write(line)
 
         # get affi contigs, read all and merge
-        affi_contigs_path = os.path.join(self.shared_folder, 'VIRSorter_affi-contigs.tab')
+        affi_contigs_path = scratch.path('VIRSorter_affi-contigs.tab')
         with open(affi_contigs_path, 'w') as f:
             for affi_contigs_shock_id in affi_contigs_shock_ids:
-                temp_affi_contigs_path = os.path.join(self.shared_folder, 'temp_VIRSorter_affi-contigs.tab')
+                temp_affi_contigs_path = scratch.path('temp_VIRSorter_affi-contigs.tab')
                 temp_affi_contigs = datafile_util.shock_to_file({
                     'shock_id': affi_contigs_shock_id,
                     'file_path': temp_affi_contigs_path,
@@ -367,25 +630,35 @@ class kb_DRAM:
         print_database_locations()
 
         # clean affi contigs file
-        cleaned_fasta = os.path.join(self.shared_folder, '%s.cleaned.fasta' % os.path.basename(fasta))
+        cleaned_fasta = scratch.path('%s.cleaned.fasta' % os.path.basename(fasta))
         remove_bad_chars(input_fasta=fasta, output=cleaned_fasta)
-        cleaned_affi_contigs = os.path.join(self.shared_folder, 'VIRSorter_affi-contigs.cleaned.tab')
+        cleaned_affi_contigs = scratch.path('VIRSorter_affi-contigs.cleaned.tab')
         remove_bad_chars(input_virsorter_affi_contigs=affi_contigs_path, output=cleaned_affi_contigs)
+        scratch.release(fasta, affi_contigs_path)
 
         # annotate and distill
-        output_dir = os.path.join(self.shared_folder, 'DRAM_annos')
+        output_dir = scratch.path('DRAM_annos')
+        input_sizes = [{'name': os.path.basename(cleaned_fasta), 'bases': os.path.getsize(cleaned_fasta)}]
+        self._check_projected_scratch(scratch, 'annotation', input_sizes)
         annotate_vgfs(cleaned_fasta, cleaned_affi_contigs, output_dir, min_contig_size, trans_table=trans_table,
                       bit_score_threshold=bitscore, rbh_bit_score_threshold=rbh_bitscore, low_mem_mode=True,
                       keep_tmp_dir=False, threads=THREADS, verbose=False)
+        scratch.checkpoint('annotation')
+        scratch.release(cleaned_fasta, cleaned_affi_contigs)
         output_files = get_annotation_files(output_dir)
         distill_output_dir = os.path.join(output_dir, 'distilled')
-        summarize_vgfs(output_files['annotations']['path'], distill_output_dir, groupby_column='scaffold')
+        self._check_projected_scratch(scratch, 'distillation', input_sizes)
+        run_distill(self.distill_cache, summarize_vgfs, [output_files['annotations']['path']], distill_output_dir,
+                    groupby_column='scaffold')
         output_files = get_viral_distill_files(distill_output_dir, output_files)
+        scratch.checkpoint('distillation')
 
         # generate report
+        self._stop_profiler(ctx, profiler, output_files)
         product_html_loc = os.path.join(distill_output_dir, 'product.html')
         report = generate_product_report(self.callback_url, params['workspace_name'], output_dir,
                                          product_html_loc, output_files)
+        scratch.cleanup()
         output = {
             'report_name': report['name'],
             'report_ref': report['ref'],
@@ -398,6 +671,148 @@ class kb_DRAM:
                              'output is not type dict as required.')
         # return the results
         return [output]
+
+    def run_kb_dram_distill(self, ctx, params):
+        """
+        Distills the annotations of an earlier DRAM or DRAM-v run without annotating again. Takes
+        annotations_shock_id or annotations_handle_id, or the report_ref of the earlier run, with optional trnas and
+        rrnas ids in the same form, and viral to distill DRAM-v annotations.
+        :param params: instance of mapping from String to unspecified object
+        :returns: instance of type "ReportResults" -> structure: parameter
+           "report_name" of String, parameter "report_ref" of String
+        """
+        # ctx is the context object
+        # return variables are: output
+        #BEGIN run_kb_dram_distill
+        from mag_annotator import __version__ as dram_version
+        from mag_annotator.database_handler import import_config, set_database_paths, print_database_locations
+        from mag_annotator.summarize_genomes import summarize_genomes
+        from mag_annotator.summarize_vgfs import summarize_vgfs
+
+        from installed_clients.WorkspaceClient import Workspace as workspaceService
+        from installed_clients.DataFileUtilClient import DataFileUtil
+
+        from .utils.dram_util import get_distill_files, get_viral_distill_files, streamed_metabolism_summary
+        from .utils.cache_util import run_distill
+        from .utils.heatmap_util import write_product_heatmap, get_genome_groups, PRODUCT_HEATMAP_GENOMES
+        from .utils.kbase_util import generate_product_report, get_distill_inputs
+
+        # validate inputs
+        if not isinstance(params.get('workspace_name'), str) or not len(params['workspace_name']):
+            raise ValueError('Pass in a valid workspace name')
+        viral = params.get('viral', False)
+        if not isinstance(viral, (bool, int)):
+            raise ValueError('viral must be a boolean')
+
+        # setup
+        wsClient = workspaceService(self.workspaceURL, token=ctx['token'])
+        datafile_util = DataFileUtil(self.callback_url)
+        scratch = JobScratch(self.shared_folder, 'DRAM_distill', self.scratch_budget)
+        profiler = self._start_profiler(ctx, params, scratch, 'run_kb_dram_distill')
+        output_dir = scratch.mkdir('DRAM_distill')
+
+        # get annotations, kept out of output_dir so they are not packed into the report again
+        input_locs = get_distill_inputs(wsClient, datafile_util, params, scratch.mkdir('inputs'))
+
+        # set DRAM database locations
+        print('DRAM version: %s' % dram_version)
+        import_config('/data/DRAM_databases/CONFIG')
+        # This is a hack to get around a bug in my database setup
+        set_database_paths(description_db_loc='/data/DRAM_databases/description_db.sqlite')
+        print_database_locations()
+
+        # distill
+        distill_output_dir = os.path.join(output_dir, 'distilled')
+        if viral:
+            run_distill(self.distill_cache, summarize_vgfs, [input_locs['annotations']], distill_output_dir,
+                        groupby_column='scaffold')
+            output_files = get_viral_distill_files(distill_output_dir)
+        else:
+            with streamed_metabolism_summary(summarize_genomes, METABOLISM_SHEET_FORMATS):
+                run_distill(self.distill_cache, summarize_genomes,
+                            [input_locs['annotations'], input_locs['trnas'], input_locs['rrnas']],
+                            distill_output_dir, groupby_column='fasta', genomes_per_product=PRODUCT_HEATMAP_GENOMES)
+            write_product_heatmap(distill_output_dir, get_genome_groups(input_locs['annotations']), output_dir)
+            output_files = get_distill_files(distill_output_dir)
+        scratch.checkpoint('distillation')
+
+        # generate report
+        self._stop_profiler(ctx, profiler, output_files)
+        product_html_loc = os.path.join(distill_output_dir, 'product.html')
+        report = generate_product_report(self.callback_url, params['workspace_name'], output_dir,
+                                         product_html_loc, output_files)
+        scratch.cleanup()
+        output = {
+            'report_name': report['name'],
+            'report_ref': report['ref'],
+        }
+        #END run_kb_dram_distill
+
+        # At some point might do deeper type checking...
+        if not isinstance(output, dict):
+            raise ValueError('Method run_kb_dram_distill return value ' +
+                             'output is not type dict as required.')
+        # return the results
+        return [output]
+
+    def estimate_kb_dram_resources(self, ctx, params):
+        """
+        Predicts the genes, peak memory, scratch and wall time of an annotation run from the input metadata,
+        without running DRAM. Takes assembly_input_ref or genome_input_ref as the run would, and is_metagenome or
+        gff_genome_import for assemblies. Stages with no recorded timings have calibrated 0, are left out of the
+        totals and are listed in uncalibrated_stages.
+        :param params: instance of mapping from String to unspecified object
+        :returns: instance of type "ResourceEstimate" -> structure: parameter
+           "input_count" of Long, parameter "input_bases" of Long, parameter
+           "predicted_genes" of Long, parameter "wall_seconds" of Long,
+           parameter "peak_memory_bytes" of Long, parameter "scratch_bytes"
+           of Long, parameter "uncalibrated_stages" of list of String,
+           parameter "stages" of list of type "StageEstimate" -> structure:
+           parameter "stage" of String, parameter "wall_seconds" of Long,
+           parameter "peak_memory_bytes" of Long, parameter "scratch_bytes"
+           of Long, parameter "calibrated" of Long
+        """
+        # ctx is the context object
+        # return variables are: output
+        #BEGIN estimate_kb_dram_resources
+        from installed_clients.WorkspaceClient import Workspace as workspaceService
+
+        from .utils.kbase_util import get_input_sizes
+        from .utils.estimate_util import load_stage_model, predict_resources, ANNOTATE_STAGES, ANNOTATE_GFF_STAGES, \
+            ANNOTATE_METAGENOME_STAGES, ANNOTATE_GENOME_STAGES
+
+        wsClient = workspaceService(self.workspaceURL, token=ctx['token'])
+        if isinstance(params.get('genome_input_ref'), str) and len(params['genome_input_ref']):
+            input_sizes = get_input_sizes(wsClient, params['genome_input_ref'])
+            stages = ANNOTATE_GENOME_STAGES
+            annotation_shards = 1
+        elif isinstance(params.get('assembly_input_ref'), str) and len(params['assembly_input_ref']):
+            input_sizes = get_input_sizes(wsClient, params['assembly_input_ref'])
+            if params.get('is_metagenome'):
+                stages = ANNOTATE_METAGENOME_STAGES
+            elif params.get('gff_genome_import'):
+                stages = ANNOTATE_GFF_STAGES
+            else:
+                stages = ANNOTATE_STAGES
+            # more than one input is annotated in shards that have to be merged
+            annotation_shards = min(self._annotation_shards(params), len(input_sizes))
+            if annotation_shards > 1:
+                stages = stages[:1] + ('shard_merge',) + stages[1:]
+        else:
+            raise ValueError('Pass in a valid assembly or genome reference string')
+        output = predict_resources(input_sizes, stages, load_stage_model(STAGE_TIMINGS_LOC),
+                                   annotation_shards=annotation_shards)
+        if len(output['uncalibrated_stages']) > 0:
+            logging.warning('There are no recorded timings of %s, the totals leave them out'
+                            % ', '.join(output['uncalibrated_stages']))
+        #END estimate_kb_dram_resources
+
+        # At some point might do deeper type checking...
+        if not isinstance(output, dict):
+            raise ValueError('Method estimate_kb_dram_resources return value ' +
+                             'output is not type dict as required.')
+        # return the results
+        return [output]
     def status(self, ctx):
         #BEGIN_STATUS
         returnVal = {'state': "OK",
@@ -405,5 +820,8 @@ class kb_DRAM:
                      'version': self.VERSION,
                      'git_url': self.GIT_URL,
                      'git_commit_hash': self.GIT_COMMIT_HASH}
+        # per method call counts, latency and payload histograms since the last run finished
+        if self.rpc_tracer is not None:
+            returnVal['rpc_summary'] = self.rpc_tracer.summary()
         #END_STATUS
         return [returnVal]
@@ -0,0 +1,123 @@
+import os
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+
+from .scratch_util import path_bytes
+
+HASH_BLOCK_SIZE = 1024 ** 2
+# pandas, DRAM and dram_util are imported where they are used, the Impl builds a DistillCache at server start
+
+
+class RunArtifacts:
+    # per run cache of parsed DRAM outputs so each file is parsed once and the frame is shared between stages
+    def __init__(self, scratch_dir=None):
+        self.scratch_dir = scratch_dir
+        self.frames = dict()
+        self.sorted_locs = dict()
+
+    def get_annotations(self, annotations_loc):
+        from .dram_util import read_annotations
+        key = os.path.abspath(annotations_loc)
+        if key not in self.frames:
+            self.frames[key] = read_annotations(annotations_loc)
+        return self.frames[key]
+
+    def get_genome_annotations(self, annotations_loc, columns=None, patterns=(), chunked=False, split_genomes=False):
+        # the whole cached frame, or for tables too large to hold, one genome at a time from a fasta sorted table
+        from .dram_util import iter_genome_annotations, annotations_sorted_by_fasta, sort_annotations
+        if not chunked:
+            return self.get_annotations(annotations_loc)
+        key = os.path.abspath(annotations_loc)
+        if key not in self.sorted_locs:
+            if annotations_sorted_by_fasta(annotations_loc):
+                self.sorted_locs[key] = annotations_loc
+            else:
+                sort_dir = tempfile.mkdtemp(dir=self.scratch_dir)
+                self.sorted_locs[key] = sort_annotations(annotations_loc, os.path.join(sort_dir, 'annotations.tsv'),
+                                                         sort_dir)
+        return iter_genome_annotations(self.sorted_locs[key], columns, patterns, split_genomes=split_genomes)
+
+
+def _hash_file(file_hash, path):
+    if path is None:
+        file_hash.update(b'None')
+        return
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            file_hash.update(block)
+
+
+class DistillCache:
+    # distill outputs kept between runs, keyed by the content of the distilled files, the DRAM version and the
+    # distill sheets it read, least recently used entries are removed to keep the cache under max_bytes
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, function, input_locs, kwargs):
+        from mag_annotator import __version__ as dram_version
+        from mag_annotator.database_handler import DatabaseHandler
+        key_hash = hashlib.sha256()
+        key_hash.update(('%s.%s %s %s' % (function.__module__, function.__name__, dram_version,
+                                         sorted(kwargs.items()))).encode())
+        for input_loc in input_locs:
+            _hash_file(key_hash, input_loc)
+        dram_sheets = DatabaseHandler(logging.getLogger(__name__)).config['dram_sheets']
+        for name in sorted(dram_sheets):
+            key_hash.update(name.encode())
+            _hash_file(key_hash, dram_sheets[name])
+        return key_hash.hexdigest()
+
+    def restore(self, key, output_dir):
+        entry_dir = os.path.join(self.cache_dir, key)
+        if not os.path.isdir(entry_dir):
+            return False
+        shutil.copytree(entry_dir, output_dir)
+        # mark as recently used
+        os.utime(entry_dir)
+        return True
+
+    def store(self, key, output_dir):
+        entry_dir = os.path.join(self.cache_dir, key)
+        # copy next to the entry then rename so other runs never see a partial entry
+        tmp_dir = tempfile.mkdtemp(prefix='.%s_' % key, dir=self.cache_dir)
+        shutil.copytree(output_dir, os.path.join(tmp_dir, key))
+        try:
+            os.rename(os.path.join(tmp_dir, key), entry_dir)
+        except OSError:
+            pass  # another run stored the same outputs first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        if self.max_bytes is None:
+            return
+        entries = [os.path.join(self.cache_dir, i) for i in os.listdir(self.cache_dir) if not i.startswith('.')]
+        entries = sorted(entries, key=os.path.getmtime)
+        sizes = {i: path_bytes(i) for i in entries}
+        total = sum(sizes.values())
+        for entry_dir in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= sizes[entry_dir]
+            logging.info('Evicted %s bytes of distill outputs from the cache' % sizes[entry_dir])
+
+
+def run_distill(distill_cache, function, input_locs, output_dir, **kwargs):
+    # run a DRAM distill function, or copy out what it wrote before for the same inputs
+    if distill_cache is None:
+        function(*input_locs, output_dir=output_dir, **kwargs)
+        return False
+    start = time.time()
+    key = distill_cache.key(function, input_locs, kwargs)
+    if distill_cache.restore(key, output_dir):
+        logging.info('Distill outputs restored from the cache in %.1f seconds' % (time.time() - start))
+        return True
+    function(*input_locs, output_dir=output_dir, **kwargs)
+    distill_cache.store(key, output_dir)
+    return False
@@ -1,13 +1,226 @@
 import os
+import sys
+import json
+import logging
+import collections
+import itertools
+import multiprocessing
 import tarfile
 import pandas as pd
 import datetime
-from skbio import read as read_sequence
 import hashlib
 import re
+import shutil
+import sqlite3
+import threading
+import importlib.util
+from urllib.parse import quote
+from contextlib import contextmanager
 
+# pyarrow and openpyxl are imported by the functions that use them, most stages need neither
+PYARROW_AVAILABLE = importlib.util.find_spec('pyarrow') is not None
 
-def get_annotation_files(output_dir, output_files=None):
+ANNOTATION_CHUNKSIZE = 100000
+# held while a function of a DRAM module is swapped out, so runs sharing the server process never restore each
+# other's stand in
+_MODULE_PATCH_LOCK = threading.Lock()
+SORT_BUCKETS = 64
+# columns not listed here are read as strings
+ANNOTATION_DTYPES = {'fasta': 'category', 'scaffold': 'category', 'gene_position': 'int32',
+                     'start_position': 'int64', 'end_position': 'int64', 'strandedness': 'int8',
+                     'rank': 'category', 'bin_taxonomy': 'category', 'bin_completeness': 'float64',
+                     'bin_contamination': 'float64'}
+GENOME_COLUMNS = ['scaffold', 'start_position', 'end_position', 'strandedness', 'kegg_hit', 'bin_taxonomy']
+# ontology id, columns and column name patterns it is found in, and the pattern of its terms
+# TODO: be able to capute EC's with - (i.e. EC 3.2.1.-)
+ONTOLOGY_SOURCES = (
+    ('KO', ('ko_id',), (), r'K\d{5}'),
+    ('EC', (), ('_hit',), r'EC[ :]\d+.\d+.\d+.\d+'),
+    ('PFAM', ('pfam_hits',), (), r'PF\d{5}'),
+    ('CAZy', ('cazy_ids', 'cazy_hits'), (), r'\b(?:GH|GT|PL|CE|AA|CBM)\d+(?:_\d+)?\b'),
+    ('MEROPS', ('peptidase_family',), (), r'\b[ACGIMNPSTU]\d{1,3}[A-Z]?\b'),
+)
+ONTOLOGY_COLUMNS = sorted({j for i in ONTOLOGY_SOURCES for j in i[1]})
+ONTOLOGY_PATTERNS = tuple(sorted({j for i in ONTOLOGY_SOURCES for j in i[2]}))
+# ontologies add_ontology_terms writes
+EVENT_ONTOLOGIES = tuple(i[0] for i in ONTOLOGY_SOURCES)
+# a genome with all of these from the same module, DRAM and databases is already annotated
+DRAM_ONTOLOGIES = ('KO', 'EC')
+# the annotation columns distill reads each ontology's terms from, as DRAM formats them, to rebuild annotations from
+# earlier events, events keep no pfam version so the id is followed by an empty one
+PRIOR_ANNOTATION_COLUMNS = {
+    'KO': (('ko_id', lambda terms: ','.join(terms)),),
+    'EC': (('kegg_hit', lambda terms: ' '.join('[%s]' % i for i in terms)),),
+    'PFAM': (('pfam_hits', lambda terms: '; '.join('[%s.]' % i for i in terms)),),
+    'CAZy': (('cazy_ids', lambda terms: '; '.join(terms)), ('cazy_best_hit', lambda terms: terms[0])),
+    'MEROPS': (('peptidase_family', lambda terms: ';'.join(terms)),),
+}
+# a genome's terms are split over several events once its event would be larger than this as json
+ONTOLOGY_EVENT_BYTES = 16 * 1024 ** 2
+# per sheet copies of metabolism_summary.xlsx are written here
+METABOLISM_SHEETS_DIR = 'metabolism_summary'
+
+
+def _annotation_columns(annotations_loc, columns=None, patterns=()):
+    with open(annotations_loc) as f:
+        header = f.readline().rstrip('\n').split('\t')
+    if columns is None and len(patterns) == 0:
+        positions = list(range(len(header)))
+    else:
+        columns = ['fasta'] + list(columns if columns is not None else [])
+        positions = [0] + [i for i, column in enumerate(header)
+                           if i > 0 and (column in columns or any(j in column for j in patterns))]
+    return header, positions
+
+
+def read_annotations(annotations_loc, columns=None, patterns=(), engine='c'):
+    # read only the columns a stage needs with an explicit schema, so numeric looking fasta names stay strings
+    header, positions = _annotation_columns(annotations_loc, columns, patterns)
+    # pyarrow is faster but holds arrow buffers next to the frame while converting
+    if engine == 'pyarrow' and not PYARROW_AVAILABLE:
+        engine = 'c'
+    # pandas names an unnamed index column differently depending on the engine
+    index_name = header[0] if (len(header[0]) or engine == 'pyarrow') else 'Unnamed: 0'
+    dtype = {index_name: str}
+    for i in positions[1:]:
+        dtype[header[i]] = ANNOTATION_DTYPES.get(header[i], str)
+    if engine == 'pyarrow':
+        # read through pyarrow directly, pandas' pyarrow engine infers types before applying dtype so numeric
+        # looking names would still come back as floats
+        import pyarrow
+        from pyarrow import csv as pyarrow_csv
+        string_columns = [column for column, column_type in dtype.items() if column_type in (str, 'category')]
+        convert_options = pyarrow_csv.ConvertOptions(include_columns=[header[i] for i in positions],
+                                                     column_types={i: pyarrow.string() for i in string_columns},
+                                                     strings_can_be_null=True)
+        annotations = pyarrow_csv.read_csv(annotations_loc, parse_options=pyarrow_csv.ParseOptions(delimiter='\t'),
+                                           convert_options=convert_options).to_pandas()
+        annotations = annotations.astype({column: column_type for column, column_type in dtype.items()
+                                          if column_type is not str})
+    else:
+        # the c engine can not select an unnamed column by name
+        annotations = pd.read_csv(annotations_loc, sep='\t', usecols=positions, dtype=dtype)
+    annotations = annotations.set_index(annotations.columns[0])
+    annotations.index.name = None
+    return annotations
+
+
+def iter_genome_annotations(annotations_loc, columns=None, patterns=(), chunksize=ANNOTATION_CHUNKSIZE,
+                            split_genomes=False):
+    # yield the annotations of one genome at a time from a table sorted by fasta, as DRAM writes it, so only a
+    # chunk and the current genome are ever in memory, with split_genomes a genome spanning chunks is yielded in
+    # consecutive parts so only a chunk is, a metagenome is a single genome of millions of genes
+    header, positions = _annotation_columns(annotations_loc, columns, patterns)
+    # categories would differ between chunks so categorical columns are read as plain strings here
+    dtype = dict()
+    for i in positions:
+        column_type = ANNOTATION_DTYPES.get(header[i], str)
+        dtype[header[i] if len(header[i]) else 'Unnamed: %s' % i] = \
+            str if i == 0 or column_type == 'category' else column_type
+    seen = set()
+    current = None
+    for chunk in pd.read_csv(annotations_loc, sep='\t', usecols=positions, dtype=dtype, chunksize=chunksize):
+        chunk = chunk.set_index(chunk.columns[0])
+        chunk.index.name = None
+        for fasta_name, genome_annotations in chunk.groupby('fasta', sort=False):
+            if current is not None and fasta_name == current[0]:
+                if split_genomes:
+                    yield current
+                    current = (fasta_name, genome_annotations)
+                else:
+                    current = (fasta_name, pd.concat([current[1], genome_annotations]))
+                continue
+            if fasta_name in seen:
+                raise ValueError('Annotations are not sorted by fasta, %s appears more than once. Sort them with '
+                                 'sort_annotations before reading them by genome' % fasta_name)
+            if current is not None:
+                yield current
+            seen.add(fasta_name)
+            current = (fasta_name, genome_annotations)
+    if current is not None:
+        yield current
+
+
+def annotations_sorted_by_fasta(annotations_loc, chunksize=ANNOTATION_CHUNKSIZE):
+    seen = set()
+    current = None
+    for chunk in pd.read_csv(annotations_loc, sep='\t', usecols=['fasta'], dtype={'fasta': str},
+                             chunksize=chunksize):
+        for fasta_name in chunk['fasta']:
+            if fasta_name != current:
+                if fasta_name in seen:
+                    return False
+                seen.add(fasta_name)
+                current = fasta_name
+    return True
+
+
+def sort_annotations(annotations_loc, output_loc, tmp_dir, buckets=SORT_BUCKETS):
+    # external sort by genome, each genome's lines go to one of a fixed number of bucket files and each bucket is
+    # then grouped by fasta in memory, so only one bucket is ever held
+    with open(annotations_loc) as f:
+        header = f.readline()
+        fasta_position = header.rstrip('\n').split('\t').index('fasta')
+        bucket_locs = [os.path.join(tmp_dir, 'annotations_bucket_%s.tsv' % i) for i in range(buckets)]
+        bucket_files = [open(bucket_loc, 'w') for bucket_loc in bucket_locs]
+        fasta_buckets = dict()
+        try:
+            for line in f:
+                fasta_name = line.split('\t', fasta_position + 1)[fasta_position]
+                if fasta_name not in fasta_buckets:
+                    fasta_buckets[fasta_name] = bucket_files[len(fasta_buckets) % buckets]
+                fasta_buckets[fasta_name].write(line)
+        finally:
+            for bucket_file in bucket_files:
+                bucket_file.close()
+    with open(output_loc, 'w') as o:
+        o.write(header)
+        for bucket_loc in bucket_locs:
+            genomes = dict()
+            with open(bucket_loc) as f:
+                for line in f:
+                    genomes.setdefault(line.split('\t', fasta_position + 1)[fasta_position], []).append(line)
+            for lines in genomes.values():
+                o.writelines(lines)
+            os.remove(bucket_loc)
+    return output_loc
+
+
+def _group_by_fasta(annotations):
+    # stages take either a whole annotations frame or (fasta, genome annotations) pairs from
+    # iter_genome_annotations
+    if isinstance(annotations, pd.DataFrame):
+        return annotations.groupby('fasta', observed=True)
+    return annotations
+
+
+def write_annotations_parquet(annotations, parquet_loc):
+    # one row group per genome, or per part of a genome from iter_genome_annotations, with page indexes, so one
+    # genome can be read without scanning the rest
+    import pyarrow
+    from pyarrow import parquet as pyarrow_parquet
+    writer = None
+    try:
+        for fasta_name, genome_annotations in _group_by_fasta(annotations):
+            if writer is None:
+                schema = pyarrow.Schema.from_pandas(genome_annotations, preserve_index=True)
+                # categoricals are stored as plain strings, parquet dictionary encodes each row group on its own,
+                # and a column empty in the first genome is taken as text
+                categories = {i.name: object for i in schema if pyarrow.types.is_dictionary(i.type)}
+                schema = pyarrow.schema([pyarrow.field(i.name, i.type.value_type) if i.name in categories else
+                                         pyarrow.field(i.name, pyarrow.string()) if pyarrow.types.is_null(i.type) else
+                                         i for i in schema], metadata=schema.metadata)
+                writer = pyarrow_parquet.ParquetWriter(parquet_loc, schema, compression='zstd',
+                                                       write_page_index=True)
+            table = pyarrow.Table.from_pandas(genome_annotations.astype(categories), schema=schema,
+                                              preserve_index=True)
+            writer.write_table(table, row_group_size=max(len(genome_annotations), 1))
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def get_annotation_files(output_dir, output_files=None, annotations=None):
     if output_files is None:
         output_files = dict()
 
@@ -16,6 +229,15 @@ def get_annotation_files(output_dir, output_files=None):
                                    'name': 'annotations.tsv',
                                    'label': 'annotations.tsv',
                                    'description': 'DRAM annotations in a tab separate table format'}
+    annotations_parquet_loc = os.path.join(output_dir, 'annotations.parquet')
+    if annotations is not None and PYARROW_AVAILABLE:
+        write_annotations_parquet(annotations, annotations_parquet_loc)
+    if os.path.exists(annotations_parquet_loc):
+        output_files['annotations_parquet'] = {'path': annotations_parquet_loc,
+                                               'name': 'annotations.parquet',
+                                               'label': 'annotations.parquet',
+                                               'description': 'DRAM annotations in parquet format with row '
+                                                              'groups by genome'}
     genes_fna_loc = os.path.join(output_dir, 'genes.fna')
     if not os.path.exists(genes_fna_loc):
         genes_fna_loc = None
@@ -71,6 +293,50 @@ def get_annotation_files(output_dir, output_files=None):
     return output_files
 
 
+def write_metabolism_summary(summarized_genomes, output_loc, distill_module, sheet_formats=()):
+    # the sheets DRAM writes, appended a row at a time by openpyxl's write only mode instead of built in memory,
+    # and optionally each sheet as tsv and parquet too
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    sheets_dir = os.path.join(os.path.dirname(output_loc), METABOLISM_SHEETS_DIR)
+    if len(sheet_formats) > 0:
+        os.makedirs(sheets_dir, exist_ok=True)
+    for sheet, frame in summarized_genomes.groupby('sheet', sort=False):
+        frame = frame.sort_values(distill_module.DISTILATE_SORT_ORDER_COLUMNS).drop(['sheet'], axis=1)
+        constant_columns = distill_module.CONSTANT_DISTILLATE_COLUMNS
+        split_genes = pd.concat([distill_module.split_names_to_long(frame[i].astype(str))
+                                 for i in frame.columns if i not in constant_columns], axis=1)
+        frame = pd.concat([frame[constant_columns], split_genes], axis=1)
+        worksheet = workbook.create_sheet(sheet)
+        worksheet.append([str(i) for i in frame.columns])
+        for row in frame.itertuples(index=False, name=None):
+            worksheet.append([None if pd.isna(i) else i for i in row])
+        sheet_name = re.sub(r'\W+', '_', sheet)
+        if 'tsv' in sheet_formats:
+            frame.to_csv(os.path.join(sheets_dir, '%s.tsv' % sheet_name), sep='\t', index=False)
+        if 'parquet' in sheet_formats and PYARROW_AVAILABLE:
+            frame.astype(str).to_parquet(os.path.join(sheets_dir, '%s.parquet' % sheet_name), index=False)
+    workbook.save(output_loc)
+
+
+@contextmanager
+def streamed_metabolism_summary(function, sheet_formats=()):
+    # summarize_genomes only takes paths, so swap in the streamed writer inside its module while it runs, an
+    # overlapping run waits for this one to finish
+    module = sys.modules[function.__module__]
+    with _MODULE_PATCH_LOCK:
+        original = getattr(module, 'write_summarized_genomes_to_xlsx', None)
+        if original is None:
+            yield
+            return
+        module.write_summarized_genomes_to_xlsx = lambda summarized_genomes, output_loc: write_metabolism_summary(
+            summarized_genomes, output_loc, module, sheet_formats)
+        try:
+            yield
+        finally:
+            module.write_summarized_genomes_to_xlsx = original
+
+
 def get_distill_files(distill_output_dir, output_files=None):
     if output_files is None:
         output_files = dict()
@@ -84,6 +350,16 @@ def get_distill_files(distill_output_dir, output_files=None):
                                           'name': 'metabolism_summary.xlsx',
                                           'label': 'metabolism_summary.xlsx',
                                           'description': 'DRAM metabolism summary tables'}
+    sheets_dir = os.path.join(distill_output_dir, METABOLISM_SHEETS_DIR)
+    if os.path.exists(sheets_dir):
+        sheets_loc = os.path.join(distill_output_dir, 'metabolism_summary.tar.gz')
+        with tarfile.open(sheets_loc, 'w:gz') as tar:
+            tar.add(sheets_dir, arcname=METABOLISM_SHEETS_DIR)
+        output_files['metabolism_summary_sheets'] = {'path': sheets_loc,
+                                                     'name': 'metabolism_summary.tar.gz',
+                                                     'label': 'metabolism_summary.tar.gz',
+                                                     'description': 'Each DRAM metabolism summary sheet as tsv and '
+                                                                    'parquet'}
     genome_stats_loc = os.path.join(distill_output_dir, 'genome_stats.tsv')
     output_files['genome_stats'] = {'path': genome_stats_loc,
                                     'name': 'genome_stats.tsv',
@@ -92,145 +368,305 @@ def get_distill_files(distill_output_dir, output_files=None):
     return output_files
 
 
-def generate_genomes(annotations, genes_nucl_loc, genes_aa_loc, assembly_ref_dict, assemblies, workspace, provenance, dram_sufix='DRAM'):
-    genes_nucl = {i.metadata['id']: i for i in read_sequence(genes_nucl_loc, format='fasta')}
-    genes_aa = {i.metadata['id']: i for i in read_sequence(genes_aa_loc, format='fasta')}
-    genome_objects = list()
-    for fasta_name, genome_annotations in annotations.groupby('fasta'):
-        # set scientific name, domain and genetic code
-        if 'bin_taxonomy' in genome_annotations.columns:  # assuming gtdb taxa strings
-            scientific_name = genome_annotations['bin_taxonomy'].iloc[0]  # not really the scientific name, whatever
-            domain = scientific_name.split[';'][0]
+class SequenceIndex:
+    # dict like sequence index kept in sqlite on disk for gene sets too large to index in memory
+    def __init__(self, index_loc):
+        if os.path.exists(index_loc):
+            os.remove(index_loc)
+        self.conn = sqlite3.connect(index_loc)
+        self.conn.execute('CREATE TABLE sequences (name TEXT PRIMARY KEY, offset INTEGER, length INTEGER)')
+
+    def __setitem__(self, name, sequence_index):
+        self.conn.execute('INSERT OR REPLACE INTO sequences VALUES (?, ?, ?)', (name,) + sequence_index)
+
+    def __getitem__(self, name):
+        sequence_index = self.conn.execute('SELECT offset, length FROM sequences WHERE name = ?',
+                                           (name,)).fetchone()
+        if sequence_index is None:
+            raise KeyError(name)
+        return sequence_index
+
+
+def index_fasta(fasta_loc, index_loc=None):
+    # byte offset and length of each sequence so a genome can read only its own genes
+    fasta_index = dict() if index_loc is None else SequenceIndex(index_loc)
+    name = None
+    start = 0
+    offset = 0
+    with open(fasta_loc, 'rb') as f:
+        for line in f:
+            if line.startswith(b'>'):
+                if name is not None:
+                    fasta_index[name] = (start, offset - start)
+                name = line[1:].split()[0].decode()
+                start = offset + len(line)
+            offset += len(line)
+    if name is not None:
+        fasta_index[name] = (start, offset - start)
+    if index_loc is not None:
+        fasta_index.conn.commit()
+    return fasta_index
+
+
+def read_indexed_sequence(f, sequence_index):
+    f.seek(sequence_index[0])
+    return f.read(sequence_index[1]).decode().replace('\n', '').replace('\r', '')
+
+
+def assembly_stats(fasta_loc):
+    # contig count, bases and G+C count from a line at a time, so no assembly is ever held in memory
+    stats = {'contigs': 0, 'dna_size': 0, 'gc_count': 0}
+    with open(fasta_loc, 'rb') as f:
+        for line in f:
+            if line.startswith(b'>'):
+                stats['contigs'] += 1
+                continue
+            line = line.strip().upper()
+            stats['dna_size'] += len(line)
+            stats['gc_count'] += line.count(b'G') + line.count(b'C')
+    return stats
+
+
+def build_genome(fasta_name, genome_annotations, genes_nucl_loc, genes_nucl_index, genes_aa_loc, genes_aa_index,
+                 assembly_ref, assembly_loc, workspace, provenance, dram_sufix='DRAM', stats=None):
+    # set scientific name, domain and genetic code
+    if 'bin_taxonomy' in genome_annotations.columns:  # assuming gtdb taxa strings
+        scientific_name = genome_annotations['bin_taxonomy'].iloc[0]  # not really the scientific name, whatever
+        domain = scientific_name.split[';'][0]
+    else:
+        scientific_name = 'Unknown'
+        domain = 'Unknown'
+    # get assembly information, measured while the assembly was downloaded when stats are given
+    if stats is None:
+        stats = assembly_stats(assembly_loc)
+    dna_size = stats['dna_size']
+    gc_content = stats['gc_count'] / dna_size
+    # get ORF features
+    cdss = []
+    mrnas = []
+    features = []
+    genes_nucl = open(genes_nucl_loc, 'rb')
+    genes_aa = open(genes_aa_loc, 'rb')
+    for feature_name, row in genome_annotations.iterrows():
+        # get general gene information
+        fid = feature_name
+        strandedness = '+' if row['strandedness'] == 1 else '-'
+        location = [[row['scaffold'], row['start_position'], strandedness,
+                     row['end_position'] - row['start_position']]]
+        aliases = []
+        # get gene sequence
+        dna = read_indexed_sequence(genes_nucl, genes_nucl_index[feature_name])
+        md5 = hashlib.md5(dna.encode()).hexdigest()
+        prot = read_indexed_sequence(genes_aa, genes_aa_index[feature_name])
+        # get mrna and cds data
+        cds_id = fid + "_CDS"
+        mrna_id = fid + "_mRNA"
+        # get product
+        if not pd.isna(row['kegg_hit']):
+            product = row['kegg_hit']
         else:
-            scientific_name = 'Unknown'
-            domain = 'Unknown'
-        # get assembly information
-        assembly_ref = assembly_ref_dict[fasta_name]
-        sequence = ''.join([str(i) for i in read_sequence(assemblies[assembly_ref]['paths'][0], format='fasta')])
-        sequence = sequence.upper()
-        dna_size = len(sequence)
-        gc_content = sum([(i == 'G') or (i == 'C') for i in sequence]) / dna_size
-        # get ORF features
-        cdss = []
-        mrnas = []
-        features = []
-        for feature_name, row in genome_annotations.iterrows():
-            # get general gene information
-            fid = feature_name
-            strandedness = '+' if row['strandedness'] == 1 else '-'
-            location = [[row['scaffold'], row['start_position'], strandedness,
-                         row['end_position'] - row['start_position']]]
-            aliases = []
-            # get gene sequence
-            dna = str(genes_nucl[feature_name])
-            md5 = hashlib.md5(dna.encode()).hexdigest()
-            prot = str(genes_aa[feature_name])
-            # get mrna and cds data
-            cds_id = fid + "_CDS"
-            mrna_id = fid + "_mRNA"
-            # get product
-            if not pd.isna(row['kegg_hit']):
-                product = row['kegg_hit']
-            else:
-                product = ''
-            # define feature
-            feature = {"id": fid, "location": location, "type": "gene", "aliases": aliases, "md5": md5,
-                       "dna_sequence": dna, "dna_sequence_length": len(dna), "protein_translation": prot,
-                       "protein_translation_length": len(prot), "cdss": [cds_id], "mrans": [mrna_id],
-                       "function": product, "ontology_terms": {}}
-            features.append(feature)
-            # define cds
-            cds = {"id": cds_id, "location": location, "md5": md5, "parent_gene": fid, "parent_mrna": mrna_id,
-                   "function": (product if product else ""), "ontology_terms": {}, "protein_translation": prot,
-                   "protein_translation_length": len(prot), "aliases": aliases}
-            cdss.append(cds)
-            # define mrna
-            mrna = {"id": mrna_id, "location": location, "md5": md5,
-                    "parent_gene": fid, "cds": cds_id}
-            mrnas.append(mrna)
-        # TODO: get rRNA features
-        # TODO: get tRNA features
-        genome = {"id": "Unknown",
-                  "features": features,
-                  "scientific_name": scientific_name,
-                  "domain": domain,
-                  "genetic_code": 0,  # might be able to get this from prodigal calls
-                  "assembly_ref": assembly_ref, # Added this just to double check things don't get overwritten
-                  "cdss": cdss,
-                  "mrnas": mrnas,
-                  "source": "DRAM annotation pipeline",
-                  "gc_content": gc_content,
-                  "dna_size": dna_size,
-                  "reference_annotation": 0}
-
-        genome_object = {"workspace": workspace,
-                         "name": '_'.join([fasta_name, dram_sufix]),
-                         "data": genome,
-                         "provenance": provenance}
-        genome_objects.append(genome_object)
-    return genome_objects
-
-
-def add_ontology_terms(annotations, description, version, workspace, workspace_url, genome_ref_dict):
-    ontology_events = []
-    for fasta_name, genome_annotations in annotations.groupby('fasta'):
-        # add ontology terms
-        # TODO: also add EC and other ontologies
-
-        kegg_ontology_terms = dict()
-        ko_terms = list()
-        ec_ontology_terms = dict()
-        ec_terms = list()
-        for gene, row in genome_annotations.iterrows():  # this is slow, could probably be an apply
-            # get kos
-            if not pd.isna(row['ko_id']):
-                kegg_terms = row['ko_id'].split(',')
-                ko_terms += kegg_terms
-                kegg_ontology_terms[gene] = [{'term': i} for i in kegg_terms]
-            # get ECs
-            # TODO: be able to capute EC's with - (i.e. EC 3.2.1.-)
-            for label, value in row.items():
-                if not pd.isna(value) and ('_hit' in label):
-                    current_ec_terms = [i.replace(' ', ':') for i in re.findall(r"EC[ :]\d+.\d+.\d+.\d+", value)]
-                    ec_terms += current_ec_terms
-                    ec_ontology_terms[gene] = [{'term': i} for i in current_ec_terms]
-
-        kegg_timestamp = datetime.datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
-        kegg_description = '%s_%s_%s' % (description, 'KO', kegg_timestamp)
-        kegg_ontology = {
-            'description': kegg_description,
-            'ontology_id': 'KO',
-            'method': 'DRAM',  # from above
-            'method_version': version,
-            "timestamp": kegg_timestamp,
-            'ontology_terms': kegg_ontology_terms,
-            'gene_count': len(annotations),  # not used in the api
-            'term_count': len(set(ko_terms))  # not used in the api
-        }
+            product = ''
+        # define feature
+        feature = {"id": fid, "location": location, "type": "gene", "aliases": aliases, "md5": md5,
+                   "dna_sequence": dna, "dna_sequence_length": len(dna), "protein_translation": prot,
+                   "protein_translation_length": len(prot), "cdss": [cds_id], "mrans": [mrna_id],
+                   "function": product, "ontology_terms": {}}
+        features.append(feature)
+        # define cds
+        cds = {"id": cds_id, "location": location, "md5": md5, "parent_gene": fid, "parent_mrna": mrna_id,
+               "function": (product if product else ""), "ontology_terms": {}, "protein_translation": prot,
+               "protein_translation_length": len(prot), "aliases": aliases}
+        cdss.append(cds)
+        # define mrna
+        mrna = {"id": mrna_id, "location": location, "md5": md5,
+                "parent_gene": fid, "cds": cds_id}
+        mrnas.append(mrna)
+    genes_nucl.close()
+    genes_aa.close()
+    # TODO: get rRNA features
+    # TODO: get tRNA features
+    genome = {"id": "Unknown",
+              "features": features,
+              "scientific_name": scientific_name,
+              "domain": domain,
+              "genetic_code": 0,  # might be able to get this from prodigal calls
+              "assembly_ref": assembly_ref, # Added this just to double check things don't get overwritten
+              "cdss": cdss,
+              "mrnas": mrnas,
+              "source": "DRAM annotation pipeline",
+              "gc_content": gc_content,
+              "dna_size": dna_size,
+              "reference_annotation": 0}
 
-        ec_timestamp = datetime.datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
-        ec_description = '%s_%s_%s' % (description, 'EC', kegg_timestamp)
-        ec_ontology = {
-            'description': ec_description,
-            'ontology_id': 'EC',
-            'method': 'DRAM',  # from above
-            'method_version': version,
-            "timestamp": ec_timestamp,
-            'ontology_terms': ec_ontology_terms,
-            'gene_count': len(annotations),  # not used in the api
-            'term_count': len(set(ec_terms))  # not used in the api
-        }
+    genome_object = {"workspace": workspace,
+                     "name": '_'.join([fasta_name, dram_sufix]),
+                     "data": genome,
+                     "provenance": provenance}
+    return genome_object
+
+
+def _build_genome_args(fasta_name, genome_annotations, genes_nucl_loc, genes_nucl_index, genes_aa_loc,
+                       genes_aa_index, assembly_ref_dict, assemblies, workspace, provenance, dram_sufix):
+    # only the columns and sequence index entries for this genome get sent to a worker
+    columns = [i for i in GENOME_COLUMNS if i in genome_annotations.columns]
+    assembly_ref = assembly_ref_dict[fasta_name]
+    return (fasta_name, genome_annotations[columns], genes_nucl_loc,
+            {i: genes_nucl_index[i] for i in genome_annotations.index}, genes_aa_loc,
+            {i: genes_aa_index[i] for i in genome_annotations.index}, assembly_ref,
+            assemblies[assembly_ref]['paths'][0], workspace, provenance, dram_sufix,
+            assemblies[assembly_ref].get('stats'))
+
+
+def generate_genomes(annotations, genes_nucl_loc, genes_aa_loc, assembly_ref_dict, assemblies, workspace, provenance,
+                     dram_sufix='DRAM', processes=1, index_dir=None, skip_genomes=(), max_in_flight=None):
+    # with index_dir the gene sequence indexes are kept on disk so memory does not grow with the gene count, genomes
+    # named in skip_genomes are not built, at most max_in_flight built genomes, one per process by default, are held
+    # on top of the ones waiting to be saved
+    genes_nucl_index = index_fasta(genes_nucl_loc, None if index_dir is None else
+                                   os.path.join(index_dir, 'genes_fna.sqlite'))
+    genes_aa_index = index_fasta(genes_aa_loc, None if index_dir is None else
+                                 os.path.join(index_dir, 'genes_faa.sqlite'))
+    genome_args = (_build_genome_args(fasta_name, genome_annotations, genes_nucl_loc, genes_nucl_index,
+                                      genes_aa_loc, genes_aa_index, assembly_ref_dict, assemblies, workspace,
+                                      provenance, dram_sufix)
+                   for fasta_name, genome_annotations in _group_by_fasta(annotations)
+                   if '_'.join([fasta_name, dram_sufix]) not in skip_genomes)
+    if max_in_flight is None:
+        max_in_flight = processes
+    # genomes are yielded so only ones waiting to be saved are held in memory, a pool is only started for more than
+    # one genome and is started now rather than on the first genome taken, forking once the caller has started its
+    # save thread can deadlock the workers
+    first_args = list(itertools.islice(genome_args, max(max_in_flight, 1)))
+    genome_args = itertools.chain(first_args, genome_args)
+    workers = min(processes, len(first_args))
+    if workers > 1:
+        return _pooled_genomes(multiprocessing.Pool(workers), genome_args, max_in_flight)
+    return (build_genome(*args) for args in genome_args)
+
+
+def _pooled_genomes(pool, genome_args, max_in_flight):
+    # at most max_in_flight genomes queued or built and not yet taken, yielded in input order
+    with pool:
+        pending = collections.deque()
+        for args in genome_args:
+            pending.append(pool.apply_async(build_genome, args))
+            if len(pending) >= max_in_flight:
+                yield pending.popleft().get()
+        while len(pending) > 0:
+            yield pending.popleft().get()
+
+
+def _ontology_terms_bytes(gene, terms):
+    # length of '"gene": [{"term": "..."}, ...], ' as json.dumps writes it
+    return len(gene) + 6 + sum(len(i['term']) + 14 for i in terms)
+
+
+def split_ontology_event(ontology_event, max_bytes=ONTOLOGY_EVENT_BYTES):
+    # the genome's genes dealt in order into events of at most about max_bytes of terms, each chunk carries the part
+    # of every ontology event that falls in it
+    chunks = [[dict(i, ontology_terms=dict()) for i in ontology_event['events']]]
+    chunk_bytes = 0
+    for event_number, event in enumerate(ontology_event['events']):
+        for gene, terms in event['ontology_terms'].items():
+            gene_bytes = _ontology_terms_bytes(gene, terms)
+            if chunk_bytes + gene_bytes > max_bytes and chunk_bytes > 0:
+                chunks.append([dict(i, ontology_terms=dict()) for i in ontology_event['events']])
+                chunk_bytes = 0
+            chunks[-1][event_number]['ontology_terms'][gene] = terms
+            chunk_bytes += gene_bytes
+    if len(chunks) == 1:
+        return [ontology_event]
+    split_events = list()
+    for chunk_number, chunk in enumerate(chunks):
+        # distinct descriptions so a later chunk is added next to the earlier ones rather than replacing them
+        events = [dict(i, description='%s_part%s' % (i['description'], chunk_number + 1)) for i in chunk
+                  if len(i['ontology_terms']) > 0 or chunk_number == 0]
+        split_events.append(dict(ontology_event, events=events))
+    return split_events
+
+
+class OntologyExtractor:
+    # every ontology's terms from one scan of each annotation column, the patterns of all ontologies a column holds
+    # are joined into one precompiled alternation so each value is searched once
+    def __init__(self, ontologies=EVENT_ONTOLOGIES):
+        self.sources = [i for i in ONTOLOGY_SOURCES if i[0] in ontologies]
+        self.ontologies = [i for i in ontologies if i in {j[0] for j in self.sources}]
+        self.column_patterns = dict()
+
+    def column_pattern(self, column):
+        if column not in self.column_patterns:
+            parts = list()
+            groups = dict()
+            for i, (ontology_id, columns, patterns, term_pattern) in enumerate(self.sources):
+                if column in columns or any(j in column for j in patterns):
+                    groups['o%s' % i] = ontology_id
+                    parts.append('(?P<o%s>%s)' % (i, term_pattern))
+            self.column_patterns[column] = (re.compile('|'.join(parts)), groups) if len(parts) > 0 else (None, None)
+        return self.column_patterns[column]
+
+    def extract(self, genome_annotations):
+        # ontology id to gene to terms in the order they were found, each term once per gene
+        ontology_terms = {i: collections.defaultdict(dict) for i in self.ontologies}
+        for column in genome_annotations.columns:
+            pattern, groups = self.column_pattern(column)
+            if pattern is None:
+                continue
+            values = genome_annotations[column].dropna()
+            for gene, value in zip(values.index, values.values):
+                for match in pattern.finditer(value):
+                    ontology_terms[groups[match.lastgroup]][gene][match.group().replace(' ', ':')] = None
+        return {ontology_id: {gene: list(terms) for gene, terms in gene_terms.items()}
+                for ontology_id, gene_terms in ontology_terms.items()}
+
+
+def dram_method_version(version):
+    # the method_version of the events this run writes, the module version, DRAM's version and a digest of the
+    # databases import_config set up, so annotations from other databases are not taken for this run's
+    from mag_annotator import __version__ as dram_version
+    from mag_annotator.database_handler import DatabaseHandler
+    config = DatabaseHandler(logging.getLogger(__name__)).config
+    databases = {i: config.get(i) for i in ('search_databases', 'database_descriptions', 'setup_info')}
+    digest = hashlib.sha256(json.dumps(databases, sort_keys=True, default=str).encode()).hexdigest()
+    return '%s;DRAM %s;databases %s' % (version, dram_version, digest[:12])
+
+
+def add_ontology_terms(annotations, description, version, workspace, workspace_url, genome_ref_dict,
+                       max_event_bytes=ONTOLOGY_EVENT_BYTES, ontologies=EVENT_ONTOLOGIES, skip_genomes=()):
+    # events are yielded per genome so they can be submitted without holding every genome's terms, a genome's
+    # events are split into several once they pass max_event_bytes, genomes named in skip_genomes get none
+    extractor = OntologyExtractor(ontologies)
+    for fasta_name, genome_annotations in _group_by_fasta(annotations):
+        if fasta_name in skip_genomes or '%s_DRAM' % fasta_name in skip_genomes:
+            continue
+        # add ontology terms
+        timestamp = datetime.datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
+        events = list()
+        for ontology_id, gene_terms in extractor.extract(genome_annotations).items():
+            # KO and EC events are always added, an empty one still marks the genome as annotated for get_dram_events
+            if len(gene_terms) == 0 and ontology_id not in DRAM_ONTOLOGIES:
+                continue
+            events.append({
+                'description': '%s_%s_%s' % (description, ontology_id, timestamp),
+                'ontology_id': ontology_id,
+                'method': 'DRAM',  # from above
+                'method_version': version,
+                "timestamp": timestamp,
+                'ontology_terms': {gene: [{'term': i} for i in terms] for gene, terms in gene_terms.items()},
+                'gene_count': len(genome_annotations),  # not used in the api
+                'term_count': len({i for terms in gene_terms.values() for i in terms})  # not used in the api
+            })
 
         # this is because when annotating assemblies we rename genomes based on input name and _DRAM
         # TODO: turn '%s_DRAM' in an argument with desired replacement or None for no replacement
-        if isinstance(fasta_name,float):
-            fasta_name = str(fasta_name)
         # fasta_name = "ap1."
         # genome_ref_dict = {"ap1.000", 'ap3.0000', 'ap1.', 'ap1.noe','ap1._DRAM'}
         # fasta_name = "Paceibacter_normanii_SCGC_AAA255-P19"
         # genome_ref_dict = {"Paceibacter_normanii_SCGC_AAA255-P19_DRAM"}
-        likly_genome_name = [i for i in genome_ref_dict
-                             if re.match(f"^{fasta_name}0?[_DRAM]?", i)]
+        # exact names first, otherwise bin_1 is ambiguous as soon as there is a bin_10
+        likly_genome_name = [i for i in (fasta_name, '%s_DRAM' % fasta_name) if i in genome_ref_dict]
+        if len(likly_genome_name) == 0:
+            likly_genome_name = [i for i in genome_ref_dict
+                                 if re.match(f"^{fasta_name}0?[_DRAM]?", i)]
         if len(likly_genome_name) == 1:
             genome_name = likly_genome_name[0]
         elif len(likly_genome_name) > 1:
@@ -263,14 +699,177 @@ def add_ontology_terms(annotations, description, version, workspace, workspace_u
             "output_name": genome_name,
             "input_workspace": workspace,
             "workspace-url": workspace_url,
-            "events": [kegg_ontology, ec_ontology],
+            "events": events,
             "timestamp": datetime.datetime.now().strftime("%Y_%m_%d_%H_%M_%S"),
             "output_workspace": workspace,
             "save": 1
         }
 
-        ontology_events.append(ontology_event)
-    return ontology_events
+        yield from split_ontology_event(ontology_event, max_event_bytes)
+
+
+def get_dram_events(events, version):
+    # the events of each ontology DRAM adds, added with this dram_method_version, so by the same module, DRAM and
+    # databases, None if any of DRAM_ONTOLOGIES are missing
+    dram_events = dict()
+    for event in events:
+        if event.get('method') == 'DRAM' and event.get('method_version') == version and \
+                event.get('ontology_id') in EVENT_ONTOLOGIES:
+            if event['ontology_id'] in dram_events:
+                # a run's terms may be split over several events
+                ontology_terms = dict(dram_events[event['ontology_id']]['ontology_terms'])
+                ontology_terms.update(event['ontology_terms'])
+                event = dict(event, ontology_terms=ontology_terms)
+            dram_events[event['ontology_id']] = event
+    if any(i not in dram_events for i in DRAM_ONTOLOGIES):
+        return None
+    return dram_events
+
+
+def annotations_from_ontology_events(genome_name, dram_events):
+    # rebuild the columns distill reads for every ontology from earlier DRAM events
+    genes = collections.defaultdict(dict)
+    columns = list()
+    for ontology_id, event in dram_events.items():
+        prefix = '%s:' % ontology_id
+        for column, format_terms in PRIOR_ANNOTATION_COLUMNS[ontology_id]:
+            columns.append(column)
+            for gene, terms in event['ontology_terms'].items():
+                terms = [i['term'] for i in terms]
+                if ontology_id != 'EC':
+                    terms = [i[len(prefix):] if i.startswith(prefix) else i for i in terms]
+                if len(terms) > 0:
+                    genes[gene][column] = format_terms(terms)
+    annotations = pd.DataFrame.from_dict(genes, orient='index', columns=columns)
+    annotations.insert(0, 'fasta', genome_name)
+    return annotations
+
+
+def write_set_annotations(annotations_loc, prior_annotations, output_loc):
+    # this run's annotations followed by those rebuilt from earlier events, the table has this run's columns and
+    # any the earlier events need that it lacks, so their terms are not dropped
+    prior_annotations = list(prior_annotations)
+    columns = list()
+    if annotations_loc is not None:
+        with open(annotations_loc) as f:
+            columns = f.readline().rstrip('\n').split('\t')[1:]
+    extra_columns = list(dict.fromkeys(j for i in prior_annotations for j in i.columns if j not in columns))
+    columns += extra_columns
+    if annotations_loc is None:
+        mode = 'w'
+    elif len(extra_columns) == 0:
+        shutil.copyfile(annotations_loc, output_loc)
+        mode = 'a'
+    else:
+        # the new columns are empty for this run's genes
+        with open(annotations_loc) as f, open(output_loc, 'w') as o:
+            o.write('\t'.join([''] + columns) + '\n')
+            next(f)
+            for line in f:
+                o.write('%s%s\n' % (line.rstrip('\n'), '\t' * len(extra_columns)))
+        mode = 'a'
+    for annotations in prior_annotations:
+        annotations.reindex(columns=columns).to_csv(output_loc, sep='\t', mode=mode, header=mode == 'w')
+        mode = 'a'
+    return output_loc
+
+
+def index_gene_products(annotations_loc, index_loc, chunksize=ANNOTATION_CHUNKSIZE):
+    # load gene products into an on disk index so memory does not grow with the number of genes
+    if os.path.exists(index_loc):
+        os.remove(index_loc)
+    conn = sqlite3.connect(index_loc)
+    conn.execute('CREATE TABLE products (gene TEXT PRIMARY KEY, product TEXT)')
+    columns = pd.read_csv(annotations_loc, sep='\t', nrows=0).columns
+    if 'kegg_hit' in columns:
+        for chunk in pd.read_csv(annotations_loc, sep='\t', index_col=0, usecols=[columns[0], 'kegg_hit'],
+                                 dtype={'kegg_hit': str}, chunksize=chunksize):
+            chunk = chunk.dropna()
+            conn.executemany('INSERT OR REPLACE INTO products VALUES (?, ?)',
+                             zip(chunk.index.astype(str), chunk['kegg_hit']))
+    conn.commit()
+    return conn
+
+
+def add_gff_product(line, conn):
+    match = re.search(r'ID=([^;]+)', line)
+    if match is not None:
+        product = conn.execute('SELECT product FROM products WHERE gene = ?', (match.group(1),)).fetchone()
+        if product is not None:
+            if not line.endswith(';'):
+                line += ';'
+            line += 'product=%s;' % quote(product[0], safe=' :[]()/-.|')
+    return line
+
+
+def write_metagenome_gff(genes_gff_loc, annotations_loc, output_gff_loc, chunksize=ANNOTATION_CHUNKSIZE):
+    # stream the DRAM gff adding products from the annotations, DRAM already adds database ids as Dbxref
+    index_loc = '%s.products.sqlite' % output_gff_loc
+    conn = index_gene_products(annotations_loc, index_loc, chunksize)
+    genes_written = 0
+    try:
+        with open(genes_gff_loc) as f, open(output_gff_loc, 'w') as o:
+            for line in f:
+                line = line.rstrip('\n')
+                if line.startswith('#') or not line:
+                    o.write('%s\n' % line)
+                    continue
+                o.write('%s\n' % add_gff_product(line, conn))
+                genes_written += 1
+    finally:
+        conn.close()
+        os.remove(index_loc)
+    return genes_written
+
+
+def get_scaffold_genomes(annotations_loc, chunksize=ANNOTATION_CHUNKSIZE):
+    # DRAM prefixes scaffolds in its gff with the fasta name, map these back to the fasta and input scaffold
+    scaffold_genomes = dict()
+    for chunk in pd.read_csv(annotations_loc, sep='\t', usecols=['fasta', 'scaffold'],
+                             dtype={'fasta': str, 'scaffold': str}, chunksize=chunksize):
+        for fasta_name, scaffold in chunk.drop_duplicates().itertuples(index=False):
+            scaffold_genomes['%s_%s' % (fasta_name, scaffold)] = (fasta_name, scaffold)
+            scaffold_genomes.setdefault(scaffold, (fasta_name, scaffold))
+    return scaffold_genomes
+
+
+def write_genome_gffs(genes_gff_loc, annotations_loc, output_dir, chunksize=ANNOTATION_CHUNKSIZE):
+    # split the DRAM gff into one gff per genome in a single streaming pass, scaffolds get their input names
+    # back so each genome can be linked to the assembly it came from
+    scaffold_genomes = get_scaffold_genomes(annotations_loc, chunksize)
+    index_loc = os.path.join(output_dir, 'products.sqlite')
+    conn = index_gene_products(annotations_loc, index_loc, chunksize)
+    gff_locs = dict()
+    current_fasta = None
+    o = None
+    try:
+        with open(genes_gff_loc) as f:
+            for line in f:
+                line = line.rstrip('\n')
+                if line.startswith('#') or not line:
+                    continue
+                seqid, rest = line.split('\t', 1)
+                if seqid not in scaffold_genomes:
+                    continue
+                fasta_name, scaffold = scaffold_genomes[seqid]
+                # DRAM writes the genes of each genome together so usually only one file is open
+                if fasta_name != current_fasta:
+                    if o is not None:
+                        o.close()
+                    if fasta_name in gff_locs:
+                        o = open(gff_locs[fasta_name], 'a')
+                    else:
+                        gff_locs[fasta_name] = os.path.join(output_dir, '%s.gff' % fasta_name)
+                        o = open(gff_locs[fasta_name], 'w')
+                        o.write('##gff-version 3\n')
+                    current_fasta = fasta_name
+                o.write('%s\t%s\n' % (scaffold, add_gff_product(rest, conn)))
+    finally:
+        if o is not None:
+            o.close()
+        conn.close()
+        os.remove(index_loc)
+    return gff_locs
 
 
 def get_viral_distill_files(distill_output_dir, output_files=None):
@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+
+# prokaryotic genomes code about one gene per kb
+GENES_PER_BASE = 1 / 1000
+MB = 1024 ** 2
+# stages each method runs, in order
+ANNOTATE_STAGES = ('annotation', 'distillation', 'genome_building', 'ontology')
+ANNOTATE_GFF_STAGES = ('annotation', 'distillation', 'genome_gff_import', 'ontology')
+ANNOTATE_METAGENOME_STAGES = ('annotation', 'distillation', 'metagenome_save')
+ANNOTATE_GENOME_STAGES = ('annotation', 'distillation', 'ontology')
+MEASURES = ('wall_seconds', 'peak_memory_bytes', 'scratch_bytes')
+# scratch bytes per input base a stage with no recorded timings is still taken to write, DRAM's annotation writes
+# the sequences it annotates again, as scaffolds.fna or genes.faa, before anything else
+MIN_SCRATCH_PER_BASE = {'annotation': 1}
+
+
+def _fit(genes, values):
+    # least squares line through the recorded points, a single point is taken as proportional to genes
+    if len(set(genes)) < 2:
+        return 0.0, float(np.mean(values) / max(np.mean(genes), 1))
+    slope, intercept = np.polyfit(genes, values, 1)
+    if slope < 0:
+        return float(np.mean(values)), 0.0
+    return max(float(intercept), 0.0), float(slope)
+
+
+def fit_stage_model(timings):
+    # intercept and per gene cost of each measure for every stage in a table of recorded stage timings
+    model = dict()
+    for stage, stage_timings in timings.groupby('stage', sort=False):
+        genes = stage_timings['genes'].astype(float).values
+        model[stage] = {
+            'wall_seconds': _fit(genes, stage_timings['wall_seconds'].astype(float).values),
+            'peak_memory_bytes': _fit(genes, stage_timings['peak_memory_mb'].astype(float).values * MB),
+            'scratch_bytes': _fit(genes, stage_timings['scratch_mb'].astype(float).values * MB),
+        }
+    return model
+
+
+def load_stage_model(timings_loc):
+    return fit_stage_model(pd.read_csv(timings_loc, sep='\t'))
+
+
+def predict_genes(input_sizes):
+    # gene counts from genome metadata where there is one, from the number of bases otherwise
+    return sum(size['genes'] if size.get('genes') else int(size['bases'] * GENES_PER_BASE) for size in input_sizes)
+
+
+def predict_stage_scratch(input_sizes, stage, model):
+    # scratch a stage is expected to add, from its recorded timings or, without any, the floor for its input bases
+    if stage in model:
+        intercept, slope = model[stage]['scratch_bytes']
+        return int(intercept + slope * predict_genes(input_sizes))
+    return int(MIN_SCRATCH_PER_BASE.get(stage, 0) * sum(size.get('bases', 0) for size in input_sizes))
+
+
+def predict_resources(input_sizes, stages, model, annotation_shards=1):
+    genes = predict_genes(input_sizes)
+    stage_estimates = list()
+    for stage in stages:
+        # a stage with no recorded timings yet is estimated as 0 and marked as not calibrated
+        stage_estimate = {'stage': stage, 'calibrated': int(stage in model)}
+        for measure in MEASURES:
+            intercept, slope = model[stage][measure] if stage in model else (0, 0)
+            stage_estimate[measure] = int(intercept + slope * genes)
+        # every shard is a DRAM process with its own databases loaded
+        if stage == 'annotation':
+            stage_estimate['peak_memory_bytes'] *= annotation_shards
+        stage_estimates.append(stage_estimate)
+    return {
+        'input_count': len(input_sizes),
+        'input_bases': sum(size.get('bases', 0) for size in input_sizes),
+        'predicted_genes': genes,
+        # stages run one after another and most of what they write stays until the report is made
+        'peak_memory_bytes': max(i['peak_memory_bytes'] for i in stage_estimates),
+        'scratch_bytes': sum(i['scratch_bytes'] for i in stage_estimates),
+        'wall_seconds': sum(i['wall_seconds'] for i in stage_estimates),
+        # the totals leave out these stages
+        'uncalibrated_stages': [i['stage'] for i in stage_estimates if not i['calibrated']],
+        'stages': stage_estimates
+    }
@@ -0,0 +1,182 @@
+import os
+import json
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+# above this many genomes DRAM's altair product is split into pages of this size and product.html is replaced by a
+# viewer that loads the heatmap a page at a time
+PRODUCT_HEATMAP_GENOMES = 200
+HEATMAP_PAGE_SIZE = 100
+HEATMAP_DIR = 'product_heatmap'
+# cell values are stored as one character each, coverage rounded to twentieths and '.' where there is no value
+HEATMAP_LEVELS = 20
+HEATMAP_CHARS = 'abcdefghijklmnopqrstu'
+
+PRODUCT_VIEWER = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>DRAM product</title>
+<style>
+body {font-family: sans-serif; font-size: 11px;}
+table {border-collapse: collapse;}
+th.column {height: 160px; white-space: nowrap; vertical-align: bottom;}
+th.column div {transform: rotate(-90deg); width: 12px;}
+td.cell {width: 12px; height: 12px; border: 1px solid #eee;}
+td.genome {white-space: nowrap; padding-right: 6px;}
+tr.group td {font-weight: bold; padding-top: 8px;}
+</style>
+</head>
+<body>
+<div>
+<button id="previous">&lt;</button> <span id="page"></span> <button id="next">&gt;</button>
+<select id="group"></select>
+<span id="altair"></span>
+</div>
+<table id="heatmap"></table>
+<script>
+var index = null;
+var pages = {};
+var current = 0;
+
+// genome, group and column names come from the user's data
+function escape(text) {
+  return String(text).replace(/&/g, '&amp;').replace(/</g, '&lt;').replace(/>/g, '&gt;')
+    .replace(/"/g, '&quot;').replace(/'/g, '&#39;');
+}
+
+function color(value) {
+  var level = CHARS.indexOf(value);
+  if (level < 0) {return '#ffffff';}
+  var shade = Math.round(255 - level / (CHARS.length - 1) * 200);
+  return 'rgb(' + shade + ',' + shade + ',255)';
+}
+
+function show(page) {
+  var table = document.getElementById('heatmap');
+  var header = '<tr><th></th>' + index.columns.map(function (column) {
+    return '<th class="column"><div>' + escape(column) + '</div></th>';
+  }).join('') + '</tr>';
+  var rows = [];
+  var group = null;
+  for (var i = 0; i < page.genomes.length; i++) {
+    if (page.groups[i] !== group) {
+      group = page.groups[i];
+      rows.push('<tr class="group"><td colspan="' + (index.columns.length + 1) + '">' + escape(group) + '</td></tr>');
+    }
+    var cells = page.values.map(function (column, j) {
+      return '<td class="cell" title="' + escape(index.columns[j]) + '" style="background:' + color(column[i]) +
+        '"></td>';
+    });
+    rows.push('<tr><td class="genome">' + escape(page.genomes[i]) + '</td>' + cells.join('') + '</tr>');
+  }
+  table.innerHTML = header + rows.join('');
+  document.getElementById('page').textContent = 'page ' + (current + 1) + ' of ' + index.pages.length;
+}
+
+function load(page_number) {
+  current = Math.max(0, Math.min(page_number, index.pages.length - 1));
+  if (pages[current]) {show(pages[current]); return;}
+  fetch(HEATMAP_DIR + '/' + index.pages[current].file).then(function (response) {return response.json();})
+    .then(function (page) {pages[current] = page; show(page);});
+}
+
+var CHARS = '';
+var HEATMAP_DIR = '%(heatmap_dir)s';
+fetch(HEATMAP_DIR + '/index.json').then(function (response) {return response.json();}).then(function (data) {
+  index = data;
+  CHARS = data.chars;
+  document.getElementById('altair').innerHTML = data.altair.map(function (page, i) {
+    return '<a href="' + escape(page) + '">altair ' + (i + 1) + '</a>';
+  }).join(' ');
+  var select = document.getElementById('group');
+  select.innerHTML = data.groups.map(function (group) {
+    return '<option value="' + escape(group.page) + '">' + escape(group.name) + ' (' + group.genomes +
+      ')</option>';
+  }).join('');
+  select.onchange = function () {load(parseInt(select.value));};
+  document.getElementById('previous').onclick = function () {load(current - 1);};
+  document.getElementById('next').onclick = function () {load(current + 1);};
+  load(0);
+});
+</script>
+</body>
+</html>
+'''
+
+
+def get_genome_groups(annotations_loc, groupby_column='fasta'):
+    # phylum of each genome where DRAM was given a gtdb taxonomy, genomes without one share a group
+    columns = pd.read_csv(annotations_loc, sep='\t', nrows=0).columns
+    if 'bin_taxonomy' not in columns:
+        return dict()
+    taxonomy = pd.read_csv(annotations_loc, sep='\t', usecols=[groupby_column, 'bin_taxonomy'])
+    taxonomy = taxonomy.drop_duplicates(groupby_column).set_index(groupby_column)['bin_taxonomy']
+    return {genome: ';'.join(str(taxa).split(';')[:2]) for genome, taxa in taxonomy.items() if isinstance(taxa, str)}
+
+
+def order_genomes(values, genomes, genome_groups):
+    # genomes grouped, then within a group ordered along the first principal component so genomes with similar
+    # products sit next to each other
+    groups = pd.Series([genome_groups.get(i, 'Unclassified') for i in genomes])
+    order = list()
+    for group in sorted(set(groups)):
+        members = np.flatnonzero((groups == group).values)
+        group_values = values[members]
+        if len(members) > 2:
+            centered = group_values - group_values.mean(axis=0)
+            component = np.linalg.svd(centered, full_matrices=False)[2][0]
+            members = members[np.argsort(centered @ component, kind='stable')]
+        order.extend(members)
+    return np.array(order, dtype=int), groups.values
+
+
+def _encode_column(column):
+    levels = np.rint(np.nan_to_num(column, nan=-1) * HEATMAP_LEVELS).astype(int)
+    return ''.join(HEATMAP_CHARS[i] if i >= 0 else '.' for i in levels)
+
+
+def write_product_heatmap(distill_output_dir, genome_groups=None, report_dir=None, threshold=PRODUCT_HEATMAP_GENOMES,
+                          page_size=HEATMAP_PAGE_SIZE):
+    # replace product.html with a viewer over a page per file heatmap when there are too many genomes for altair,
+    # report_dir is where product.html is served from once the report is made
+    product = pd.read_csv(os.path.join(distill_output_dir, 'product.tsv'), sep='\t', index_col=0)
+    if len(product) <= threshold:
+        return False
+    if genome_groups is None:
+        genome_groups = dict()
+    if report_dir is None:
+        report_dir = distill_output_dir
+    # coverage is already a fraction and functions are present or not
+    values = product.apply(lambda column: column.map({True: 1.0, False: 0.0, 'True': 1.0, 'False': 0.0})
+                           if column.dtype == object or column.dtype == bool else column).astype(float).values
+    genomes = [str(i) for i in product.index]
+    order, groups = order_genomes(np.nan_to_num(values), genomes, genome_groups)
+    heatmap_dir = os.path.join(distill_output_dir, HEATMAP_DIR)
+    os.mkdir(heatmap_dir)
+    # DRAM's own altair heatmaps when it split them into pages
+    altair_pages = sorted((i for i in os.listdir(distill_output_dir) if i.startswith('product_') and
+                           i.endswith('.html')), key=lambda i: int(i[len('product_'):-len('.html')]))
+    index = {'chars': HEATMAP_CHARS, 'columns': [str(i) for i in product.columns], 'pages': list(),
+             'groups': list(),
+             'altair': [os.path.relpath(os.path.join(distill_output_dir, i), report_dir) for i in altair_pages]}
+    for page_number, start in enumerate(range(0, len(order), page_size)):
+        page_order = order[start:start + page_size]
+        page_file = 'page_%s.json' % page_number
+        with open(os.path.join(heatmap_dir, page_file), 'w') as f:
+            json.dump({'genomes': [genomes[i] for i in page_order], 'groups': [groups[i] for i in page_order],
+                       'values': [_encode_column(values[page_order, j]) for j in range(values.shape[1])]},
+                      f, separators=(',', ':'))
+        index['pages'].append({'file': page_file})
+    ordered_groups = [groups[i] for i in order]
+    group_sizes = Counter(ordered_groups)
+    for position, group in enumerate(ordered_groups):
+        if position == 0 or group != ordered_groups[position - 1]:
+            index['groups'].append({'name': group, 'page': position // page_size, 'genomes': group_sizes[group]})
+    with open(os.path.join(heatmap_dir, 'index.json'), 'w') as f:
+        json.dump(index, f, separators=(',', ':'))
+    with open(os.path.join(distill_output_dir, 'product.html'), 'w') as f:
+        f.write(PRODUCT_VIEWER % {'heatmap_dir': os.path.relpath(heatmap_dir, report_dir)})
+    return True
@@ -1,22 +1,229 @@
 import os
+import re
+import gzip
+import time
+import queue
+import logging
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+import requests
+
+from installed_clients.baseclient import ServerError
 from installed_clients.KBaseReportClient import KBaseReport
 from installed_clients.DataFileUtilClient import DataFileUtil
 
+from .dram_util import assembly_stats
+
+SAVE_QUEUE_SIZE = 2
+# a genome that fails to save is retried this many times, waiting this long before the first retry and twice as
+# long before each one after
+SAVE_RETRIES = 3
+SAVE_BACKOFF_SECONDS = 30
+# server errors reporting a problem with the genome itself, these fail the same way however often they are retried
+VALIDATION_ERROR = re.compile(r'validat|invalid|failed type checking|illegal|does not exist|not found|permission',
+                              re.IGNORECASE)
+# AssemblySet members are fetched this many to a get_fastas call, with this many calls running at once
+ASSEMBLY_BATCH_SIZE = 10
+DOWNLOAD_WORKERS = 4
+GUNZIP_BUFFER_SIZE = 1024 ** 2
+# DRAM outputs distill reads, annotations is required
+DISTILL_INPUTS = ('annotations', 'trnas', 'rrnas')
+# genome metadata keys that give the number of protein coding genes, newest first
+GENE_COUNT_METADATA = ('Number of Protein Encoding Genes', 'Number of CDS')
+
+
+def _set_save_status(statuses, name, attempts, ref=None, error=None):
+    statuses[name] = {'status': 'saved' if error is None else 'failed', 'attempts': attempts, 'ref': ref,
+                      'error': None if error is None else str(error).strip()}
+
+
+def _is_transient(error):
+    # dropped connections, timeouts and 5xx responses, baseclient raises a ServerError for those, that do not say the
+    # request itself was bad
+    if isinstance(error, (requests.ConnectionError, requests.Timeout, ConnectionError, TimeoutError)):
+        return True
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and error.response.status_code >= 500
+    if isinstance(error, ServerError):
+        return VALIDATION_ERROR.search('%s %s' % (error.message, error.data)) is None
+    return False
+
+
+def _save_failed(statuses, failed, name, item, attempts, error):
+    # only a transient failure is set aside to be retried
+    _set_save_status(statuses, name, attempts, error=error)
+    if _is_transient(error):
+        logging.warning('Saving genome %s failed on attempt %s, it will be retried: %s' % (name, attempts, error))
+        failed.append((name, item))
+    else:
+        logging.warning('Saving genome %s failed on attempt %s: %s' % (name, attempts, error))
+
+
+def _retry_saves(save, failed, statuses, on_saved, retries, backoff):
+    # saves that failed are retried once the other genomes are done, waiting twice as long before each round
+    for retry in range(retries):
+        if len(failed) == 0:
+            break
+        time.sleep(backoff * 2 ** retry)
+        still_failed = list()
+        for name, item in failed:
+            try:
+                ref = save(item)
+            except Exception as e:
+                _save_failed(statuses, still_failed, name, item, retry + 2, e)
+                continue
+            _set_save_status(statuses, name, retry + 2, ref=ref)
+            if on_saved is not None:
+                on_saved(name, ref)
+        failed = still_failed
+
+
+def save_genomes(genome_util, genome_objects, queue_size=SAVE_QUEUE_SIZE, saved=None, on_saved=None,
+                 retries=SAVE_RETRIES, backoff=SAVE_BACKOFF_SECONDS):
+    # genomes are built by the caller's iterator while a worker saves them, the bounded queue caps how many
+    # genome objects are held in memory at once, a genome that fails to save is set aside for retries so the rest
+    # are still saved, genomes in saved are kept as they are and on_saved is called with each new one
+    save_queue = queue.Queue(maxsize=queue_size)
+    statuses = dict()
+    for name, ref in (saved or dict()).items():
+        _set_save_status(statuses, name, 0, ref=ref)
+    failed = list()
+
+    def save(genome_object):
+        info = genome_util.save_one_genome(genome_object)["info"]
+        return '%s/%s/%s' % (info[6], info[0], info[4])
+
+    def save_worker():
+        while True:
+            genome_object = save_queue.get()
+            if genome_object is None:
+                break
+            try:
+                ref = save(genome_object)
+            except Exception as e:
+                _save_failed(statuses, failed, genome_object["name"], genome_object, 1, e)
+                continue
+            _set_save_status(statuses, genome_object["name"], 1, ref=ref)
+            if on_saved is not None:
+                on_saved(genome_object["name"], ref)
+
+    worker = threading.Thread(target=save_worker, daemon=True)
+    worker.start()
+    try:
+        for genome_object in genome_objects:
+            if genome_object["name"] in statuses:
+                continue
+            save_queue.put(genome_object)
+    finally:
+        save_queue.put(None)
+        worker.join()
+    _retry_saves(save, failed, statuses, on_saved, retries, backoff)
+    return statuses
+
+
+def save_genomes_from_gff(genome_util, gff_locs, assembly_ref_dict, assemblies, workspace, dram_sufix='DRAM',
+                          saved=None, on_saved=None, retries=SAVE_RETRIES, backoff=SAVE_BACKOFF_SECONDS):
+    # GenomeFileUtil reads the files itself so no genome object is built in this process
+    statuses = dict()
+    for name, ref in (saved or dict()).items():
+        _set_save_status(statuses, name, 0, ref=ref)
+    failed = list()
+
+    def save(fasta_name):
+        assembly_ref = assembly_ref_dict[fasta_name]
+        return genome_util.fasta_gff_to_genome({
+            'fasta_file': {'path': assemblies[assembly_ref]['paths'][0]},
+            'gff_file': {'path': gff_locs[fasta_name]},
+            'genome_name': '_'.join([fasta_name, dram_sufix]),
+            'workspace_name': workspace,
+            'source': 'DRAM annotation pipeline',
+            'generate_missing_genes': 1,
+            'existing_assembly_ref': assembly_ref
+        })['genome_ref']
+
+    for fasta_name in gff_locs:
+        genome_name = '_'.join([fasta_name, dram_sufix])
+        if genome_name in statuses:
+            continue
+        try:
+            ref = save(fasta_name)
+        except Exception as e:
+            _save_failed(statuses, failed, genome_name, fasta_name, 1, e)
+            continue
+        _set_save_status(statuses, genome_name, 1, ref=ref)
+        if on_saved is not None:
+            on_saved(genome_name, ref)
+    _retry_saves(save, failed, statuses, on_saved, retries, backoff)
+    return statuses
+
+
+def get_saved_refs(statuses):
+    # refs of the genomes that were saved, a run where none were is a failure
+    genome_refs = {name: i['ref'] for name, i in statuses.items() if i['status'] == 'saved'}
+    if len(genome_refs) == 0 and len(statuses) > 0:
+        raise ValueError('No genome could be saved, the first error was: %s'
+                         % next(i['error'] for i in statuses.values()))
+    return genome_refs
+
+
+def write_genome_statuses(statuses, chunk_counts, output_loc):
+    # a row per genome of the save stage with the number of ontology event chunks added to it
+    with open(output_loc, 'w') as f:
+        f.write('genome\tstatus\tattempts\tgenome_ref\tontology_event_chunks\terror\n')
+        for name, status in sorted(statuses.items()):
+            f.write('%s\t%s\t%s\t%s\t%s\t%s\n' % (name, status['status'], status['attempts'], status['ref'] or '',
+                                                 chunk_counts.get(name, 0),
+                                                 (status['error'] or '').replace('\t', ' ').replace('\n', ' ')))
+    failed = sorted(name for name, status in statuses.items() if status['status'] == 'failed')
+    message = 'Saved %s of %s genomes.' % (len(statuses) - len(failed), len(statuses))
+    if len(failed) > 0:
+        message += ' These genomes could not be saved, see genome_status.tsv: %s' % ', '.join(failed)
+    return message
+
+
+def submit_ontology_events(anno_api, ontology_events, submitted=None, on_submitted=None):
+    # events are added in order, a genome's later chunks to the version its previous chunk saved so none are lost,
+    # submitted has the chunks an earlier attempt already added and on_submitted is called with each new one
+    if submitted is None:
+        submitted = dict()
+    output_refs = {genome_name: i['output_ref'] for genome_name, i in submitted.items()}
+    chunk_counts = {genome_name: i['chunks'] for genome_name, i in submitted.items()}
+    skip_chunks = dict(chunk_counts)
+    for ontology_event in ontology_events:
+        genome_name = ontology_event['output_name']
+        if skip_chunks.get(genome_name, 0) > 0:
+            skip_chunks[genome_name] -= 1
+            continue
+        if genome_name in output_refs:
+            ontology_event = dict(ontology_event, input_ref=output_refs[genome_name])
+        output_refs[genome_name] = anno_api.add_annotation_ontology_events(ontology_event)['output_ref']
+        chunk_counts[genome_name] = chunk_counts.get(genome_name, 0) + 1
+        if on_submitted is not None:
+            on_submitted(genome_name, output_refs[genome_name])
+    for genome_name, chunks in chunk_counts.items():
+        logging.info('Ontology events for %s were added in %s chunk(s)' % (genome_name, chunks))
+    return output_refs, chunk_counts
+
 
 def generate_product_report(callback_url, workspace_name, output_dir, product_html_loc, output_files,
-                            output_objects=None):
+                            output_objects=None, message=None):
     # check params
     if output_objects is None:
         output_objects = []
+    report_message = 'Here are the results from your DRAM run.'
+    if message is not None:
+        report_message = '%s %s' % (report_message, message)
 
     # setup utils
     datafile_util = DataFileUtil(callback_url)
     report_util = KBaseReport(callback_url)
 
-    # move html to main directory uploaded to shock so kbase can find it
+    # move html to main directory uploaded to shock so kbase can find it, a resumed run may have moved it already
     html_file = os.path.join(output_dir, 'product.html')
-    os.rename(product_html_loc, html_file)
+    if os.path.exists(product_html_loc):
+        os.rename(product_html_loc, html_file)
     report_shock_id = datafile_util.file_to_shock({
         'file_path': output_dir,
         'pack': 'zip'
@@ -27,7 +234,7 @@ def generate_product_report(callback_url, workspace_name, output_dir, product_ht
         'label': os.path.basename(html_file),
         'description': 'DRAM product.'
     }]
-    report = report_util.create_extended_report({'message': 'Here are the results from your DRAM run.',
+    report = report_util.create_extended_report({'message': report_message,
                                                  'workspace_name': workspace_name,
                                                  'html_links': html_report,
                                                  'direct_html_link_index': 0,
@@ -36,3 +243,128 @@ def generate_product_report(callback_url, workspace_name, output_dir, product_ht
                                                  'objects_created': output_objects,
                                                  })
     return report
+
+
+def _file_link_source(file_link):
+    if file_link.get('handle'):
+        return {'handle_id': file_link['handle']}
+    return {'shock_id': file_link['URL'].rstrip('/').split('/')[-1]}
+
+
+def get_distill_inputs(ws_client, datafile_util, params, input_dir):
+    # annotations.tsv and the optional trnas.tsv and rrnas.tsv of an earlier run, each from a Shock node or handle id
+    # or else from the file links of that run's report
+    file_links = dict()
+    if params.get('report_ref'):
+        report = ws_client.get_objects2({'objects': [{'ref': params['report_ref'],
+                                                      'included': ['/file_links']}]})['data'][0]['data']
+        file_links = {i['name']: i for i in report.get('file_links', [])}
+    input_locs = dict()
+    for name in DISTILL_INPUTS:
+        file_name = '%s.tsv' % name
+        if params.get('%s_shock_id' % name):
+            source = {'shock_id': params['%s_shock_id' % name]}
+        elif params.get('%s_handle_id' % name):
+            source = {'handle_id': params['%s_handle_id' % name]}
+        elif file_name in file_links:
+            source = _file_link_source(file_links[file_name])
+        else:
+            input_locs[name] = None
+            continue
+        # report file links are uploaded zipped, so unpack into a directory of their own
+        file_dir = os.path.join(input_dir, name)
+        os.makedirs(file_dir)
+        file_loc = datafile_util.shock_to_file(dict(source, file_path=file_dir, unpack='unpack'))['file_path']
+        unpacked_loc = os.path.join(file_dir, file_name)
+        input_locs[name] = unpacked_loc if os.path.exists(unpacked_loc) else file_loc
+    if input_locs['annotations'] is None:
+        raise ValueError('Pass in annotations_shock_id, annotations_handle_id or the report_ref of a DRAM run')
+    return input_locs
+
+
+def _metadata_size(object_info):
+    metadata = object_info[10] or dict()
+    size = {'name': object_info[1], 'bases': int(metadata.get('Size', 0))}
+    for key in GENE_COUNT_METADATA:
+        if metadata.get(key):
+            size['genes'] = int(metadata[key])
+            break
+    return size
+
+
+def member_ref_path(set_ref, member_ref):
+    # members are read through the set, so a user who can read the set but not a member's workspace still can
+    return '%s;%s' % (set_ref, member_ref)
+
+
+def get_input_sizes(ws_client, input_ref):
+    # bases, and genes where the metadata has them, of every assembly or genome behind an input without downloading
+    # any sequence
+    object_info = ws_client.get_object_info3({'objects': [{'ref': input_ref}], 'includeMetadata': 1})['infos'][0]
+    object_type = object_info[2]
+    if 'BinnedContigs' in object_type:
+        bins = ws_client.get_objects2({'objects': [{'ref': input_ref,
+                                                    'included': ['/bins/[*]/bid', '/bins/[*]/sum_contig_len']}]
+                                       })['data'][0]['data']['bins']
+        return [{'name': i['bid'], 'bases': int(i['sum_contig_len'])} for i in bins]
+    if 'Set' in object_type:
+        set_data = ws_client.get_objects2({'objects': [{'ref': input_ref}]})['data'][0]['data']
+        if 'elements' in set_data:
+            member_refs = [i['ref'] for i in set_data['elements'].values()]
+        else:
+            member_refs = [i['ref'] for i in set_data['items']]
+        return [_metadata_size(i) for i in ws_client.get_object_info3({
+            'objects': [{'ref': member_ref_path(input_ref, i)} for i in member_refs], 'includeMetadata': 1})['infos']]
+    return [_metadata_size(object_info)]
+
+
+def get_assembly_refs(ws_client, input_ref):
+    # members of an AssemblySet so they can be fetched in batches, any other input is fetched as one
+    object_type = ws_client.get_object_info3({'objects': [{'ref': input_ref}]})['infos'][0][2]
+    if 'AssemblySet' not in object_type:
+        return [input_ref]
+    set_data = ws_client.get_objects2({'objects': [{'ref': input_ref}]})['data'][0]['data']
+    return [member_ref_path(input_ref, i['ref']) for i in set_data['items']]
+
+
+def gunzip_fasta(fasta_loc):
+    # decompress a buffer at a time next to the download and drop the compressed copy
+    output_loc = fasta_loc[:-len('.gz')]
+    with gzip.open(fasta_loc, 'rb') as f_in, open(output_loc, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out, GUNZIP_BUFFER_SIZE)
+    os.remove(fasta_loc)
+    return output_loc
+
+
+def _fetch_assemblies(assembly_util, assembly_refs):
+    # keyed by the member's own ref, as get_fastas of the whole set returned them, which is what genomes record as
+    # their assembly_ref
+    assemblies = {assembly_ref.split(';')[-1]: assembly_data
+                  for assembly_ref, assembly_data in assembly_util.get_fastas({'ref_lst': assembly_refs}).items()}
+    for assembly_data in assemblies.values():
+        if assembly_data['paths'][0].endswith('.gz'):
+            assembly_data['paths'][0] = gunzip_fasta(assembly_data['paths'][0])
+        # build_genome uses these in place of reading the assembly again
+        assembly_data['stats'] = assembly_stats(assembly_data['paths'][0])
+    return assemblies
+
+
+class AssemblyDownloads:
+    # get_fastas calls for batches of assemblies run in the background so the caller can set up while they
+    # download, each batch is decompressed and measured as soon as it arrives
+    def __init__(self, assembly_util, assembly_refs, batch_size=ASSEMBLY_BATCH_SIZE, workers=DOWNLOAD_WORKERS):
+        batches = [assembly_refs[i:i + batch_size] for i in range(0, len(assembly_refs), batch_size)]
+        self.executor = ThreadPoolExecutor(max(1, min(workers, len(batches))))
+        self.futures = [self.executor.submit(_fetch_assemblies, assembly_util, batch) for batch in batches]
+
+    def result(self):
+        # same mapping of assembly ref to assembly data a single get_fastas call returns
+        assemblies = dict()
+        try:
+            for future in self.futures:
+                assemblies.update(future.result())
+        finally:
+            for future in self.futures:
+                future.cancel()
+            self.executor.shutdown(wait=True)
+        return assemblies
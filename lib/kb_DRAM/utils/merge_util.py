@@ -0,0 +1,178 @@
+import os
+import heapq
+import shutil
+import sqlite3
+
+# DRAM sorts annotations.tsv by these, so each input is already in merge order
+ANNOTATION_SORT_COLUMNS = ('fasta', 'scaffold', 'gene_position')
+GENE_ID_BATCH = 100000
+
+
+def _read_header(table_loc):
+    with open(table_loc) as f:
+        return f.readline().rstrip('\n').split('\t')
+
+
+def _merged_columns(table_locs):
+    # columns of every input in the order they are first seen, DRAM only adds columns for databases it used
+    columns = list()
+    for table_loc in table_locs:
+        for column in _read_header(table_loc):
+            if column not in columns:
+                columns.append(column)
+    return columns
+
+
+def _aligned_lines(table_loc, columns):
+    # lines of a table with its fields moved to the merged columns, blank where the input lacks a column
+    with open(table_loc) as f:
+        header = f.readline().rstrip('\n').split('\t')
+        if header == columns:
+            for line in f:
+                yield line if line.endswith('\n') else line + '\n'
+            return
+        positions = [header.index(column) if column in header else None for column in columns]
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            yield '\t'.join('' if i is None else fields[i] for i in positions) + '\n'
+
+
+def _annotation_sort_key(columns):
+    positions = [columns.index(column) for column in ANNOTATION_SORT_COLUMNS if column in columns]
+    gene_position = columns.index('gene_position') if 'gene_position' in columns else None
+
+    def sort_key(line):
+        fields = line.split('\t', max(positions) + 1) if len(positions) > 0 else []
+        return tuple(int(fields[i] or -1) if i == gene_position else fields[i] for i in positions)
+    return sort_key
+
+
+class _GeneIds:
+    # gene ids seen so far, in sqlite so a collision check does not hold every id in memory
+    def __init__(self, index_loc):
+        if os.path.exists(index_loc):
+            os.remove(index_loc)
+        self.index_loc = index_loc
+        self.conn = sqlite3.connect(index_loc)
+        self.conn.execute('CREATE TABLE genes (id TEXT PRIMARY KEY, input TEXT)')
+        self.batch = list()
+
+    def add(self, gene_id, input_dir):
+        self.batch.append((gene_id, input_dir))
+        if len(self.batch) >= GENE_ID_BATCH:
+            self.flush()
+
+    def flush(self):
+        try:
+            with self.conn:
+                self.conn.executemany('INSERT INTO genes VALUES (?, ?)', self.batch)
+        except sqlite3.IntegrityError:
+            # find which id it was, the failed batch was rolled back
+            for gene_id, input_dir in self.batch:
+                existing = self.conn.execute('SELECT input FROM genes WHERE id = ?', (gene_id,)).fetchone()
+                if existing is not None:
+                    raise ValueError('Gene id %s is in both %s and %s, DRAM outputs with colliding gene ids can '
+                                     'not be merged' % (gene_id, existing[0], input_dir))
+                self.conn.execute('INSERT INTO genes VALUES (?, ?)', (gene_id, input_dir))
+        self.batch = list()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+        os.remove(self.index_loc)
+
+
+def merge_annotation_tables(input_dirs, output_loc, gene_index_loc):
+    # k-way merge of already sorted annotations.tsv files, one line per input in memory at a time
+    annotations_locs = [os.path.join(i, 'annotations.tsv') for i in input_dirs]
+    columns = _merged_columns(annotations_locs)
+    sort_key = _annotation_sort_key(columns)
+    gene_ids = _GeneIds(gene_index_loc)
+
+    def checked_lines(input_dir, annotations_loc):
+        for line in _aligned_lines(annotations_loc, columns):
+            gene_ids.add(line.split('\t', 1)[0], input_dir)
+            yield line
+
+    try:
+        with open(output_loc, 'w') as f:
+            f.write('\t'.join(columns) + '\n')
+            f.writelines(heapq.merge(*[checked_lines(i, j) for i, j in zip(input_dirs, annotations_locs)],
+                                     key=sort_key))
+    finally:
+        gene_ids.close()
+    return output_loc
+
+
+def merge_tables(table_locs, output_loc):
+    # tables with a header, like trnas.tsv and rrnas.tsv, concatenated under the merged columns
+    columns = _merged_columns(table_locs)
+    with open(output_loc, 'w') as f:
+        f.write('\t'.join(columns) + '\n')
+        for table_loc in table_locs:
+            f.writelines(_aligned_lines(table_loc, columns))
+    return output_loc
+
+
+def concatenate_files(file_locs, output_loc):
+    with open(output_loc, 'wb') as f:
+        for file_loc in file_locs:
+            with open(file_loc, 'rb') as i:
+                shutil.copyfileobj(i, f)
+    return output_loc
+
+
+def merge_gffs(gff_locs, output_loc):
+    # one gff version pragma at the top, the rest of every file as is
+    with open(output_loc, 'w') as f:
+        f.write('##gff-version 3\n')
+        for gff_loc in gff_locs:
+            with open(gff_loc) as i:
+                for line in i:
+                    if not line.startswith('##gff-version'):
+                        f.write(line)
+    return output_loc
+
+
+def merge_genbanks(input_dirs, output_dir):
+    # every genbank file goes in one genbank directory, a scaffolds.gbk is named after the directory it came from
+    gbk_locs = list()
+    for input_dir in input_dirs:
+        gbks_loc = os.path.join(input_dir, 'genbank')
+        if os.path.isdir(gbks_loc):
+            gbk_locs += [(os.path.join(gbks_loc, i), i) for i in sorted(os.listdir(gbks_loc))]
+        elif os.path.exists(os.path.join(input_dir, 'scaffolds.gbk')):
+            gbk_locs.append((os.path.join(input_dir, 'scaffolds.gbk'),
+                             '%s.gbk' % os.path.basename(os.path.normpath(input_dir))))
+    if len(gbk_locs) == 0:
+        return None
+    if len(gbk_locs) == 1 and os.path.basename(gbk_locs[0][0]) == 'scaffolds.gbk':
+        return shutil.copyfile(gbk_locs[0][0], os.path.join(output_dir, 'scaffolds.gbk'))
+    gbks_dir = os.path.join(output_dir, 'genbank')
+    os.mkdir(gbks_dir)
+    for gbk_loc, name in gbk_locs:
+        if os.path.exists(os.path.join(gbks_dir, name)):
+            raise ValueError('Genbank file %s is in more than one DRAM output' % name)
+        shutil.copyfile(gbk_loc, os.path.join(gbks_dir, name))
+    return gbks_dir
+
+
+def merge_dram_outputs(input_dirs, output_dir):
+    # combine DRAM output directories into one laid out like a single annotate run, as get_annotation_files
+    # expects it, streaming every file rather than loading it
+    os.mkdir(output_dir)
+    merge_annotation_tables(input_dirs, os.path.join(output_dir, 'annotations.tsv'),
+                            os.path.join(output_dir, 'gene_ids.sqlite'))
+    for name in ('genes.fna', 'genes.faa', 'scaffolds.fna', 'annotate.log'):
+        file_locs = [os.path.join(i, name) for i in input_dirs if os.path.exists(os.path.join(i, name))]
+        if len(file_locs) > 0:
+            concatenate_files(file_locs, os.path.join(output_dir, name))
+    gff_locs = [os.path.join(i, 'genes.gff') for i in input_dirs if os.path.exists(os.path.join(i, 'genes.gff'))]
+    if len(gff_locs) > 0:
+        merge_gffs(gff_locs, os.path.join(output_dir, 'genes.gff'))
+    for name in ('trnas.tsv', 'rrnas.tsv'):
+        table_locs = [os.path.join(i, name) for i in input_dirs if os.path.exists(os.path.join(i, name))]
+        if len(table_locs) > 0:
+            merge_tables(table_locs, os.path.join(output_dir, name))
+    merge_genbanks(input_dirs, output_dir)
+    return output_dir
@@ -0,0 +1,124 @@
+import os
+import sys
+import time
+import pstats
+import logging
+import tarfile
+import cProfile
+import threading
+from collections import Counter
+
+# seconds between samples of every thread's stack
+SAMPLE_INTERVAL = 0.01
+# functions by cumulative time written to the job timeline
+PROFILE_TOP_FUNCTIONS = 20
+# the helpers profiled on their own
+HELPER_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dram_util.py')
+
+
+def frame_label(code):
+    return '%s:%s' % (os.path.basename(code.co_filename), code.co_name)
+
+
+class StackSampler(threading.Thread):
+    # samples the stack of every other thread at a fixed interval and counts them as collapsed stacks, a frame per
+    # ';' outermost first, which flamegraph.pl and speedscope read as they are
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.stacks = Counter()
+        self.helper_stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        thread_names = dict()
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.ident:
+                    continue
+                if thread_id not in thread_names:
+                    thread_names = {i.ident: i.name for i in threading.enumerate()}
+                stack = list()
+                helper_start = None
+                while frame is not None:
+                    stack.append(frame_label(frame.f_code))
+                    if frame.f_code.co_filename == HELPER_FILE:
+                        helper_start = len(stack)
+                    frame = frame.f_back
+                stack.reverse()
+                self.stacks[';'.join([thread_names.get(thread_id, str(thread_id))] + stack)] += 1
+                # the same sample from the outermost dram_util frame in, so each helper gets a flame graph of its own
+                if helper_start is not None:
+                    self.helper_stacks[';'.join(stack[len(stack) - helper_start:])] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def write_collapsed(stacks, collapsed_loc):
+    with open(collapsed_loc, 'w') as f:
+        for stack, count in sorted(stacks.items()):
+            f.write('%s %s\n' % (stack, count))
+
+
+def write_helper_stats(stats, helper_stats_loc):
+    # calls, own and cumulative seconds of each dram_util function as cProfile measured them
+    with open(helper_stats_loc, 'w') as f:
+        f.write('function\tcalls\ttotal_seconds\tcumulative_seconds\n')
+        helpers = [(func, stat) for func, stat in stats.stats.items() if func[0] == HELPER_FILE]
+        for (_, line, name), (_, calls, total, cumulative, _) in sorted(helpers, key=lambda i: i[1][3],
+                                                                        reverse=True):
+            f.write('%s:%s\t%s\t%.3f\t%.3f\n' % (name, line, calls, total, cumulative))
+
+
+class RunProfiler:
+    # cProfile over the thread that runs an Impl method plus sampled stacks of every thread, DRAM's own tools run as
+    # child processes and show up only as the time spent waiting on them
+    def __init__(self, profile_dir, name, interval=SAMPLE_INTERVAL):
+        self.profile_dir = profile_dir
+        self.name = name
+        self.profile = cProfile.Profile()
+        self.sampler = StackSampler(interval)
+        self.start_time = None
+        self.running = False
+
+    def start(self):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        self.start_time = time.time()
+        self.running = True
+        self.sampler.start()
+        self.profile.enable()
+        return self
+
+    def stop(self):
+        self.running = False
+        self.profile.disable()
+        self.sampler.stop()
+        stats = pstats.Stats(self.profile)
+        stats_loc = os.path.join(self.profile_dir, '%s.pstats' % self.name)
+        stats.dump_stats(stats_loc)
+        with open(os.path.join(self.profile_dir, '%s_cumulative.txt' % self.name), 'w') as f:
+            pstats.Stats(stats_loc, stream=f).sort_stats('cumulative').print_stats()
+        write_collapsed(self.sampler.stacks, os.path.join(self.profile_dir, '%s.collapsed' % self.name))
+        write_collapsed(self.sampler.helper_stacks, os.path.join(self.profile_dir, 'dram_util.collapsed'))
+        write_helper_stats(stats, os.path.join(self.profile_dir, 'dram_util_functions.tsv'))
+        self.log_summary(stats)
+        profile_loc = os.path.join(self.profile_dir, 'profile.tar.gz')
+        with tarfile.open(profile_loc, 'w:gz') as tar:
+            for name in sorted(os.listdir(self.profile_dir)):
+                if name != os.path.basename(profile_loc):
+                    tar.add(os.path.join(self.profile_dir, name), arcname=name)
+        return {'path': profile_loc,
+                'name': 'profile.tar.gz',
+                'label': 'profile.tar.gz',
+                'description': 'cProfile stats, collapsed stacks for flame graphs and dram_util helper timings of '
+                               'this run'}
+
+    def log_summary(self, stats):
+        logging.info('Profiled %s for %.1f seconds, %s stack samples' % (self.name, time.time() - self.start_time,
+                                                                        sum(self.sampler.stacks.values())))
+        top = sorted(stats.stats.items(), key=lambda i: i[1][3], reverse=True)[:PROFILE_TOP_FUNCTIONS]
+        for (file_name, line, name), (_, calls, total, cumulative, _) in top:
+            logging.info('Profile: %s:%s(%s)\t%s\t%.3f\t%.3f' % (os.path.basename(file_name), line, name, calls,
+                                                                total, cumulative))
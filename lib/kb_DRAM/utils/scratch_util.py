@@ -0,0 +1,137 @@
+import os
+import re
+import json
+import time
+import shutil
+import logging
+import resource
+import tempfile
+
+
+def path_bytes(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            file_loc = os.path.join(root, name)
+            if not os.path.islink(file_loc):
+                total += os.path.getsize(file_loc)
+    return total
+
+
+class JobScratch:
+    # a scratch directory of its own for each run, so runs never share file names, with the bytes it holds checked
+    # against a budget and intermediates removed once no later stage needs them, runs given the same job key share
+    # one so a failed run can be resumed
+    def __init__(self, shared_folder, prefix, budget=None, job_key=None):
+        if job_key is None:
+            self.root = tempfile.mkdtemp(prefix='%s_' % prefix, dir=shared_folder)
+        else:
+            self.root = os.path.join(shared_folder, '%s_%s' % (prefix, re.sub(r'[^\w.-]', '_', job_key)))
+            os.makedirs(self.root, exist_ok=True)
+        self.budget = budget
+        self.stage_start = time.time()
+        self.peak_bytes = 0
+        self.released_bytes = 0
+
+    def path(self, *names):
+        return os.path.join(self.root, *names)
+
+    def mkdir(self, *names):
+        path = self.path(*names)
+        os.makedirs(path)
+        return path
+
+    def checkpoint(self, stage):
+        used_bytes = path_bytes(self.root)
+        self.peak_bytes = max(self.peak_bytes, used_bytes)
+        # DRAM's tools run as child processes, so the peak is the larger of this process and its children
+        peak_memory_mb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                             resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+        # seconds, peak memory MB and scratch MB as data/stage_timings.tsv records them for the resource model
+        logging.info('Stage timing: %s\t%.1f\t%.0f\t%.1f' % (stage, time.time() - self.stage_start, peak_memory_mb,
+                                                           used_bytes / 1024 ** 2))
+        self.stage_start = time.time()
+        if self.budget is not None and used_bytes > self.budget:
+            raise ValueError('Scratch for this run holds %s bytes after %s which is over the budget of %s bytes'
+                             % (used_bytes, stage, self.budget))
+        return used_bytes
+
+    def check_projected(self, stage, projected_bytes):
+        # before a stage, so a run that is expected to go over its budget fails before doing the stage's work
+        if self.budget is None:
+            return
+        used_bytes = path_bytes(self.root)
+        if used_bytes + projected_bytes > self.budget:
+            raise ValueError('Scratch for this run holds %s bytes and %s is expected to add %s bytes which is over '
+                             'the budget of %s bytes' % (used_bytes, stage, projected_bytes, self.budget))
+
+    def release(self, *paths):
+        # remove intermediates, files or directories, that later stages do not read
+        for path in paths:
+            if path is None or not os.path.exists(path):
+                continue
+            self.released_bytes += path_bytes(path)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+    def cleanup(self):
+        logging.info('Scratch peaked at %s bytes, %s bytes of intermediates were removed during the run'
+                     % (self.peak_bytes, self.released_bytes))
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+class StageManifest:
+    # the stages a run completed, the outputs they left, the objects it saved and the ontology events it added,
+    # written after every change so a run with the same job key can skip what is already done
+    def __init__(self, manifest_loc, params):
+        self.manifest_loc = manifest_loc
+        # compare parameters as they come back from json
+        params = json.loads(json.dumps(params))
+        if os.path.exists(manifest_loc):
+            with open(manifest_loc) as f:
+                self.manifest = json.load(f)
+            if self.manifest['params'] != params:
+                raise ValueError('The job key of this run was used by a run with different parameters')
+            logging.info('Resuming after stage(s) %s' % ', '.join(self.manifest['stages']))
+        else:
+            self.manifest = {'params': params, 'stages': dict(), 'saved': dict(), 'ontology_events': dict()}
+            self.write()
+
+    def write(self):
+        # replace the manifest in one step so a crash never leaves half of one
+        tmp_loc = '%s.tmp' % self.manifest_loc
+        with open(tmp_loc, 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_loc, self.manifest_loc)
+
+    def done(self, stage):
+        return stage in self.manifest['stages']
+
+    def outputs(self, stage):
+        return self.manifest['stages'][stage]
+
+    def complete(self, stage, **outputs):
+        self.manifest['stages'][stage] = outputs
+        self.write()
+
+    @property
+    def saved(self):
+        return dict(self.manifest['saved'])
+
+    def record_saved(self, name, ref):
+        self.manifest['saved'][name] = ref
+        self.write()
+
+    @property
+    def ontology_events(self):
+        return {name: dict(i) for name, i in self.manifest['ontology_events'].items()}
+
+    def record_ontology_event(self, genome_name, output_ref):
+        submitted = self.manifest['ontology_events'].setdefault(genome_name, {'chunks': 0})
+        submitted['output_ref'] = output_ref
+        submitted['chunks'] += 1
+        self.write()
@@ -0,0 +1,45 @@
+import os
+import shutil
+import multiprocessing
+
+from mag_annotator.annotate_bins import annotate_bins
+
+from .merge_util import merge_dram_outputs
+
+
+def shard_fastas(fasta_locs, shards):
+    # largest fasta first onto the lightest shard so every shard gets about the same number of bases
+    shards = max(1, min(shards, len(fasta_locs)))
+    shard_locs = [list() for _ in range(shards)]
+    shard_sizes = [0] * shards
+    for fasta_loc in sorted(fasta_locs, key=os.path.getsize, reverse=True):
+        i = shard_sizes.index(min(shard_sizes))
+        shard_locs[i].append(fasta_loc)
+        shard_sizes[i] += os.path.getsize(fasta_loc)
+    return shard_locs
+
+
+def _annotate_shard(args):
+    fasta_locs, output_dir, kwargs = args
+    annotate_bins(fasta_locs, output_dir, **kwargs)
+    return output_dir
+
+
+def annotate_bins_sharded(fasta_locs, output_dir, shards=1, threads=10, **kwargs):
+    # run annotate_bins on size balanced shards at once, splitting the thread budget between them, then merge the
+    # shard outputs into output_dir as if it was one run
+    shard_locs = shard_fastas(fasta_locs, shards)
+    if len(shard_locs) == 1:
+        annotate_bins(fasta_locs, output_dir, threads=threads, **kwargs)
+        return output_dir
+    shards_dir = '%s_shards' % output_dir
+    os.mkdir(shards_dir)
+    shard_threads = max(1, threads // len(shard_locs))
+    shard_args = [(fasta_locs, os.path.join(shards_dir, 'shard_%s' % i), dict(kwargs, threads=shard_threads))
+                  for i, fasta_locs in enumerate(shard_locs)]
+    # DRAM logs and keeps its database handles per process, so shards are processes rather than threads
+    with multiprocessing.Pool(len(shard_locs), maxtasksperchild=1) as pool:
+        pool.map(_annotate_shard, shard_args, chunksize=1)
+    merge_dram_outputs([i[1] for i in shard_args], output_dir)
+    shutil.rmtree(shards_dir)
+    return output_dir
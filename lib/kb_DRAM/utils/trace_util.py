@@ -0,0 +1,182 @@
+import json
+import time
+import random
+import logging
+import threading
+from bisect import bisect_left
+from collections import Counter
+
+import requests
+
+from installed_clients.baseclient import BaseClient, ServerError, _JSONObjectEncoder
+
+# installed_clients is regenerated by kb-sdk, so tracing wraps its BaseClient from here rather than editing it
+_base_call = BaseClient._call
+_base_run_job = BaseClient.run_job
+# the tracer BaseClient reports to while one is started
+_tracer = None
+# bytes of the calls made by the job this thread is running, a job is traced once with the bytes of its submit and
+# _check_job calls
+_job_calls = threading.local()
+
+# upper edges of the histogram buckets, the last bucket holds everything above the last edge
+LATENCY_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 1800)
+BYTES_BUCKETS = tuple(1024 * 4 ** i for i in range(11))
+
+
+def _record(method, request_bytes, response_bytes, start, status):
+    job_bytes = getattr(_job_calls, 'bytes', None)
+    if job_bytes is not None:
+        job_bytes[0] += request_bytes
+        job_bytes[1] += response_bytes
+    elif _tracer is not None:
+        _tracer(method, request_bytes, response_bytes, time.time() - start, status)
+
+
+def _traced_call(self, url, method, params, context=None):
+    # BaseClient._call, measuring the body it sends and the response it gets instead of serializing anything again
+    arg_hash = {'method': method, 'params': params, 'version': '1.1', 'id': str(random.random())[2:]}
+    if context:
+        if type(context) is not dict:
+            raise ValueError('context is not type dict as required.')
+        arg_hash['context'] = context
+    body = json.dumps(arg_hash, cls=_JSONObjectEncoder)
+    start = time.time()
+    ret = None
+    status = 'ok'
+    try:
+        ret = requests.post(url, data=body, headers=self._headers, timeout=self.timeout,
+                            verify=not self.trust_all_ssl_certificates)
+        ret.encoding = 'utf-8'
+        if ret.status_code == 500:
+            if ret.headers.get('content-type') == 'application/json':
+                err = ret.json()
+                if 'error' in err:
+                    raise ServerError(**err['error'])
+                raise ServerError('Unknown', 0, ret.text)
+            raise ServerError('Unknown', 0, ret.text)
+        if not ret.ok:
+            ret.raise_for_status()
+        resp = ret.json()
+    except Exception as e:
+        status = type(e).__name__
+        raise
+    finally:
+        _record(method, len(body), len(ret.content) if ret is not None else 0, start, status)
+    if 'result' not in resp:
+        raise ServerError('Unknown', 0, 'An unknown server error occurred')
+    if not resp['result']:
+        return
+    if len(resp['result']) == 1:
+        return resp['result'][0]
+    return resp['result']
+
+
+def _traced_run_job(self, service_method, args, service_ver=None, context=None):
+    start = time.time()
+    _job_calls.bytes = job_bytes = [0, 0]
+    status = 'ok'
+    try:
+        return _base_run_job(self, service_method, args, service_ver, context)
+    except Exception as e:
+        status = type(e).__name__
+        raise
+    finally:
+        _job_calls.bytes = None
+        if _tracer is not None:
+            _tracer(service_method, job_bytes[0], job_bytes[1], time.time() - start, status)
+
+
+def bucket_label(edges, i, unit):
+    if i == len(edges):
+        return '>%s%s' % (edges[-1], unit)
+    return '<=%s%s' % (edges[i], unit)
+
+
+class MethodTrace:
+    def __init__(self):
+        self.calls = 0
+        self.statuses = Counter()
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.latency_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.request_counts = [0] * (len(BYTES_BUCKETS) + 1)
+        self.response_counts = [0] * (len(BYTES_BUCKETS) + 1)
+
+    def add(self, request_bytes, response_bytes, seconds, status):
+        self.calls += 1
+        self.statuses[status] += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.request_bytes += request_bytes
+        self.response_bytes += response_bytes
+        self.latency_counts[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.request_counts[bisect_left(BYTES_BUCKETS, request_bytes)] += 1
+        self.response_counts[bisect_left(BYTES_BUCKETS, response_bytes)] += 1
+
+    def summary(self):
+        def histogram(edges, counts, unit):
+            return {bucket_label(edges, i, unit): count for i, count in enumerate(counts) if count}
+        return {
+            'calls': self.calls,
+            'statuses': dict(self.statuses),
+            'seconds': self.seconds,
+            'max_seconds': self.max_seconds,
+            'request_bytes': self.request_bytes,
+            'response_bytes': self.response_bytes,
+            'latency_histogram': histogram(LATENCY_BUCKETS, self.latency_counts, 's'),
+            'request_bytes_histogram': histogram(BYTES_BUCKETS, self.request_counts, 'B'),
+            'response_bytes_histogram': histogram(BYTES_BUCKETS, self.response_counts, 'B'),
+        }
+
+
+class RPCTracer:
+    # every call and job the clients make, by method, for seeing which remote methods a run spends its time in and
+    # how much they send and receive, a job is traced once as a whole with the bytes of its submit and _check_job calls
+    def __init__(self):
+        self.methods = dict()
+        # saves and downloads call from worker threads
+        self.lock = threading.Lock()
+
+    def __call__(self, method, request_bytes, response_bytes, seconds, status):
+        with self.lock:
+            if method not in self.methods:
+                self.methods[method] = MethodTrace()
+            self.methods[method].add(request_bytes, response_bytes, seconds, status)
+
+    def start(self):
+        # every client shares BaseClient, so calls are traced whenever the client was imported or made
+        global _tracer
+        _tracer = self
+        BaseClient._call = _traced_call
+        BaseClient.run_job = _traced_run_job
+        return self
+
+    def stop(self):
+        global _tracer
+        _tracer = None
+        BaseClient._call = _base_call
+        BaseClient.run_job = _base_run_job
+
+    def reset(self):
+        with self.lock:
+            self.methods = dict()
+
+    def summary(self):
+        # per method totals and histograms, the methods that took longest first
+        with self.lock:
+            summaries = {method: trace.summary() for method, trace in self.methods.items()}
+        return dict(sorted(summaries.items(), key=lambda i: i[1]['seconds'], reverse=True))
+
+    def log_summary(self):
+        # method, calls, errors, total and max seconds, MB sent and received as one line each on the job timeline,
+        # then the latency histogram
+        for method, summary in self.summary().items():
+            errors = summary['calls'] - summary['statuses'].get('ok', 0)
+            logging.info('RPC timing: %s\t%s\t%s\t%.1f\t%.1f\t%.2f\t%.2f' % (
+                method, summary['calls'], errors, summary['seconds'], summary['max_seconds'],
+                summary['request_bytes'] / 1024 ** 2, summary['response_bytes'] / 1024 ** 2))
+            logging.info('RPC latency: %s\t%s' % (method, ' '.join(
+                '%s:%s' % i for i in summary['latency_histogram'].items())))
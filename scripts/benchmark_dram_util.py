@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# Benchmarks for the scaling sensitive parts of kb_DRAM.utils, run outside of the KBase test environment
+# usage: python scripts/benchmark_dram_util.py metagenome_gff --genes 1000000 5000000 10000000
+#        python scripts/benchmark_dram_util.py load_schema_pyarrow --genes 5000000
+#        python scripts/benchmark_dram_util.py ontology_chunked --genes 20000000 --max_rss_mb 1024
+#        python scripts/benchmark_dram_util.py ontology_one --genes 1000000 && \
+#            python scripts/benchmark_dram_util.py ontology_all --genes 1000000
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from kb_DRAM.utils import dram_util  # noqa: E402
+from kb_DRAM.utils import merge_util  # noqa: E402
+
+GENES_PER_SCAFFOLD = 50
+GENES_PER_FASTA = 5000
+
+
+def gene_names(num_genes, genes_per_fasta=GENES_PER_FASTA):
+    for i in range(num_genes):
+        fasta = 'bin_%s' % (i // genes_per_fasta)
+        scaffold = '%s_scaffold_%s' % (fasta, i // GENES_PER_SCAFFOLD)
+        yield fasta, scaffold, '%s_%s' % (scaffold, i % GENES_PER_SCAFFOLD + 1), i % GENES_PER_SCAFFOLD
+
+
+def write_annotations(annotations_loc, num_genes, genes_per_fasta=GENES_PER_FASTA):
+    with open(annotations_loc, 'w') as f:
+        f.write('\tfasta\tscaffold\tgene_position\tstart_position\tend_position\tstrandedness\trank\t'
+                'kegg_id\tko_id\tkegg_hit\tpfam_hits\tcazy_hits\n')
+        for fasta, scaffold, gene, position in gene_names(num_genes, genes_per_fasta):
+            start = position * 1000 + 1
+            ko = 'K%05d' % (position * 97 % 25000)
+            f.write('%s\t%s\t%s\t%s\t%s\t%s\t1\tC\t%s\t%s\t'
+                    'alcohol dehydrogenase [EC:1.1.1.1]\tADH_N [PF08240.15]\tGT2 [EC:2.4.1.-]\n'
+                    % (gene, fasta, scaffold, position + 1, start, start + 899, ko, ko))
+
+
+def write_gff(gff_loc, num_genes):
+    with open(gff_loc, 'w') as f:
+        f.write('##gff-version 3\n')
+        for _, scaffold, gene, position in gene_names(num_genes):
+            start = position * 1000 + 1
+            f.write('%s\tProdigal_v2.6.3\tCDS\t%s\t%s\t10.5\t+\t0\tID=%s;partial=00;start_type=ATG;'
+                    'Dbxref="kegg:K00001";\n' % (scaffold, start, start + 899, gene))
+
+
+def write_sequences(work_dir, num_genes):
+    # gene fastas plus one assembly fasta per bin, scaffolds are just long enough for their genes
+    assemblies = dict()
+    assembly_ref_dict = dict()
+    gene = 'ATG' + 'GCA' * 298 + 'TAA'
+    with open(os.path.join(work_dir, 'genes.fna'), 'w') as fna, open(os.path.join(work_dir, 'genes.faa'), 'w') as faa:
+        for fasta, scaffold, gene_name, position in gene_names(num_genes):
+            fna.write('>%s\n%s\n' % (gene_name, gene))
+            faa.write('>%s\nM%s\n' % (gene_name, 'A' * 298))
+            if fasta not in assembly_ref_dict:
+                assembly_ref = '1/%s/1' % (len(assembly_ref_dict) + 1)
+                assembly_ref_dict[fasta] = assembly_ref
+                assemblies[assembly_ref] = {'paths': [os.path.join(work_dir, '%s.fa' % fasta)]}
+            if position == 0:
+                with open(assemblies[assembly_ref_dict[fasta]]['paths'][0], 'a') as f:
+                    f.write('>%s\n%s\n' % (scaffold, 'GCAT' * GENES_PER_SCAFFOLD * 250))
+    return assemblies, assembly_ref_dict
+
+
+def build_genome_json(annotations_loc, work_dir, assemblies, assembly_ref_dict):
+    annotations = pd.read_csv(annotations_loc, sep='\t', index_col=0)
+    for genome_object in dram_util.generate_genomes(annotations, os.path.join(work_dir, 'genes.fna'),
+                                                    os.path.join(work_dir, 'genes.faa'), assembly_ref_dict,
+                                                    assemblies, 'workspace', []):
+        json.dumps(genome_object)
+
+
+def ontology_chunked(annotations_loc, num_genes, ontologies=dram_util.EVENT_ONTOLOGIES):
+    genome_ref_dict = {'bin_%s' % i: '1/%s/1' % (i + 1) for i in range(num_genes // GENES_PER_FASTA + 1)}
+    for ontology_event in dram_util.add_ontology_terms(
+            dram_util.iter_genome_annotations(annotations_loc, dram_util.ONTOLOGY_COLUMNS,
+                                              dram_util.ONTOLOGY_PATTERNS),
+            'benchmark', '0', 'workspace', 'workspace_url', genome_ref_dict, ontologies=ontologies):
+        json.dumps(ontology_event)
+
+
+def _measure(queue, target, args):
+    start = time.time()
+    target(*args)
+    queue.put((time.time() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def run_measured(target, *args):
+    # run in a child so ru_maxrss is the peak of this case only
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_measure, args=(queue, target, args))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError('Benchmark case failed with exit code %s' % process.exitcode)
+    return queue.get()
+
+
+def benchmark_metagenome_gff(num_genes, work_dir):
+    annotations_loc = os.path.join(work_dir, 'annotations.tsv')
+    gff_loc = os.path.join(work_dir, 'genes.gff')
+    write_annotations(annotations_loc, num_genes)
+    write_gff(gff_loc, num_genes)
+    return run_measured(dram_util.write_metagenome_gff, gff_loc, annotations_loc,
+                        os.path.join(work_dir, 'metagenome.gff'))
+
+
+def benchmark_genome_json(num_genes, work_dir):
+    # the in memory genome objects as they would be serialized for save_one_genome
+    annotations_loc = os.path.join(work_dir, 'annotations.tsv')
+    write_annotations(annotations_loc, num_genes)
+    assemblies, assembly_ref_dict = write_sequences(work_dir, num_genes)
+    return run_measured(build_genome_json, annotations_loc, work_dir, assemblies, assembly_ref_dict)
+
+
+def benchmark_genome_gff(num_genes, work_dir):
+    # the per genome gffs handed to fasta_gff_to_genome
+    annotations_loc = os.path.join(work_dir, 'annotations.tsv')
+    gff_loc = os.path.join(work_dir, 'genes.gff')
+    write_annotations(annotations_loc, num_genes)
+    write_gff(gff_loc, num_genes)
+    return run_measured(dram_util.write_genome_gffs, gff_loc, annotations_loc, work_dir)
+
+
+def load_bare(annotations_loc):
+    pd.read_csv(annotations_loc, sep='\t', index_col=0)
+
+
+def benchmark_load_bare(num_genes, work_dir):
+    annotations_loc = os.path.join(work_dir, 'annotations.tsv')
+    write_annotations(annotations_loc, num_genes)
+    return run_measured(load_bare, annotations_loc)
+
+
+def benchmark_load_schema(num_genes, work_dir, engine='c'):
+    annotations_loc = os.path.join(work_dir, 'annotations.tsv')
+    write_annotations(annotations_loc, num_genes)
+    return run_measured(dram_util.read_annotations, annotations_loc,
+                        dram_util.GENOME_COLUMNS + dram_util.ONTOLOGY_COLUMNS, dram_util.ONTOLOGY_PATTERNS, engine)
+
+
+def benchmark_load_schema_pyarrow(num_genes, work_dir):
+    return benchmark_load_schema(num_genes, work_dir, engine='pyarrow')
+
+
+def benchmark_ontology_chunked(num_genes, work_dir):
+    # a genome at a time from the sorted table, peak memory should not grow with the gene count
+    annotations_loc = os.path.join(work_dir, 'annotations.tsv')
+    write_annotations(annotations_loc, num_genes)
+    return run_measured(ontology_chunked, annotations_loc, num_genes)
+
+
+def benchmark_ontology_one(num_genes, work_dir):
+    # KO alone against every ontology, the columns are scanned once either way
+    annotations_loc = os.path.join(work_dir, 'annotations.tsv')
+    write_annotations(annotations_loc, num_genes)
+    return run_measured(ontology_chunked, annotations_loc, num_genes, ('KO',))
+
+
+def benchmark_ontology_all(num_genes, work_dir):
+    annotations_loc = os.path.join(work_dir, 'annotations.tsv')
+    write_annotations(annotations_loc, num_genes)
+    return run_measured(ontology_chunked, annotations_loc, num_genes, dram_util.EVENT_ONTOLOGIES)
+
+
+def benchmark_sort(num_genes, work_dir):
+    # interleave the genomes so every line has to move
+    annotations_loc = os.path.join(work_dir, 'annotations.tsv')
+    write_annotations(annotations_loc, num_genes, genes_per_fasta=GENES_PER_SCAFFOLD)
+    return run_measured(dram_util.sort_annotations, annotations_loc, os.path.join(work_dir, 'sorted.tsv'), work_dir)
+
+
+def benchmark_merge(num_genes, work_dir, shards=3):
+    # shard outputs as annotate_bins_sharded leaves them, genomes dealt round robin
+    annotations_loc = os.path.join(work_dir, 'annotations.tsv')
+    write_annotations(annotations_loc, num_genes)
+    shard_dirs = [os.path.join(work_dir, 'shard_%s' % i) for i in range(shards)]
+    shard_files = list()
+    for shard_dir in shard_dirs:
+        os.mkdir(shard_dir)
+        shard_files.append(open(os.path.join(shard_dir, 'annotations.tsv'), 'w'))
+    with open(annotations_loc) as f:
+        header = f.readline()
+        for shard_file in shard_files:
+            shard_file.write(header)
+        for line in f:
+            shard_files[int(line.split('\t')[1].split('_')[1]) % shards].write(line)
+    for shard_file in shard_files:
+        shard_file.close()
+    return run_measured(merge_util.merge_dram_outputs, shard_dirs, os.path.join(work_dir, 'merged'))
+
+
+BENCHMARKS = {
+    'metagenome_gff': benchmark_metagenome_gff,
+    'genome_json': benchmark_genome_json,
+    'genome_gff': benchmark_genome_gff,
+    'load_bare': benchmark_load_bare,
+    'load_schema': benchmark_load_schema,
+    'load_schema_pyarrow': benchmark_load_schema_pyarrow,
+    'ontology_chunked': benchmark_ontology_chunked,
+    'ontology_one': benchmark_ontology_one,
+    'ontology_all': benchmark_ontology_all,
+    'sort': benchmark_sort,
+    'merge': benchmark_merge,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--genes', type=int, nargs='+', default=[1000000, 5000000, 10000000])
+    parser.add_argument('--work_dir', default=None)
+    parser.add_argument('--max_rss_mb', type=float, default=None, help='fail if any case peaks above this')
+    args = parser.parse_args()
+    print('benchmark\tgenes\twall_seconds\tpeak_rss_mb')
+    for num_genes in args.genes:
+        work_dir = tempfile.mkdtemp(dir=args.work_dir)
+        try:
+            wall, peak_rss = BENCHMARKS[args.benchmark](num_genes, work_dir)
+        finally:
+            shutil.rmtree(work_dir)
+        print('%s\t%s\t%.1f\t%.0f' % (args.benchmark, num_genes, wall, peak_rss))
+        if args.max_rss_mb is not None and peak_rss > args.max_rss_mb:
+            sys.exit('%s peaked at %.0f MB with %s genes, above the %.0f MB limit'
+                     % (args.benchmark, peak_rss, num_genes, args.max_rss_mb))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# Import time of the modules the server loads at start, each measured with python -X importtime in a fresh
+# interpreter and held to a budget, run outside of the KBase test environment
+# usage: python scripts/benchmark_imports.py
+#        python scripts/benchmark_imports.py --repeat 5 --scale 2
+import argparse
+import os
+import subprocess
+import sys
+
+LIB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib')
+
+# seconds each module may take to import, including everything it imports
+IMPORT_BUDGETS = {
+    'kb_DRAM.kb_DRAMImpl': 0.5,
+    'kb_DRAM.utils.cache_util': 0.1,
+    'kb_DRAM.utils.scratch_util': 0.1,
+    'kb_DRAM.utils.profile_util': 0.1,
+    'kb_DRAM.utils.trace_util': 0.3,
+    'kb_DRAM.utils.dram_util': 1.5,
+}
+# modules the Impl leaves to the methods that need them
+DEFERRED_MODULES = ('pandas', 'numpy', 'yaml', 'mag_annotator', 'altair', 'sqlalchemy', 'skbio', 'openpyxl',
+                    'pyarrow', 'installed_clients.WorkspaceClient', 'installed_clients.AssemblyUtilClient',
+                    'installed_clients.GenomeFileUtilClient', 'installed_clients.DataFileUtilClient',
+                    'installed_clients.KBaseReportClient', 'installed_clients.cb_annotation_ontology_apiClient',
+                    'installed_clients.KBaseDataObjectToFileUtilsClient')
+SERVER_MODULE = 'kb_DRAM.kb_DRAMImpl'
+
+
+def import_times(module):
+    # cumulative microseconds and depth of every module the import loaded, as -X importtime reports them, leaving
+    # out what the interpreter imported at start
+    env = dict(os.environ, PYTHONPATH=LIB_DIR)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s' % module], env=env,
+                            stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError('Importing %s failed:\n%s' % (module, result.stderr))
+    times = dict()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        times[name.strip()] = (int(cumulative), depth)
+        # children are listed before their parent, so a top level import other than the module ends a startup one
+        if depth == 0:
+            if name.strip() == module:
+                return times
+            times = dict()
+    raise RuntimeError('-X importtime did not report %s' % module)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=3, help='the fastest of this many imports is reported')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiply the budgets for slower machines')
+    args = parser.parse_args()
+    failures = list()
+    print('module\tseconds\tbudget_seconds\tslowest_imports')
+    for module, budget in IMPORT_BUDGETS.items():
+        # the first import writes the bytecode caches
+        import_times(module)
+        runs = [import_times(module) for _ in range(args.repeat)]
+        times = min(runs, key=lambda i: i[module][0])
+        seconds = times[module][0] / 1e6
+        # the heaviest of its own imports
+        slowest = sorted((name for name, (_, depth) in times.items() if depth == 1), key=times.get,
+                         reverse=True)[:3]
+        print('%s\t%.3f\t%.3f\t%s' % (module, seconds, budget * args.scale,
+                                       ', '.join('%s %.3f' % (name, times[name][0] / 1e6) for name in slowest)))
+        if seconds > budget * args.scale:
+            failures.append('%s took %.3f seconds to import, above the %.3f second budget'
+                            % (module, seconds, budget * args.scale))
+        if module == SERVER_MODULE:
+            loaded = sorted({name if name in DEFERRED_MODULES else name.split('.')[0] for name in times
+                             if name in DEFERRED_MODULES or name.split('.')[0] in DEFERRED_MODULES})
+            if len(loaded) > 0:
+                failures.append('%s imported %s at load instead of in the methods that use them'
+                                % (module, ', '.join(loaded)))
+    if len(failures) > 0:
+        sys.exit('\n'.join(failures))
+
+
+if __name__ == '__main__':
+    main()
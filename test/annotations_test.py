@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+import pandas as pd
+
+from kb_DRAM.utils.dram_util import read_annotations, iter_genome_annotations, sort_annotations, \
+    annotations_sorted_by_fasta, get_annotation_files, PYARROW_AVAILABLE
+
+HEADER = ['', 'fasta', 'scaffold', 'gene_position', 'start_position', 'end_position', 'strandedness', 'rank',
+          'kegg_hit', 'bin_completeness']
+
+
+def annotation_rows(fasta_names, genes_per_fasta=5):
+    # genes of each fasta in the order given, only the second genome has kegg hits
+    rows = list()
+    for fasta_name in fasta_names:
+        for i in range(genes_per_fasta):
+            rows.append(['%s_s1_%s' % (fasta_name, i + 1), fasta_name, '%s_s1' % fasta_name, str(i + 1),
+                         str(i * 100 + 1), str(i * 100 + 90), '1', 'D', 'kinase' if fasta_name == '002' else '',
+                         '90.5'])
+    return rows
+
+
+def write_table(table_loc, rows):
+    with open(table_loc, 'w') as f:
+        for row in [HEADER] + rows:
+            f.write('\t'.join(row) + '\n')
+
+
+class ReadAnnotationsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.annotations_loc = os.path.join(self.tmp_dir, 'annotations.tsv')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def read_fastas(self, annotations_loc):
+        with open(annotations_loc) as f:
+            next(f)
+            return [line.split('\t')[1] for line in f]
+
+    def test_numeric_names_kept(self):
+        write_table(self.annotations_loc, annotation_rows(['001', '1.10', '2'], genes_per_fasta=2))
+        for engine in ('c', 'pyarrow'):
+            annotations = read_annotations(self.annotations_loc, engine=engine)
+            self.assertEqual(annotations['fasta'].unique().tolist(), ['001', '1.10', '2'])
+            self.assertEqual(annotations.index[0], '001_s1_1')
+            self.assertEqual(annotations['gene_position'].tolist(), [1, 2] * 3)
+        # only the columns asked for, with fasta
+        annotations = read_annotations(self.annotations_loc, columns=['kegg_hit'])
+        self.assertEqual(list(annotations.columns), ['fasta', 'kegg_hit'])
+
+    def test_sort_across_chunks(self):
+        # genomes interleaved, as a merge of shards can leave them, are grouped keeping each genome's gene order
+        rows = annotation_rows(['bin_1', 'bin_2', 'bin_3'], genes_per_fasta=4)
+        write_table(self.annotations_loc, rows[0:2] + rows[4:6] + rows[2:4] + rows[8:] + rows[6:8])
+        self.assertFalse(annotations_sorted_by_fasta(self.annotations_loc, chunksize=3))
+        sorted_loc = sort_annotations(self.annotations_loc, os.path.join(self.tmp_dir, 'sorted.tsv'), self.tmp_dir,
+                                      buckets=2)
+        self.assertTrue(annotations_sorted_by_fasta(sorted_loc, chunksize=3))
+        # each genome's lines together, genomes in bucket order
+        fastas = self.read_fastas(sorted_loc)
+        self.assertEqual(sorted(fastas), ['bin_1'] * 4 + ['bin_2'] * 4 + ['bin_3'] * 4)
+        self.assertEqual(len([i for i in range(1, len(fastas)) if fastas[i] != fastas[i - 1]]), 2)
+        sorted_annotations = read_annotations(sorted_loc)
+        self.assertEqual(sorted_annotations.loc[sorted_annotations['fasta'] == 'bin_2', 'gene_position'].tolist(),
+                         [1, 2, 3, 4])
+        # the bucket files are removed
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), ['annotations.tsv', 'sorted.tsv'])
+
+    def test_iter_genomes(self):
+        rows = annotation_rows(['bin_1', 'bin_2', 'bin_3'], genes_per_fasta=4)
+        write_table(self.annotations_loc, rows[0:2] + rows[4:8] + rows[2:4] + rows[8:])
+        # an unsorted table is refused rather than yielding bin_1 twice
+        with self.assertRaisesRegex(ValueError, 'bin_1 appears more than once'):
+            list(iter_genome_annotations(self.annotations_loc, chunksize=3))
+        sorted_loc = sort_annotations(self.annotations_loc, os.path.join(self.tmp_dir, 'sorted.tsv'), self.tmp_dir)
+        genomes = list(iter_genome_annotations(sorted_loc, columns=['kegg_hit'], chunksize=3))
+        # each genome once, whole, though chunks split them
+        self.assertEqual(sorted(i[0] for i in genomes), ['bin_1', 'bin_2', 'bin_3'])
+        self.assertEqual([len(i[1]) for i in genomes], [4, 4, 4])
+        bin_2 = dict(genomes)['bin_2']
+        self.assertEqual(list(bin_2.columns), ['fasta', 'kegg_hit'])
+        self.assertEqual(bin_2.index.tolist(), ['bin_2_s1_%s' % i for i in range(1, 5)])
+
+
+@unittest.skipUnless(PYARROW_AVAILABLE, 'pyarrow is not installed')
+class AnnotationsParquetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.annotations_loc = os.path.join(self.tmp_dir, 'annotations.tsv')
+        write_table(self.annotations_loc, annotation_rows(['001', '002']))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def read_parquet(self, output_files):
+        from pyarrow import parquet as pyarrow_parquet
+        parquet_loc = output_files['annotations_parquet']['path']
+        return pd.read_parquet(parquet_loc), pyarrow_parquet.ParquetFile(parquet_loc)
+
+    def test_streamed_matches_frame(self):
+        frame_output = os.path.join(self.tmp_dir, 'frame')
+        streamed_output = os.path.join(self.tmp_dir, 'streamed')
+        for output_dir in (frame_output, streamed_output):
+            os.mkdir(output_dir)
+        frame, frame_file = self.read_parquet(
+            get_annotation_files(frame_output, annotations=read_annotations(self.annotations_loc)))
+        # a genome spanning chunks is written as consecutive row groups
+        streamed, streamed_file = self.read_parquet(get_annotation_files(
+            streamed_output, annotations=iter_genome_annotations(self.annotations_loc, chunksize=3,
+                                                                 split_genomes=True)))
+        self.assertEqual(frame_file.num_row_groups, 2)
+        self.assertEqual(streamed_file.num_row_groups, 5)
+        self.assertEqual(streamed_file.schema_arrow, frame_file.schema_arrow)
+        pd.testing.assert_frame_equal(streamed, frame)
+        self.assertEqual(streamed['fasta'].tolist(), ['001'] * 5 + ['002'] * 5)
+
+    def test_no_annotations(self):
+        output_files = get_annotation_files(self.tmp_dir)
+        self.assertNotIn('annotations_parquet', output_files)
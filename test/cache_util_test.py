@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from kb_DRAM.utils.cache_util import RunArtifacts, DistillCache
+
+ANNOTATIONS = '\n'.join([
+    '\tfasta\tscaffold\tgene_position\tstart_position\tend_position\tstrandedness\trank\tkegg_hit\t'
+    'kegg_RBH\tkegg_bitScore\tko_id\tpeptidase_eVal\tbin_completeness\tcamper_hit\tsignal',
+    '1_s1_1\t1\t1_s1\t1\t2\t310\t1\tC\tdehydrogenase [EC:1.1.1.1]\tTrue\t301.5\tK00001\t1e-30\t98.2\t\t1',
+    '1_s1_2\t1\t1_s1\t2\t400\t900\t-1\tE\t\tFalse\t\t\t\t98.2\t\t2',
+    '2_s1_1\t2\t2_s1\t1\t5\t1200\t1\tD\tkinase\tTrue\t88\tK00002\t2.5e-12\t75\t\t3',
+]) + '\n'
+
+
+class RunArtifactsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.annotations_loc = os.path.join(self.tmp_dir, 'annotations.tsv')
+        with open(self.annotations_loc, 'w') as f:
+            f.write(ANNOTATIONS)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_frame_shared(self):
+        # every stage of a run gets the one frame parsed from the file
+        artifacts = RunArtifacts(self.tmp_dir)
+        annotations = artifacts.get_annotations(self.annotations_loc)
+        self.assertIs(artifacts.get_annotations(self.annotations_loc), annotations)
+        self.assertIs(artifacts.get_genome_annotations(self.annotations_loc), annotations)
+        self.assertEqual(annotations['kegg_hit'].tolist()[0], 'dehydrogenase [EC:1.1.1.1]')
+
+
+class DistillCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache = DistillCache(os.path.join(self.tmp_dir, 'cache'), max_bytes=250)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def distill_output(self, name, content):
+        output_dir = os.path.join(self.tmp_dir, name)
+        os.mkdir(output_dir)
+        with open(os.path.join(output_dir, 'product.tsv'), 'w') as f:
+            f.write(content)
+        return output_dir
+
+    def entry_time(self, key, mtime):
+        os.utime(os.path.join(self.cache.cache_dir, key), (mtime, mtime))
+
+    def test_restore(self):
+        self.cache.store('a', self.distill_output('run_1', 'genome\tproduct\n'))
+        restored_dir = os.path.join(self.tmp_dir, 'restored')
+        self.assertTrue(self.cache.restore('a', restored_dir))
+        with open(os.path.join(restored_dir, 'product.tsv')) as f:
+            self.assertEqual(f.read(), 'genome\tproduct\n')
+        self.assertFalse(self.cache.restore('b', os.path.join(self.tmp_dir, 'missing')))
+
+    def test_least_recently_used_evicted(self):
+        self.cache.store('a', self.distill_output('run_1', 'a' * 100))
+        self.cache.store('b', self.distill_output('run_2', 'b' * 100))
+        self.entry_time('a', 1000)
+        self.entry_time('b', 2000)
+        # restoring a makes b the least recently used
+        self.assertTrue(self.cache.restore('a', os.path.join(self.tmp_dir, 'restored')))
+        self.cache.store('c', self.distill_output('run_3', 'c' * 100))
+        self.assertEqual(sorted(os.listdir(self.cache.cache_dir)), ['a', 'c'])
+
+    def test_store_race(self):
+        # another run stored the same key first, its entry is kept and nothing partial is left behind
+        self.cache.store('a', self.distill_output('run_1', 'first'))
+        self.cache.store('a', self.distill_output('run_2', 'second'))
+        self.assertEqual(os.listdir(self.cache.cache_dir), ['a'])
+        with open(os.path.join(self.cache.cache_dir, 'a', 'product.tsv')) as f:
+            self.assertEqual(f.read(), 'first')
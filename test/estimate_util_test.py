@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import pandas as pd
+
+from kb_DRAM.utils.estimate_util import fit_stage_model, predict_resources, predict_stage_scratch
+
+TIMINGS = pd.DataFrame([
+    ['annotation', 3000, 1200, 16384, 30, 'run_kb_dram_annotate'],
+    ['annotation', 300000, 60600, 20480, 3000, 'run_kb_dram_annotate'],
+    ['ontology', 100000, 10, 100, 0, 'benchmark_dram_util ontology_chunked'],
+    ['ontology', 200000, 20, 200, 0, 'benchmark_dram_util ontology_chunked'],
+], columns=['stage', 'genes', 'wall_seconds', 'peak_memory_mb', 'scratch_mb', 'source'])
+
+
+class EstimateUtilTest(unittest.TestCase):
+
+    def test_unrecorded_uncalibrated(self):
+        # a stage with no timings is marked and left out of the totals
+        estimate = predict_resources([{'genes': 300000}], ('distillation', 'ontology'), fit_stage_model(TIMINGS))
+        self.assertEqual(estimate['uncalibrated_stages'], ['distillation'])
+        self.assertEqual([i['calibrated'] for i in estimate['stages']], [0, 1])
+        self.assertEqual(estimate['stages'][0]['wall_seconds'], 0)
+        self.assertAlmostEqual(estimate['wall_seconds'], 30, delta=1)
+
+    def test_fit(self):
+        model = fit_stage_model(TIMINGS)
+        estimate = predict_resources([{'genes': 300000}], ('ontology',), model)
+        self.assertAlmostEqual(estimate['stages'][0]['wall_seconds'], 30, delta=1)
+        self.assertAlmostEqual(estimate['peak_memory_bytes'], 300 * 1024 ** 2, delta=1)
+
+    def test_annotation_shards(self):
+        model = fit_stage_model(TIMINGS)
+        single = predict_resources([{'genes': 3000}], ('annotation',), model)
+        sharded = predict_resources([{'genes': 3000}], ('annotation',), model, annotation_shards=3)
+        self.assertEqual(sharded['peak_memory_bytes'], 3 * single['peak_memory_bytes'])
+        self.assertEqual(sharded['wall_seconds'], single['wall_seconds'])
+
+    def test_stage_scratch(self):
+        model = fit_stage_model(TIMINGS)
+        self.assertAlmostEqual(predict_stage_scratch([{'genes': 3000}], 'annotation', model), 30 * 1024 ** 2,
+                               delta=1)
+        # without timings annotation is still taken to write its input again
+        self.assertEqual(predict_stage_scratch([{'bases': 5000}], 'annotation', dict()), 5000)
+        self.assertEqual(predict_stage_scratch([{'bases': 5000}], 'distillation', model), 0)
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from kb_DRAM.utils.dram_util import write_genome_gffs, write_metagenome_gff
+
+# bin_3 had no genes called, so it has no annotations and nothing in the gff
+ANNOTATIONS = [
+    ['', 'fasta', 'scaffold', 'gene_position', 'kegg_hit'],
+    ['bin_1_contig_1_1', 'bin_1', 'contig_1', '1', 'alcohol dehydrogenase [EC:1.1.1.1]'],
+    ['bin_1_contig_2_1', 'bin_1', 'contig_2', '1', ''],
+    ['001_contig_1_1', '001', 'contig_1', '1', 'kinase; other'],
+]
+# DRAM writes each scaffold prefixed with the fasta it came from
+GENES_GFF = [
+    '##gff-version 3',
+    'bin_1_contig_1\tProdigal_v2.6.3\tCDS\t2\t310\t.\t+\t0\tID=bin_1_contig_1_1;kegg_id=K00001',
+    'bin_1_contig_2\tProdigal_v2.6.3\tCDS\t5\t400\t.\t-\t0\tID=bin_1_contig_2_1',
+    '001_contig_1\tProdigal_v2.6.3\tCDS\t1\t90\t.\t+\t0\tID=001_contig_1_1;',
+]
+
+
+class GffTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.annotations_loc = os.path.join(self.tmp_dir, 'annotations.tsv')
+        with open(self.annotations_loc, 'w') as f:
+            for row in ANNOTATIONS:
+                f.write('\t'.join(row) + '\n')
+        self.genes_gff_loc = os.path.join(self.tmp_dir, 'genes.gff')
+        with open(self.genes_gff_loc, 'w') as f:
+            f.write('\n'.join(GENES_GFF) + '\n')
+        self.output_dir = os.path.join(self.tmp_dir, 'genome_gffs')
+        os.mkdir(self.output_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def read_gff(self, gff_loc):
+        with open(gff_loc) as f:
+            return [line.split('\t') for line in f.read().splitlines()]
+
+    def test_genome_gffs(self):
+        gff_locs = write_genome_gffs(self.genes_gff_loc, self.annotations_loc, self.output_dir, chunksize=2)
+        # a genome with no genes gets no gff, so it is not saved from one
+        self.assertEqual(sorted(gff_locs), ['001', 'bin_1'])
+        self.assertFalse(os.path.exists(os.path.join(self.output_dir, 'bin_3.gff')))
+        bin_1 = self.read_gff(gff_locs['bin_1'])
+        self.assertEqual(bin_1[0], ['##gff-version 3'])
+        # scaffolds are named as in the input assembly again
+        self.assertEqual([i[0] for i in bin_1[1:]], ['contig_1', 'contig_2'])
+        self.assertEqual(bin_1[1][8], 'ID=bin_1_contig_1_1;kegg_id=K00001;'
+                                      'product=alcohol dehydrogenase [EC:1.1.1.1];')
+        self.assertEqual(bin_1[2][8], 'ID=bin_1_contig_2_1')
+        # numeric looking fasta names are kept as written
+        genome_001 = self.read_gff(gff_locs['001'])
+        self.assertEqual(genome_001[1][0], 'contig_1')
+        self.assertEqual(genome_001[1][8], 'ID=001_contig_1_1;product=kinase%3B other;')
+        # the product index is removed with the run
+        self.assertEqual(sorted(os.listdir(self.output_dir)), ['001.gff', 'bin_1.gff'])
+
+    def test_unprefixed_scaffolds(self):
+        # a gff that kept the input scaffold names maps to the same genomes
+        with open(self.genes_gff_loc, 'w') as f:
+            f.write('\n'.join([GENES_GFF[0]] + [i[len('bin_1_'):] for i in GENES_GFF[1:3]]) + '\n')
+        gff_locs = write_genome_gffs(self.genes_gff_loc, self.annotations_loc, self.output_dir)
+        self.assertEqual(list(gff_locs), ['bin_1'])
+        self.assertEqual([i[0] for i in self.read_gff(gff_locs['bin_1'])[1:]], ['contig_1', 'contig_2'])
+
+    def test_metagenome_gff(self):
+        output_gff_loc = os.path.join(self.output_dir, 'metagenome.gff')
+        genes_written = write_metagenome_gff(self.genes_gff_loc, self.annotations_loc, output_gff_loc, chunksize=2)
+        self.assertEqual(genes_written, 3)
+        metagenome = self.read_gff(output_gff_loc)
+        # the metagenome keeps DRAM's scaffold names, they are unique across its bins
+        self.assertEqual([i[0] for i in metagenome], ['##gff-version 3', 'bin_1_contig_1', 'bin_1_contig_2',
+                                                      '001_contig_1'])
+        self.assertTrue(metagenome[1][8].endswith(';product=alcohol dehydrogenase [EC:1.1.1.1];'))
+        self.assertEqual(os.listdir(self.output_dir), ['metagenome.gff'])
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+from kb_DRAM.utils.heatmap_util import write_product_heatmap, HEATMAP_DIR
+
+NODE = shutil.which('node')
+# runs product.html's script with a stand in for the page, prints what it put in the heatmap and group list
+RENDER_VIEWER = '''
+const fs = require('fs');
+const path = require('path');
+const dir = process.argv[1];
+const html = fs.readFileSync(path.join(dir, 'product.html'), 'utf8');
+const script = html.split('<script>')[1].split('</script>')[0];
+const elements = {};
+const document = {getElementById: function (id) {
+  return elements[id] = elements[id] || {innerHTML: '', textContent: ''};
+}};
+const fetch = function (file) {
+  return Promise.resolve({json: function () {return JSON.parse(fs.readFileSync(path.join(dir, file), 'utf8'));}});
+};
+new Function('document', 'fetch', script)(document, fetch);
+setTimeout(function () {
+  console.log(JSON.stringify({heatmap: elements.heatmap.innerHTML, group: elements.group.innerHTML}));
+}, 100);
+'''
+
+
+class ProductHeatmapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_product(self, genomes, columns=('Complex I', 'Methanogenesis & <b>')):
+        with open(os.path.join(self.tmp_dir, 'product.tsv'), 'w') as f:
+            f.write('\t'.join(('genome',) + columns) + '\n')
+            for i, genome in enumerate(genomes):
+                f.write('%s\t%s\t%s\n' % (genome, (i % 10) / 10, i % 2 == 0))
+
+    def test_below_threshold(self):
+        self.write_product(['bin_%s' % i for i in range(200)])
+        self.assertFalse(write_product_heatmap(self.tmp_dir))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, HEATMAP_DIR)))
+
+    def test_pages_written(self):
+        genomes = ['bin_%s' % i for i in range(250)]
+        self.write_product(genomes)
+        groups = {genome: 'd__Bacteria;p__Firmicutes' for genome in genomes[:120]}
+        self.assertTrue(write_product_heatmap(self.tmp_dir, groups))
+        heatmap_dir = os.path.join(self.tmp_dir, HEATMAP_DIR)
+        self.assertEqual(sorted(os.listdir(heatmap_dir)), ['index.json', 'page_0.json', 'page_1.json',
+                                                           'page_2.json'])
+        with open(os.path.join(heatmap_dir, 'index.json')) as f:
+            index = json.load(f)
+        self.assertEqual([i['file'] for i in index['pages']], ['page_0.json', 'page_1.json', 'page_2.json'])
+        self.assertEqual(index['groups'], [{'name': 'Unclassified', 'page': 0, 'genomes': 130},
+                                           {'name': 'd__Bacteria;p__Firmicutes', 'page': 1, 'genomes': 120}])
+        paged = list()
+        for page in index['pages']:
+            with open(os.path.join(heatmap_dir, page['file'])) as f:
+                page = json.load(f)
+            self.assertEqual([len(i) for i in page['values']], [len(page['genomes'])] * 2)
+            paged += page['genomes']
+        # every genome on exactly one page
+        self.assertEqual(sorted(paged), sorted(genomes))
+        with open(os.path.join(self.tmp_dir, 'product.html')) as f:
+            self.assertIn("var HEATMAP_DIR = '%s';" % HEATMAP_DIR, f.read())
+
+    @unittest.skipIf(NODE is None, 'node is not installed')
+    def test_names_escaped(self):
+        genomes = ['bin_%s' % i for i in range(201)]
+        genomes[0] = '<script>alert(1)</script>'
+        genomes[1] = 'bin_1 & "2"'
+        self.write_product(genomes)
+        # the viewer opens on the first page, which starts with this group
+        groups = {genome: '<img src=x onerror=alert(1)>' for genome in genomes[:2]}
+        self.assertTrue(write_product_heatmap(self.tmp_dir, groups))
+        rendered = json.loads(subprocess.run([NODE, '-e', RENDER_VIEWER, self.tmp_dir], check=True,
+                                             capture_output=True, text=True).stdout)
+        html = rendered['heatmap'] + rendered['group']
+        self.assertNotIn('<script>', html)
+        self.assertNotIn('<img', html)
+        self.assertNotIn('<b>', html)
+        self.assertIn('&lt;script&gt;alert(1)&lt;/script&gt;', rendered['heatmap'])
+        self.assertIn('bin_1 &amp; &quot;2&quot;', rendered['heatmap'])
+        self.assertIn('Methanogenesis &amp; &lt;b&gt;', rendered['heatmap'])
+        self.assertIn('&lt;img src=x onerror=alert(1)&gt;', rendered['group'])
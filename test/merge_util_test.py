@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from kb_DRAM.utils.merge_util import merge_dram_outputs
+
+
+def write_table(table_loc, rows):
+    with open(table_loc, 'w') as f:
+        for row in rows:
+            f.write('\t'.join(row) + '\n')
+
+
+def read_table(table_loc):
+    with open(table_loc) as f:
+        return [line.rstrip('\n').split('\t') for line in f]
+
+
+class MergeUtilTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.shard_dirs = [os.path.join(self.tmp_dir, 'shard_%s' % i) for i in range(2)]
+        for shard_dir in self.shard_dirs:
+            os.mkdir(shard_dir)
+        # the second shard used a database the first did not and lacks one the first used
+        write_table(os.path.join(self.shard_dirs[0], 'annotations.tsv'), [
+            ['', 'fasta', 'scaffold', 'gene_position', 'ko_id', 'pfam_hits'],
+            ['bin_1_s1_1', 'bin_1', 'bin_1_s1', '1', 'K00001', 'PF00001'],
+            ['bin_1_s1_10', 'bin_1', 'bin_1_s1', '10', '', ''],
+            ['bin_3_s1_2', 'bin_3', 'bin_3_s1', '2', 'K00003', ''],
+        ])
+        write_table(os.path.join(self.shard_dirs[1], 'annotations.tsv'), [
+            ['', 'fasta', 'scaffold', 'gene_position', 'ko_id', 'cazy_hits'],
+            ['bin_1_s2_2', 'bin_1', 'bin_1_s2', '2', 'K00002', 'GH5'],
+            ['bin_2_s1_1', 'bin_2', 'bin_2_s1', '1', '', 'GT2'],
+        ])
+        write_table(os.path.join(self.shard_dirs[0], 'trnas.tsv'), [
+            ['gene_id', 'fasta', 'type'],
+            ['bin_1_trna_1', 'bin_1', 'Ala'],
+        ])
+        write_table(os.path.join(self.shard_dirs[1], 'trnas.tsv'), [
+            ['gene_id', 'fasta', 'type', 'note'],
+            ['bin_2_trna_1', 'bin_2', 'Gly', 'pseudo'],
+        ])
+        for i, shard_dir in enumerate(self.shard_dirs):
+            with open(os.path.join(shard_dir, 'genes.faa'), 'w') as f:
+                f.write('>gene_%s\nMK\n' % i)
+        self.output_dir = os.path.join(self.tmp_dir, 'merged')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_columns_aligned(self):
+        merge_dram_outputs(self.shard_dirs, self.output_dir)
+        annotations = read_table(os.path.join(self.output_dir, 'annotations.tsv'))
+        self.assertEqual(annotations[0], ['', 'fasta', 'scaffold', 'gene_position', 'ko_id', 'pfam_hits',
+                                          'cazy_hits'])
+        rows = {row[0]: dict(zip(annotations[0], row)) for row in annotations[1:]}
+        self.assertEqual(rows['bin_1_s1_1']['pfam_hits'], 'PF00001')
+        self.assertEqual(rows['bin_1_s1_1']['cazy_hits'], '')
+        self.assertEqual(rows['bin_2_s1_1']['pfam_hits'], '')
+        self.assertEqual(rows['bin_2_s1_1']['cazy_hits'], 'GT2')
+        trnas = read_table(os.path.join(self.output_dir, 'trnas.tsv'))
+        self.assertEqual(trnas, [['gene_id', 'fasta', 'type', 'note'],
+                                 ['bin_1_trna_1', 'bin_1', 'Ala', ''],
+                                 ['bin_2_trna_1', 'bin_2', 'Gly', 'pseudo']])
+
+    def test_merge_order(self):
+        # by fasta, scaffold and then gene position as a number, as DRAM sorts a single run
+        merge_dram_outputs(self.shard_dirs, self.output_dir)
+        annotations = read_table(os.path.join(self.output_dir, 'annotations.tsv'))
+        self.assertEqual([row[0] for row in annotations[1:]],
+                         ['bin_1_s1_1', 'bin_1_s1_10', 'bin_1_s2_2', 'bin_2_s1_1', 'bin_3_s1_2'])
+        with open(os.path.join(self.output_dir, 'genes.faa')) as f:
+            self.assertEqual(f.read(), '>gene_0\nMK\n>gene_1\nMK\n')
+        self.assertFalse(os.path.exists(os.path.join(self.output_dir, 'gene_ids.sqlite')))
+
+    def test_gene_id_collision(self):
+        with open(os.path.join(self.shard_dirs[1], 'annotations.tsv'), 'a') as f:
+            f.write('bin_1_s1_1\tbin_4\tbin_4_s1\t1\t\t\n')
+        with self.assertRaisesRegex(ValueError, 'bin_1_s1_1'):
+            merge_dram_outputs(self.shard_dirs, self.output_dir)
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import json
+import unittest
+
+from kb_DRAM.utils.dram_util import split_ontology_event
+from kb_DRAM.utils.kbase_util import submit_ontology_events
+
+
+def ontology_event(genome_name, gene_count, ontology_ids=('KO', 'EC')):
+    events = [{'description': 'DRAM_%s' % ontology_id, 'ontology_id': ontology_id, 'method': 'DRAM',
+               'ontology_terms': {'%s_gene_%s' % (genome_name, i): [{'term': '%s:%05d' % (ontology_id, i)}]
+                                  for i in range(gene_count)}}
+              for ontology_id in ontology_ids]
+    return {'input_ref': '1/%s/1' % genome_name, 'output_name': genome_name, 'events': events, 'save': 1}
+
+
+class AnnotationOntologyAPI:
+    # records what was added and saves every event as a new version of its input
+    def __init__(self):
+        self.added = list()
+
+    def add_annotation_ontology_events(self, params):
+        self.added.append(params)
+        workspace, object_id, version = params['input_ref'].split('/')
+        return {'output_ref': '%s/%s/%s' % (workspace, object_id, int(version) + 1)}
+
+
+class SplitOntologyEventTest(unittest.TestCase):
+
+    def test_small_event_not_split(self):
+        event = ontology_event('bin_1', 10)
+        self.assertEqual(split_ontology_event(event), [event])
+
+    def test_chunks_capped(self):
+        event = ontology_event('bin_1', 1000)
+        max_bytes = 5000
+        chunks = split_ontology_event(event, max_bytes)
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks:
+            self.assertLessEqual(sum(len(json.dumps(i['ontology_terms'])) for i in chunk['events']), max_bytes)
+        # every gene's terms are in exactly one chunk
+        for original in event['events']:
+            genes = dict()
+            for chunk in chunks:
+                for chunk_event in chunk['events']:
+                    if chunk_event['ontology_id'] == original['ontology_id']:
+                        self.assertFalse(set(genes) & set(chunk_event['ontology_terms']))
+                        genes.update(chunk_event['ontology_terms'])
+            self.assertEqual(genes, original['ontology_terms'])
+        descriptions = [i['description'] for chunk in chunks for i in chunk['events']]
+        self.assertEqual(len(descriptions), len(set(descriptions)))
+        self.assertEqual(chunks[0]['events'][0]['description'], 'DRAM_KO_part1')
+
+    def test_gene_larger_than_max_bytes(self):
+        # a gene is never split, it gets a chunk of its own
+        event = ontology_event('bin_1', 3, ontology_ids=('KO',))
+        chunks = split_ontology_event(event, 10)
+        self.assertEqual([len(i['events'][0]['ontology_terms']) for i in chunks], [1, 1, 1])
+
+
+class SubmitOntologyEventsTest(unittest.TestCase):
+
+    def test_chunks_chained(self):
+        anno_api = AnnotationOntologyAPI()
+        events = split_ontology_event(ontology_event('bin_1', 1000), 5000) + [ontology_event('bin_2', 10)]
+        output_refs, chunk_counts = submit_ontology_events(anno_api, events)
+        bin_1_chunks = len(events) - 1
+        # each chunk is added to the version the previous one saved
+        self.assertEqual([i['input_ref'] for i in anno_api.added[:bin_1_chunks]],
+                         ['1/bin_1/%s' % (i + 1) for i in range(bin_1_chunks)])
+        self.assertEqual(output_refs, {'bin_1': '1/bin_1/%s' % (bin_1_chunks + 1), 'bin_2': '1/bin_2/2'})
+        self.assertEqual(chunk_counts, {'bin_1': bin_1_chunks, 'bin_2': 1})
+
+    def test_resume_skips_submitted(self):
+        anno_api = AnnotationOntologyAPI()
+        events = split_ontology_event(ontology_event('bin_1', 1000), 5000)
+        submitted_refs = list()
+        submitted = {'bin_1': {'output_ref': '1/bin_1/3', 'chunks': 2}}
+        output_refs, chunk_counts = submit_ontology_events(
+            anno_api, events, submitted=submitted,
+            on_submitted=lambda genome_name, output_ref: submitted_refs.append(output_ref))
+        self.assertEqual(len(anno_api.added), len(events) - 2)
+        self.assertEqual(anno_api.added[0]['input_ref'], '1/bin_1/3')
+        self.assertEqual(anno_api.added[0]['events'], events[2]['events'])
+        self.assertEqual(submitted_refs, ['1/bin_1/%s' % (i + 4) for i in range(len(events) - 2)])
+        self.assertEqual(chunk_counts, {'bin_1': len(events)})
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+import pandas as pd
+
+from kb_DRAM.utils.dram_util import OntologyExtractor, add_ontology_terms, get_dram_events, \
+    annotations_from_ontology_events, write_set_annotations
+
+
+def genome_annotations():
+    return pd.DataFrame({
+        'fasta': ['bin_1', 'bin_1', 'bin_1'],
+        'ko_id': ['K00001,K00002', None, 'K00001'],
+        'kegg_hit': ['alcohol dehydrogenase [EC:1.1.1.1]', None, 'dehydrogenase [EC:1.1.1.1] [EC:1.1.1.2]'],
+        'uniref_hit': ['UniRef90_A [EC:1.1.1.1]', None, None],
+        'pfam_hits': ['Adh [PF00107.29]; ADH_N [PF08240.15]', 'Peptidase [PF00082.25]', None],
+        'cazy_hits': [None, 'GH5_2 cellulase; CBM1', None],
+        'peptidase_family': [None, 'S8;S53', None],
+    }, index=['gene_1', 'gene_2', 'gene_3'])
+
+
+class OntologyExtractorTest(unittest.TestCase):
+
+    def test_extract(self):
+        terms = OntologyExtractor().extract(genome_annotations())
+        self.assertEqual(terms['KO'], {'gene_1': ['K00001', 'K00002'], 'gene_3': ['K00001']})
+        # EC terms come from every _hit column, once per gene, in the order found
+        self.assertEqual(terms['EC'], {'gene_1': ['EC:1.1.1.1'], 'gene_3': ['EC:1.1.1.1', 'EC:1.1.1.2']})
+        self.assertEqual(terms['PFAM'], {'gene_1': ['PF00107', 'PF08240'], 'gene_2': ['PF00082']})
+        self.assertEqual(terms['CAZy'], {'gene_2': ['GH5_2', 'CBM1']})
+        self.assertEqual(terms['MEROPS'], {'gene_2': ['S8', 'S53']})
+
+    def test_selected_ontologies(self):
+        terms = OntologyExtractor(('EC', 'KO')).extract(genome_annotations())
+        self.assertEqual(list(terms), ['EC', 'KO'])
+
+    def test_missing_columns(self):
+        # a run without a database has no column for it, its ontology comes back empty
+        annotations = genome_annotations()[['fasta', 'ko_id']]
+        terms = OntologyExtractor().extract(annotations)
+        self.assertEqual(terms['KO'], {'gene_1': ['K00001', 'K00002'], 'gene_3': ['K00001']})
+        self.assertEqual(terms['EC'], {})
+        self.assertEqual(terms['PFAM'], {})
+
+
+class AddOntologyTermsTest(unittest.TestCase):
+
+    def test_empty_events_skipped(self):
+        annotations = genome_annotations()[['fasta', 'ko_id', 'pfam_hits']]
+        ontology_events = list(add_ontology_terms(annotations, 'DRAM', '0.1.3', 'workspace', 'url',
+                                                  {'bin_1_DRAM': '1/2/3'}))
+        self.assertEqual(len(ontology_events), 1)
+        self.assertEqual(ontology_events[0]['input_ref'], '1/2/3')
+        events = {i['ontology_id']: i for i in ontology_events[0]['events']}
+        # KO and EC are always added so the genome counts as annotated, the others only with terms
+        self.assertEqual(sorted(events), ['EC', 'KO', 'PFAM'])
+        self.assertEqual(events['EC']['ontology_terms'], {})
+        self.assertEqual(events['KO']['ontology_terms']['gene_1'], [{'term': 'K00001'}, {'term': 'K00002'}])
+        self.assertEqual(events['KO']['method_version'], '0.1.3')
+
+
+class PriorAnnotationsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def prior_annotations(self):
+        ontology_event = next(add_ontology_terms(genome_annotations(), 'DRAM', '0.1.3', 'workspace', 'url',
+                                                 {'bin_1_DRAM': '1/2/3'}))
+        dram_events = get_dram_events(ontology_event['events'], '0.1.3')
+        self.assertEqual(sorted(dram_events), ['CAZy', 'EC', 'KO', 'MEROPS', 'PFAM'])
+        return annotations_from_ontology_events('bin_1', dram_events)
+
+    def test_every_ontology_rebuilt(self):
+        annotations = self.prior_annotations()
+        self.assertEqual(annotations.loc['gene_1', 'ko_id'], 'K00001,K00002')
+        self.assertEqual(annotations.loc['gene_3', 'kegg_hit'], '[EC:1.1.1.1] [EC:1.1.1.2]')
+        self.assertEqual(annotations.loc['gene_1', 'pfam_hits'], '[PF00107.]; [PF08240.]')
+        self.assertEqual(annotations.loc['gene_2', 'cazy_best_hit'], 'GH5_2')
+        self.assertEqual(annotations.loc['gene_2', 'peptidase_family'], 'S8;S53')
+        # the rebuilt columns give back the terms the events were made from
+        terms = OntologyExtractor().extract(annotations)
+        self.assertEqual(terms, OntologyExtractor().extract(genome_annotations()))
+
+    def test_missing_columns_added(self):
+        # this run had no kegg or pfam columns, the earlier genome's ECs and PFAMs are still written
+        annotations_loc = os.path.join(self.tmp_dir, 'annotations.tsv')
+        with open(annotations_loc, 'w') as f:
+            f.write('\tfasta\tko_id\nbin_2_1\tbin_2\tK00003\n')
+        output_loc = write_set_annotations(annotations_loc, [self.prior_annotations()],
+                                           os.path.join(self.tmp_dir, 'set_annotations.tsv'))
+        set_annotations = pd.read_csv(output_loc, sep='\t', index_col=0)
+        self.assertEqual(list(set_annotations.columns)[:2], ['fasta', 'ko_id'])
+        self.assertEqual(set_annotations.loc['gene_3', 'kegg_hit'], '[EC:1.1.1.1] [EC:1.1.1.2]')
+        self.assertEqual(set_annotations.loc['gene_2', 'pfam_hits'], '[PF00082.]')
+        self.assertEqual(set_annotations.loc['bin_2_1', 'ko_id'], 'K00003')
+        self.assertTrue(pd.isna(set_annotations.loc['bin_2_1', 'kegg_hit']))
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from installed_clients.baseclient import ServerError
+from kb_DRAM.utils.kbase_util import save_genomes, save_genomes_from_gff, get_saved_refs, write_genome_statuses
+
+
+class GenomeFileUtil:
+    # fails each genome the number of times given in failures before saving it, with a server error that can be
+    # retried unless it is given in errors
+    def __init__(self, failures=None, errors=None):
+        self.failures = dict(failures or dict())
+        self.errors = dict(errors or dict())
+        self.saved = list()
+        self.attempts = list()
+
+    def _save(self, name):
+        self.attempts.append(name)
+        if self.failures.get(name, 0) > 0:
+            self.failures[name] -= 1
+            raise self.errors.get(name, ServerError('JSONRPCError', -32000, 'Could not save %s' % name))
+        self.saved.append(name)
+        return len(self.saved)
+
+    def save_one_genome(self, params):
+        object_id = self._save(params['name'])
+        return {'info': [object_id, params['name'], 'KBaseGenomes.Genome', None, 1, None, 7]}
+
+    def fasta_gff_to_genome(self, params):
+        return {'genome_ref': '7/%s/1' % self._save(params['genome_name'])}
+
+
+def genome_objects(names):
+    return ({'name': name, 'data': {}} for name in names)
+
+
+class SaveGenomesTest(unittest.TestCase):
+
+    def test_saved(self):
+        saved_refs = dict()
+        statuses = save_genomes(GenomeFileUtil(), genome_objects(['bin_1', 'bin_2']), on_saved=saved_refs.__setitem__,
+                                backoff=0)
+        self.assertEqual(statuses['bin_1'], {'status': 'saved', 'attempts': 1, 'ref': '7/1/1', 'error': None})
+        self.assertEqual(saved_refs, {'bin_1': '7/1/1', 'bin_2': '7/2/1'})
+
+    def test_failure_retried(self):
+        # bin_1 fails once and is saved on its retry after the other genomes, bin_2 never saves
+        genome_util = GenomeFileUtil({'bin_1': 1, 'bin_2': 10})
+        statuses = save_genomes(genome_util, genome_objects(['bin_1', 'bin_2', 'bin_3']), retries=2, backoff=0)
+        self.assertEqual(genome_util.saved, ['bin_3', 'bin_1'])
+        self.assertEqual(statuses['bin_1'], {'status': 'saved', 'attempts': 2, 'ref': '7/2/1', 'error': None})
+        self.assertEqual(statuses['bin_2'], {'status': 'failed', 'attempts': 3, 'ref': None,
+                                             'error': 'JSONRPCError: -32000. Could not save bin_2'})
+        self.assertEqual(get_saved_refs(statuses), {'bin_1': '7/2/1', 'bin_3': '7/1/1'})
+
+    def test_deterministic_failure_not_retried(self):
+        # a genome the server rejects, or an error that is not from the server, fails on its first attempt
+        genome_util = GenomeFileUtil({'bin_1': 10, 'bin_2': 10}, {
+            'bin_1': ServerError('JSONRPCError', -32500, 'Object #1 failed type checking'),
+            'bin_2': ValueError('Genome bin_2 has no features')})
+        statuses = save_genomes(genome_util, genome_objects(['bin_1', 'bin_2', 'bin_3']), backoff=0)
+        self.assertEqual(genome_util.attempts, ['bin_1', 'bin_2', 'bin_3'])
+        self.assertEqual([statuses[i]['attempts'] for i in ('bin_1', 'bin_2')], [1, 1])
+        self.assertEqual(statuses['bin_2']['error'], 'Genome bin_2 has no features')
+
+    def test_connection_error_retried(self):
+        genome_util = GenomeFileUtil({'bin_1': 1}, {'bin_1': ConnectionError('Connection reset by peer')})
+        statuses = save_genomes(genome_util, genome_objects(['bin_1']), backoff=0)
+        self.assertEqual(statuses['bin_1']['status'], 'saved')
+        self.assertEqual(statuses['bin_1']['attempts'], 2)
+
+    def test_saved_skipped(self):
+        # genomes a resumed run already saved keep their refs and are not saved again
+        genome_util = GenomeFileUtil()
+        statuses = save_genomes(genome_util, genome_objects(['bin_1', 'bin_2']), saved={'bin_1': '7/9/1'},
+                                backoff=0)
+        self.assertEqual(genome_util.saved, ['bin_2'])
+        self.assertEqual(statuses['bin_1'], {'status': 'saved', 'attempts': 0, 'ref': '7/9/1', 'error': None})
+
+    def test_none_saved(self):
+        statuses = save_genomes(GenomeFileUtil({'bin_1': 10}), genome_objects(['bin_1']), retries=1, backoff=0)
+        with self.assertRaisesRegex(ValueError, 'Could not save bin_1'):
+            get_saved_refs(statuses)
+
+    def test_from_gff(self):
+        genome_util = GenomeFileUtil({'bin_1_DRAM': 1})
+        assemblies = {'1/1/1': {'paths': ['bin_1.fa']}, '1/2/1': {'paths': ['bin_2.fa']}}
+        statuses = save_genomes_from_gff(genome_util, {'bin_1': 'bin_1.gff', 'bin_2': 'bin_2.gff'},
+                                         {'bin_1': '1/1/1', 'bin_2': '1/2/1'}, assemblies, 'workspace', backoff=0)
+        self.assertEqual(genome_util.saved, ['bin_2_DRAM', 'bin_1_DRAM'])
+        self.assertEqual({name: i['attempts'] for name, i in statuses.items()}, {'bin_1_DRAM': 2, 'bin_2_DRAM': 1})
+
+
+class WriteGenomeStatusesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_statuses_written(self):
+        statuses = save_genomes(GenomeFileUtil({'bin_2': 10}), genome_objects(['bin_1', 'bin_2']), retries=0,
+                                backoff=0)
+        status_loc = os.path.join(self.tmp_dir, 'genome_status.tsv')
+        message = write_genome_statuses(statuses, {'bin_1': 3}, status_loc)
+        self.assertEqual(message, 'Saved 1 of 2 genomes. These genomes could not be saved, see genome_status.tsv: '
+                                  'bin_2')
+        with open(status_loc) as f:
+            self.assertEqual(f.read().splitlines(), [
+                'genome\tstatus\tattempts\tgenome_ref\tontology_event_chunks\terror',
+                'bin_1\tsaved\t1\t7/1/1\t3\t',
+                'bin_2\tfailed\t1\t\t0\tJSONRPCError: -32000. Could not save bin_2'])
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from kb_DRAM.utils.scratch_util import JobScratch, StageManifest
+
+PARAMS = {'assembly_input_ref': '1/2/3', 'min_contig_size': 2500, 'job_key': 'run_1'}
+
+
+class StageManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.shared_folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.shared_folder)
+
+    def resumed(self, params=PARAMS):
+        scratch = JobScratch(self.shared_folder, 'DRAM_annotate', job_key=params['job_key'])
+        return scratch, StageManifest(scratch.path('stage_manifest.json'), params)
+
+    def test_stages_resumed(self):
+        scratch, manifest = self.resumed()
+        self.assertFalse(manifest.done('annotation'))
+        manifest.complete('annotation', output_dir=scratch.path('DRAM_annos'))
+        resumed_scratch, resumed = self.resumed()
+        # the same job key gets the same scratch directory back
+        self.assertEqual(resumed_scratch.root, scratch.root)
+        self.assertTrue(resumed.done('annotation'))
+        self.assertFalse(resumed.done('distillation'))
+        self.assertEqual(resumed.outputs('annotation'), {'output_dir': scratch.path('DRAM_annos')})
+
+    def test_different_params(self):
+        self.resumed()
+        with self.assertRaises(ValueError):
+            self.resumed(dict(PARAMS, min_contig_size=1000))
+
+    def test_saved_and_submitted(self):
+        _, manifest = self.resumed()
+        manifest.record_saved('bin_1', '1/4/1')
+        manifest.record_ontology_event('bin_1', '1/4/2')
+        manifest.record_ontology_event('bin_1', '1/4/3')
+        manifest.record_ontology_event('bin_2', '1/5/2')
+        _, resumed = self.resumed()
+        self.assertEqual(resumed.saved, {'bin_1': '1/4/1'})
+        # the chunks already added to each genome and the version the last one saved
+        self.assertEqual(resumed.ontology_events, {'bin_1': {'output_ref': '1/4/3', 'chunks': 2},
+                                                   'bin_2': {'output_ref': '1/5/2', 'chunks': 1}})
+        # handing them out does not change the manifest
+        resumed.saved['bin_2'] = '1/5/1'
+        resumed.ontology_events['bin_1']['chunks'] = 0
+        self.assertEqual(resumed.saved, {'bin_1': '1/4/1'})
+        self.assertEqual(resumed.ontology_events['bin_1']['chunks'], 2)
+
+    def test_interrupted_directory_released(self):
+        # a stage that failed part way leaves its directory behind, releasing it lets the rerun make it again
+        scratch, _ = self.resumed()
+        with open(os.path.join(scratch.mkdir('genome_gffs'), 'bin_1.gff'), 'w') as f:
+            f.write('##gff-version 3\n')
+        resumed_scratch, _ = self.resumed()
+        resumed_scratch.release(resumed_scratch.path('genome_gffs'))
+        self.assertEqual(os.listdir(resumed_scratch.mkdir('genome_gffs')), [])
+        self.assertEqual(resumed_scratch.released_bytes, len('##gff-version 3\n'))
+
+
+class JobScratchBudgetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.shared_folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.shared_folder)
+
+    def test_projected_over_budget(self):
+        # a stage expected to go over the budget fails before it runs, checkpoint still checks after it
+        scratch = JobScratch(self.shared_folder, 'DRAM_annotate', budget=100)
+        with open(scratch.path('scaffolds.fna'), 'w') as f:
+            f.write('A' * 60)
+        scratch.check_projected('annotation', 40)
+        with self.assertRaisesRegex(ValueError, 'annotation is expected to add 41 bytes'):
+            scratch.check_projected('annotation', 41)
+        with open(scratch.path('genes.fna'), 'w') as f:
+            f.write('A' * 50)
+        with self.assertRaisesRegex(ValueError, 'after annotation'):
+            scratch.checkpoint('annotation')
+
+    def test_no_budget(self):
+        JobScratch(self.shared_folder, 'DRAM_annotate').check_projected('annotation', 10 ** 15)